@@ -1,35 +1,101 @@
 from flask import Flask, render_template, request, jsonify
 from flask_cors import CORS
-from database import Database
+from dotenv import load_dotenv
+from database import REFERRAL_BONUSES, Database, encode_task_cursor
+from tap_buffer import TapAccumulator
+from energy import EnergyEngine
+from leaderboard import Leaderboard
+from telegram_auth import InitDataError, TelegramAuth, parse_init_data
+from user_search import telegram_id_query
+import referral_codes
 from datetime import datetime
-import hashlib
-import hmac
+import atexit
+import logging
 import os
-import json
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 CORS(app)
 db = Database()
 
 # Constants
-REFERRAL_BONUS = 5.0
+REFERRAL_BONUS = REFERRAL_BONUSES[0]
 TASK_CREATION_COST = 2.0
 TASK_COMPLETION_REWARD = 10.0
+ADMIN_TELEGRAM_IDS = [i.strip() for i in os.environ.get('ADMIN_TELEGRAM_IDS', '').split(',') if i.strip()]
+TAP_REWARD = 1.0  # Coins per tap
+MAX_TAPS_PER_BATCH = 500  # Upper bound for a single /api/tap batch
+MAX_ENERGY = 100  # One tap costs one energy
+ENERGY_RECHARGE_PER_SECOND = 1.0
+MAX_TAPS_PER_SECOND = 15  # Sustained tap rate a human can reach
+TASK_PAGE_SIZE = 20
+MAX_TASK_PAGE_SIZE = 100
+OPEN_TASKS_LIMIT = 100  # Assigned + available tasks returned by /api/tasks
+LEADERBOARD_SIZE = 10
+MAX_LEADERBOARD_RADIUS = 50  # Neighbours on each side returned by /api/leaderboard/rank
+
+# Write-behind buffering of tap credits (set TAP_WRITE_BEHIND=0 to write each batch directly)
+tap_buffer = None
+if os.environ.get('TAP_WRITE_BEHIND', '1') != '0':
+    tap_buffer = TapAccumulator(
+        db,
+        spill_path=os.environ.get('TAP_SPILL_PATH', 'tap_spill.log'),
+        flush_interval_ms=int(os.environ.get('TAP_FLUSH_INTERVAL_MS', 500)),
+        max_entries=int(os.environ.get('TAP_FLUSH_MAX_ENTRIES', 1000)),
+        fsync=os.environ.get('TAP_SPILL_FSYNC', '0') == '1'
+    )
+    tap_buffer.start()
+    atexit.register(tap_buffer.stop)
+
+# Server-authoritative energy, checked before a tap batch touches the database
+energy_engine = EnergyEngine(
+    db,
+    max_energy=MAX_ENERGY,
+    recharge_per_second=ENERGY_RECHARGE_PER_SECOND,
+    max_taps_per_second=MAX_TAPS_PER_SECOND,
+    checkpoint_interval=int(os.environ.get('ENERGY_CHECKPOINT_SECONDS', 30))
+)
+energy_engine.start()
+atexit.register(energy_engine.stop)
 
-def verify_telegram_webapp(data, hash_str, bot_token):
-    """Verify Telegram WebApp data"""
-    data_check_string = '&'.join(f"{k}={v}" for k, v in sorted(data.items()) if k != 'hash')
-    secret_key = hmac.new(
-        key=b"WebAppData",
-        msg=bot_token.encode(),
-        digestmod=hashlib.sha256
-    ).digest()
-    calculated_hash = hmac.new(
-        key=secret_key,
-        msg=data_check_string.encode(),
-        digestmod=hashlib.sha256
-    ).hexdigest()
-    return calculated_hash == hash_str
+# Ranking kept in memory, updated on every balance change
+leaderboard = Leaderboard(
+    db,
+    snapshot_path=os.environ.get('LEADERBOARD_SNAPSHOT_PATH', 'leaderboard_snapshot.json'),
+    refresh_interval=float(os.environ.get('LEADERBOARD_REFRESH_SECONDS', 1.0))
+)
+leaderboard.start()
+atexit.register(leaderboard.stop)
+
+# initData is verified against the bot token and writes need the session
+# token issued for it. ALLOW_UNVERIFIED_USERS=1 is for local development
+# only: initData is then parsed unverified if there is no bot token, and
+# writes without a session act for whatever telegram_id they claim.
+telegram_auth = TelegramAuth(os.environ['TELEGRAM_BOT_TOKEN']) if os.environ.get('TELEGRAM_BOT_TOKEN') else None
+ALLOW_UNVERIFIED_USERS = os.environ.get('ALLOW_UNVERIFIED_USERS', '0') == '1'
+if telegram_auth is None and not ALLOW_UNVERIFIED_USERS:
+    logger.warning('TELEGRAM_BOT_TOKEN is not set: Mini App users are rejected (ALLOW_UNVERIFIED_USERS=1 for development)')
+if telegram_auth is not None:
+    # Verified users get referral codes to share, which must not be forgeable
+    referral_codes.require_secret()
+
+def caller_telegram_id(claimed):
+    """The Telegram id a request acts for, or None if its session doesn't allow it
+    
+    A request must carry a session token from /api/user (Authorization:
+    Bearer ...) and `claimed` must be the token's user. Only with
+    ALLOW_UNVERIFIED_USERS is a request without one trusted.
+    """
+    header = request.headers.get('Authorization', '')
+    if telegram_auth is None or not header.startswith('Bearer '):
+        return claimed if ALLOW_UNVERIFIED_USERS else None
+    telegram_id = telegram_auth.session_telegram_id(header[len('Bearer '):])
+    if telegram_id is None or claimed != telegram_id:
+        return None
+    return telegram_id
 
 @app.route('/')
 def index():
@@ -43,21 +109,20 @@ def get_user():
         data = request.json
         init_data = data.get('initData', '')
         
-        # Parse initData
-        params = {}
-        for pair in init_data.split('&'):
-            if '=' in pair:
-                key, value = pair.split('=', 1)
-                params[key] = value
+        try:
+            if telegram_auth:
+                params = telegram_auth.verify(init_data)
+            elif ALLOW_UNVERIFIED_USERS:
+                params = parse_init_data(init_data)
+            else:
+                return jsonify({'error': 'initData cannot be verified without TELEGRAM_BOT_TOKEN'}), 401
+        except InitDataError as e:
+            return jsonify({'error': f'Invalid initData: {e}'}), 401
         
-        # Verify (in production, verify with bot token)
-        telegram_id = int(params.get('user', '{}').split('"id":')[1].split(',')[0]) if 'user' in params else None
-        if not telegram_id:
+        user_data = params.get('user')
+        telegram_id = user_data.get('id') if isinstance(user_data, dict) else None
+        if not isinstance(telegram_id, int):
             return jsonify({'error': 'Invalid user data'}), 400
-        
-        # Parse user JSON
-        user_data = json.loads(params.get('user', '{}'))
-        telegram_id = user_data.get('id')
         username = user_data.get('username')
         first_name = user_data.get('first_name')
         
@@ -69,39 +134,49 @@ def get_user():
         
         # Handle referral if code provided and user not already referred
         if referral_code and not user.referred_by:
-            referrer = db.get_user_by_referral_code(referral_code)
-            if referrer and referrer.id != user.id:
-                session = db.get_session()
-                try:
-                    from database import User
-                    db_user = session.query(User).filter_by(id=user.id).first()
-                    if db_user:
-                        db_user.referred_by = referrer.id
-                        session.commit()
-                        # Give bonus to referrer
-                        db.add_coins(referrer.id, REFERRAL_BONUS, 'referral_bonus', 
-                                   f'Referred user {first_name}')
-                finally:
-                    session.close()
+            db.attach_referral(user.id, referral_code, first_name)
         
         # Check if user is admin
         is_admin = str(user.telegram_id) in ADMIN_TELEGRAM_IDS or user.is_admin
+        energy = energy_engine.status(user.telegram_id)
         
         return jsonify({
             'id': user.id,
             'telegram_id': user.telegram_id,
             'username': user.username,
             'first_name': user.first_name,
-            'coins': user.coins,
+            'coins': user.coins + (tap_buffer.pending_coins(user.id) if tap_buffer else 0),
             'referral_code': user.referral_code,
             'is_admin': is_admin,
             'level': user.level or 1,
             'total_earned': user.total_earned or 0.0,
-            'tasks_completed': user.tasks_completed or 0
+            'tasks_completed': user.tasks_completed or 0,
+            'energy': energy['energy'],
+            'max_energy': energy['max_energy'],
+            'energy_recharge_per_second': energy['recharge_per_second'],
+            'taps_today': energy['taps_today'],
+            # Sent as "Authorization: Bearer" by later calls, so initData isn't verified again
+            'session_token': telegram_auth.issue_session(telegram_id) if telegram_auth else None
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def task_to_dict(task):
+    """Serialize a task loaded with its creator and assignee"""
+    return {
+        'id': task.id,
+        'title': task.title,
+        'description': task.description,
+        'reward_coins': task.reward_coins,
+        'completed': task.completed,
+        'created_at': task.created_at.isoformat() if task.created_at else None,
+        'completed_at': task.completed_at.isoformat() if task.completed_at else None,
+        'creator_name': task.creator.first_name if task.creator else 'Unknown',
+        'assignee_name': task.assignee.first_name if task.assignee else None,
+        'assigned_to': task.assigned_to,
+        'created_by': task.created_by
+    }
+
 @app.route('/api/tasks', methods=['GET'])
 def get_tasks():
     """Get tasks for user"""
@@ -109,50 +184,53 @@ def get_tasks():
         telegram_id = int(request.args.get('telegram_id'))
         user = db.get_or_create_user(telegram_id=telegram_id)
         
-        session = db.get_session()
-        try:
-            from database import Task, User
-            # Get assigned tasks
-            assigned_tasks = session.query(Task).filter_by(
-                assigned_to=user.id, 
-                completed=False
-            ).all()
-            
-            # Get available tasks (not assigned)
-            available_tasks = session.query(Task).filter_by(
-                assigned_to=None,
-                completed=False
-            ).all()
-            
-            # Get created tasks
-            created_tasks = session.query(Task).filter_by(
-                created_by=user.id
-            ).order_by(Task.created_at.desc()).limit(20).all()
-            
-            def task_to_dict(task):
-                creator = session.query(User).filter_by(id=task.created_by).first()
-                assignee = session.query(User).filter_by(id=task.assigned_to).first() if task.assigned_to else None
-                return {
-                    'id': task.id,
-                    'title': task.title,
-                    'description': task.description,
-                    'reward_coins': task.reward_coins,
-                    'completed': task.completed,
-                    'created_at': task.created_at.isoformat() if task.created_at else None,
-                    'completed_at': task.completed_at.isoformat() if task.completed_at else None,
-                    'creator_name': creator.first_name if creator else 'Unknown',
-                    'assignee_name': assignee.first_name if assignee else None,
-                    'assigned_to': task.assigned_to,
-                    'created_by': task.created_by
-                }
-            
-            return jsonify({
-                'assigned': [task_to_dict(t) for t in assigned_tasks],
-                'available': [task_to_dict(t) for t in available_tasks],
-                'created': [task_to_dict(t) for t in created_tasks]
-            })
-        finally:
-            session.close()
+        assigned_tasks, available_tasks, created_tasks = db.get_user_tasks(
+            user.id, open_limit=OPEN_TASKS_LIMIT
+        )
+        
+        # When the open list was cut off, the rest of the available tasks
+        # can be paged through /api/tasks/feed starting from this cursor
+        available_next_cursor = None
+        if len(assigned_tasks) + len(available_tasks) >= OPEN_TASKS_LIMIT and available_tasks:
+            available_next_cursor = encode_task_cursor(available_tasks[-1])
+        
+        return jsonify({
+            'assigned': [task_to_dict(t) for t in assigned_tasks],
+            'available': [task_to_dict(t) for t in available_tasks],
+            'created': [task_to_dict(t) for t in created_tasks],
+            'available_next_cursor': available_next_cursor
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/tasks/feed', methods=['GET'])
+def get_task_feed():
+    """Page through tasks newest first
+    
+    Query parameters: cursor (from the previous page's next_cursor), limit,
+    status (available, assigned, completed, open or all), min_reward,
+    max_reward and creator_id.
+    """
+    try:
+        args = request.args
+        limit = min(int(args.get('limit', TASK_PAGE_SIZE)), MAX_TASK_PAGE_SIZE)
+        if limit < 1:
+            raise ValueError('limit must be positive')
+        tasks, next_cursor = db.get_task_feed(
+            cursor=args.get('cursor') or None,
+            limit=limit,
+            status=args.get('status', 'available'),
+            min_reward=float(args['min_reward']) if args.get('min_reward') else None,
+            max_reward=float(args['max_reward']) if args.get('max_reward') else None,
+            creator_id=int(args['creator_id']) if args.get('creator_id') else None
+        )
+        
+        return jsonify({
+            'tasks': [task_to_dict(t) for t in tasks],
+            'next_cursor': next_cursor
+        })
+    except ValueError as e:
+        return jsonify({'error': f'Invalid feed parameters: {e}'}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -161,7 +239,9 @@ def create_task():
     """Create a new task - Admin only"""
     try:
         data = request.json
-        telegram_id = int(data.get('telegram_id'))
+        telegram_id = caller_telegram_id(int(data.get('telegram_id')))
+        if telegram_id is None:
+            return jsonify({'error': 'Invalid or expired session'}), 401
         title = data.get('title')
         description = data.get('description', '')
         reward_coins = float(data.get('reward_coins', TASK_COMPLETION_REWARD))
@@ -173,41 +253,18 @@ def create_task():
         if not is_admin:
             return jsonify({'error': 'Only admins can create tasks!'}), 403
         
-        session = db.get_session()
-        try:
-            from database import Task, Transaction
-            task = Task(
-                title=title,
-                description=description,
-                created_by=user.id,
-                reward_coins=reward_coins
-            )
-            session.add(task)
-            
-            # Admins don't pay for task creation
-            # user.coins -= TASK_CREATION_COST
-            # transaction = Transaction(
-            #     user_id=user.id,
-            #     amount=-TASK_CREATION_COST,
-            #     transaction_type='task_creation',
-            #     description=f'Created task: {title}'
-            # )
-            # session.add(transaction)
-            session.commit()
-            session.refresh(task)
-            
-            return jsonify({
-                'success': True,
-                'task': {
-                    'id': task.id,
-                    'title': task.title,
-                    'description': task.description,
-                    'reward_coins': task.reward_coins
-                },
-                'new_balance': user.coins
-            })
-        finally:
-            session.close()
+        # Admins don't pay for task creation
+        task, balance = db.create_task(user.id, title, description, reward_coins)
+        return jsonify({
+            'success': True,
+            'task': {
+                'id': task.id,
+                'title': task.title,
+                'description': task.description,
+                'reward_coins': task.reward_coins
+            },
+            'new_balance': balance
+        })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -218,7 +275,9 @@ def assign_task():
         data = request.json
         task_id = int(data.get('task_id'))
         assignee_telegram_id = int(data.get('assignee_telegram_id'))
-        assigner_telegram_id = int(data.get('assigner_telegram_id'))
+        assigner_telegram_id = caller_telegram_id(int(data.get('assigner_telegram_id')))
+        if assigner_telegram_id is None:
+            return jsonify({'error': 'Invalid or expired session'}), 401
         
         session = db.get_session()
         try:
@@ -250,64 +309,27 @@ def complete_task():
     try:
         data = request.json
         task_id = int(data.get('task_id'))
-        telegram_id = int(data.get('telegram_id'))
+        telegram_id = caller_telegram_id(int(data.get('telegram_id')))
+        if telegram_id is None:
+            return jsonify({'error': 'Invalid or expired session'}), 401
         
         user = db.get_or_create_user(telegram_id=telegram_id)
-        session = db.get_session()
-        try:
-            from database import Task, User
-            task = session.query(Task).filter_by(id=task_id).first()
-            
-            if not task:
-                return jsonify({'error': 'Task not found'}), 404
-            
-            if task.completed:
-                return jsonify({'error': 'Task already completed'}), 400
-            
-            if task.assigned_to != user.id:
-                return jsonify({'error': 'Task not assigned to you'}), 403
-            
-            task.completed = True
-            task.completed_at = datetime.utcnow()
-            session.commit()
-            
-            # Give reward
-            new_balance = db.add_coins(
-                user.id,
-                task.reward_coins,
-                'task_reward',
-                f'Completed task: {task.title}'
-            )
-            
-            # Update user stats
-            from database import User
-            db_user = session.query(User).filter_by(id=user.id).first()
-            if db_user:
-                old_level = db_user.level or 1
-                db_user.tasks_completed = (db_user.tasks_completed or 0) + 1
-                db_user.total_earned = (db_user.total_earned or 0.0) + task.reward_coins
-                
-                # Level up system (every 10 tasks = 1 level)
-                new_level = (db_user.tasks_completed // 10) + 1
-                if new_level > (db_user.level or 1):
-                    db_user.level = new_level
-                
-                session.commit()
-                level_up = new_level > old_level
-            else:
-                new_level = 1
-                level_up = False
-            
-            return jsonify({
-                'success': True,
-                'reward': task.reward_coins,
-                'new_balance': new_balance,
-                'level_up': level_up,
-                'new_level': new_level,
-                'tasks_completed': db_user.tasks_completed if db_user else 0
-            })
-        finally:
-            session.close()
+        error, result = db.complete_task(task_id, user.id)
+        if error == 'not_found':
+            return jsonify({'error': 'Task not found'}), 404
+        if error == 'completed':
+            return jsonify({'error': 'Task already completed'}), 400
+        if error == 'not_assigned':
+            return jsonify({'error': 'Task not assigned to you'}), 403
+        
+        return jsonify({
+            'success': True,
+            'reward': result['reward'],
+            'new_balance': result['balance'],
+            'level_up': result['level_up'],
+            'new_level': result['level'],
+            'tasks_completed': result['tasks_completed']
+        })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -316,69 +338,110 @@ def search_users():
     """Search users by username or telegram_id"""
     try:
         query = request.args.get('q', '')
-        session = db.get_session()
-        try:
-            from database import User
-            users = session.query(User).filter(
-                (User.username.contains(query)) | 
-                (User.first_name.contains(query)) |
-                (User.telegram_id == query if query.isdigit() else False)
-            ).limit(10).all()
-            
-            return jsonify([{
-                'id': u.id,
-                'telegram_id': u.telegram_id,
-                'username': u.username,
-                'first_name': u.first_name,
-                'coins': u.coins
-            } for u in users])
-        finally:
-            session.close()
+        users = db.search_users(query, limit=10)
+        
+        return jsonify([{
+            'id': u.id,
+            'telegram_id': u.telegram_id,
+            'username': u.username,
+            'first_name': u.first_name,
+            'coins': u.coins
+        } for u in users])
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/stats/cache', methods=['GET'])
+def get_cache_stats():
+    """User cache size and hit ratio, referral code resolution and verified initData, for this process"""
+    return jsonify(dict(
+        db.user_cache.stats(),
+        referral_codes=db.referral_codes.stats(),
+        init_data=telegram_auth.stats() if telegram_auth else None
+    ))
+
+def leaderboard_entry(rank, user):
+    return {
+        'rank': rank,
+        'first_name': user.first_name or user.username or f'User {user.telegram_id}',
+        'coins': user.coins
+    }
+
 @app.route('/api/leaderboard', methods=['GET'])
 def get_leaderboard():
-    """Get leaderboard"""
+    """Get the all-time leaderboard, or earnings in a day/week/24h window"""
     try:
-        session = db.get_session()
-        try:
-            from database import User
-            top_users = session.query(User).order_by(User.coins.desc()).limit(10).all()
-            
-            return jsonify([{
-                'rank': i + 1,
-                'first_name': u.first_name or u.username or f'User {u.telegram_id}',
-                'coins': u.coins
-            } for i, u in enumerate(top_users)])
-        finally:
-            session.close()
+        window = request.args.get('window')
+        if not window or window == 'all':
+            top_users = leaderboard.top(LEADERBOARD_SIZE)
+            return jsonify([leaderboard_entry(i + 1, u) for i, u in enumerate(top_users)])
+        
+        top = leaderboard.window_top(
+            window,
+            metric=request.args.get('metric', 'earned'),
+            limit=LEADERBOARD_SIZE,
+            ago=int(request.args.get('ago', 0))
+        )
+        return jsonify([dict(leaderboard_entry(i + 1, u), coins=amount) for i, (u, amount) in enumerate(top)])
+    except ValueError as e:
+        return jsonify({'error': f'Invalid leaderboard parameters: {e}'}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/leaderboard/rank', methods=['GET'])
+def get_leaderboard_rank():
+    """Get a user's rank and the users ranked around them"""
+    telegram_id = request.args.get('telegram_id')
+    if not telegram_id or telegram_id == 'undefined':
+        return jsonify({'error': 'Invalid telegram_id'}), 400
+    
+    try:
+        telegram_id = int(telegram_id)
+        radius = min(max(int(request.args.get('radius', 2)), 0), MAX_LEADERBOARD_RADIUS)
+    except ValueError:
+        return jsonify({'error': 'Invalid telegram_id or radius'}), 400
+    
+    try:
+        rank, neighbours = leaderboard.around(telegram_id, radius)
+        if rank is None:
+            leaderboard.add_user(db.get_or_create_user(telegram_id))
+            rank, neighbours = leaderboard.around(telegram_id, radius)
+        return jsonify({
+            'rank': rank,
+            'total': len(leaderboard),
+            'neighbours': [leaderboard_entry(r, u) for r, u in neighbours]
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def referral_to_dict(user):
+    return {
+        'referral_code': user.referral_code,
+        'referrals_count': user.direct_referrals or 0,
+        'indirect_referrals_count': user.indirect_referrals or 0,
+        'referral_earnings': user.referral_earnings or 0.0,
+        'bonus_per_referral': REFERRAL_BONUS,
+        'bonus_per_level': list(REFERRAL_BONUSES)
+    }
+
+def transaction_to_dict(transaction):
+    return {
+        'id': transaction.id,
+        'amount': transaction.amount,
+        'type': transaction.transaction_type,
+        'description': transaction.description,
+        'created_at': transaction.created_at.isoformat() if transaction.created_at else None
+    }
+
 @app.route('/api/transactions', methods=['GET'])
 def get_transactions():
     """Get user transactions"""
+    telegram_id = telegram_id_query(request.args.get('telegram_id', ''))
+    if telegram_id is None:
+        return jsonify({'error': 'Invalid telegram_id'}), 400
     try:
-        telegram_id = int(request.args.get('telegram_id'))
         user = db.get_or_create_user(telegram_id=telegram_id)
-        
-        session = db.get_session()
-        try:
-            from database import Transaction
-            transactions = session.query(Transaction).filter_by(
-                user_id=user.id
-            ).order_by(Transaction.created_at.desc()).limit(20).all()
-            
-            return jsonify([{
-                'id': t.id,
-                'amount': t.amount,
-                'type': t.transaction_type,
-                'description': t.description,
-                'created_at': t.created_at.isoformat() if t.created_at else None
-            } for t in transactions])
-        finally:
-            session.close()
+        transactions = db.get_transactions(user.id, 20)
+        return jsonify([transaction_to_dict(t) for t in transactions])
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -393,47 +456,86 @@ def get_referral():
         telegram_id = int(telegram_id)
         user = db.get_or_create_user(telegram_id=telegram_id)
         
-        session = db.get_session()
-        try:
-            from database import User
-            referrals_count = session.query(User).filter_by(referred_by=user.id).count()
-            
-            return jsonify({
-                'referral_code': user.referral_code,
-                'referrals_count': referrals_count,
-                'bonus_per_referral': REFERRAL_BONUS
-            })
-        finally:
-            session.close()
+        return jsonify(referral_to_dict(user))
     except ValueError:
         return jsonify({'error': 'Invalid telegram_id format'}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def parse_client_timestamp(value):
+    """Convert a client epoch timestamp in milliseconds to a UTC datetime"""
+    if value is None:
+        return None
+    return datetime.utcfromtimestamp(int(value) / 1000.0)
+
 @app.route('/api/tap', methods=['POST'])
 def tap_earn():
-    """Handle tap-to-earn"""
+    """Handle a batch of taps buffered by the Mini App
+    
+    Expects the tap count, a client sequence number (unique per user) and the
+    time window the taps were collected in. Retrying a batch with the same
+    sequence number does not credit it twice. Taps beyond the user's
+    current energy are dropped.
+    """
     try:
         data = request.json
         telegram_id = int(data.get('telegram_id'))
-        coins = float(data.get('coins', 1.0))
-        
+        seq = data.get('seq')
+        taps = int(data.get('taps', 1))
+        window_start = parse_client_timestamp(data.get('window_start'))
+        window_end = parse_client_timestamp(data.get('window_end'))
+    except (TypeError, ValueError, OverflowError, OSError):
+        return jsonify({'error': 'Invalid tap batch'}), 400
+    
+    telegram_id = caller_telegram_id(telegram_id)
+    if telegram_id is None:
+        return jsonify({'error': 'Invalid or expired session'}), 401
+    if seq is None or not str(seq).isdigit():
+        return jsonify({'error': 'Missing or invalid seq'}), 400
+    if taps < 1 or taps > MAX_TAPS_PER_BATCH:
+        return jsonify({'error': f'taps must be between 1 and {MAX_TAPS_PER_BATCH}'}), 400
+    if window_start and window_end and window_end < window_start:
+        return jsonify({'error': 'Invalid tap window'}), 400
+    
+    # Clamp the batch to the energy the user actually has
+    granted, energy = energy_engine.consume(telegram_id, taps)
+    if not granted:
+        return jsonify({'error': 'Out of energy', **energy}), 429
+    
+    try:
         user = db.get_or_create_user(telegram_id=telegram_id)
+        coins = granted * TAP_REWARD
         
-        # Add coins from tap
-        new_balance = db.add_coins(
-            user.id,
-            coins,
-            'tap_reward',
-            f'Tap to earn: {coins} coins'
-        )
+        if tap_buffer:
+            duplicate = not tap_buffer.add(user.id, int(seq), granted, coins, window_start, window_end)
+            new_balance = user.coins + tap_buffer.pending_coins(user.id)
+        else:
+            new_balance, duplicate = db.record_tap_batch(
+                user.id,
+                int(seq),
+                granted,
+                coins,
+                window_start,
+                window_end
+            )
+        
+        if duplicate:
+            energy_engine.refund(telegram_id, granted)
+            energy = energy_engine.status(telegram_id)
         
         return jsonify({
             'success': True,
-            'coins_earned': coins,
-            'new_balance': new_balance
+            'seq': int(seq),
+            'duplicate': duplicate,
+            'taps_applied': 0 if duplicate else granted,
+            'coins_earned': 0 if duplicate else coins,
+            'new_balance': new_balance,
+            'energy': energy['energy'],
+            'max_energy': energy['max_energy'],
+            'taps_today': energy['taps_today']
         })
     except Exception as e:
+        energy_engine.refund(telegram_id, granted)
         return jsonify({'error': str(e)}), 500
 
 if __name__ == '__main__':
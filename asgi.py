@@ -0,0 +1,206 @@
+"""ASGI server for the Mini App API, sharing one event loop with the bot.
+
+The read-heavy endpoints are served natively on the event loop through
+AsyncDatabase; every other route falls through to the Flask app in app.py,
+which uvicorn runs in its worker threads. When TELEGRAM_BOT_TOKEN is set the
+bot's Application is started on the same loop, so one process serves both
+the Mini App and the bot. With TELEGRAM_WEBHOOK_URL also set, the bot
+receives updates through a webhook on this server (webhook.py) instead of
+long polling.
+
+Run with:
+    python asgi.py
+"""
+import asyncio
+import json
+import logging
+import os
+from urllib.parse import parse_qs
+
+import uvicorn
+from dotenv import load_dotenv
+from telegram import Update
+from uvicorn.middleware.wsgi import WSGIMiddleware
+
+import app as web
+from async_database import AsyncDatabase
+from user_search import telegram_id_query
+from webhook import WEBHOOK_URL, TelegramWebhook, webhook_secret
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+adb = AsyncDatabase()
+flask_app = WSGIMiddleware(web.app)
+
+ROUTES = {}
+webhook = None  # TelegramWebhook while the bot runs in webhook mode
+
+
+def route(path):
+    """Register a native async handler for GET `path`"""
+    def register(fn):
+        ROUTES[path] = fn
+        return fn
+    return register
+
+
+async def send_json(send, body, status=200):
+    """Send an already encoded JSON body"""
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+            (b'access-control-allow-origin', b'*'),
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def asgi_app(scope, receive, send):
+    if webhook is not None and scope['type'] == 'http' and scope['path'] == webhook.path:
+        await webhook(scope, receive, send)
+        return
+    handler = ROUTES.get(scope.get('path')) if scope['type'] == 'http' and scope['method'] == 'GET' else None
+    if handler is None:
+        await flask_app(scope, receive, send)
+        return
+    args = {k: v[0] for k, v in parse_qs(scope['query_string'].decode()).items()}
+    try:
+        payload, status = await handler(args)
+        # Serialized here, so an unserializable payload is a 500 like any other error
+        body = json.dumps(payload).encode()
+    except Exception:
+        logger.exception('Unhandled error in %s', scope['path'])
+        body, status = json.dumps({'error': 'Internal server error'}).encode(), 500
+    await send_json(send, body, status)
+
+
+@route('/api/leaderboard')
+async def get_leaderboard(args):
+    """Get leaderboard, see app.get_leaderboard"""
+    try:
+        window = args.get('window')
+        if not window or window == 'all':
+            users = web.leaderboard.top(web.LEADERBOARD_SIZE)
+            return [web.leaderboard_entry(i + 1, u) for i, u in enumerate(users)], 200
+        # Bucket sums are a database read, keep them off the loop
+        top = await asyncio.to_thread(
+            web.leaderboard.window_top,
+            window,
+            args.get('metric', 'earned'),
+            web.LEADERBOARD_SIZE,
+            int(args.get('ago', 0))
+        )
+        return [dict(web.leaderboard_entry(i + 1, u), coins=amount) for i, (u, amount) in enumerate(top)], 200
+    except ValueError as e:
+        return {'error': f'Invalid leaderboard parameters: {e}'}, 400
+    except Exception as e:
+        return {'error': str(e)}, 500
+
+
+@route('/api/transactions')
+async def get_transactions(args):
+    """Get user transactions"""
+    telegram_id = telegram_id_query(args.get('telegram_id', ''))
+    if telegram_id is None:
+        return {'error': 'Invalid telegram_id'}, 400
+    try:
+        user = await adb.get_or_create_user(telegram_id)
+        transactions = await adb.get_transactions(user.id, 20)
+        return [web.transaction_to_dict(t) for t in transactions], 200
+    except Exception as e:
+        return {'error': str(e)}, 500
+
+
+@route('/api/referral')
+async def get_referral(args):
+    """Get referral info"""
+    telegram_id = args.get('telegram_id')
+    if not telegram_id or telegram_id == 'undefined':
+        return {'error': 'Invalid telegram_id'}, 400
+    try:
+        user = await adb.get_or_create_user(int(telegram_id))
+        return web.referral_to_dict(user), 200
+    except ValueError:
+        return {'error': 'Invalid telegram_id format'}, 400
+    except Exception as e:
+        return {'error': str(e)}, 500
+
+
+@route('/api/tasks/feed')
+async def get_task_feed(args):
+    """Page through tasks newest first, see app.get_task_feed"""
+    try:
+        limit = min(int(args.get('limit', web.TASK_PAGE_SIZE)), web.MAX_TASK_PAGE_SIZE)
+        if limit < 1:
+            raise ValueError('limit must be positive')
+        tasks, next_cursor = await adb.get_task_feed(
+            cursor=args.get('cursor') or None,
+            limit=limit,
+            status=args.get('status', 'available'),
+            min_reward=float(args['min_reward']) if args.get('min_reward') else None,
+            max_reward=float(args['max_reward']) if args.get('max_reward') else None,
+            creator_id=int(args['creator_id']) if args.get('creator_id') else None
+        )
+        return {'tasks': [web.task_to_dict(t) for t in tasks], 'next_cursor': next_cursor}, 200
+    except ValueError as e:
+        return {'error': f'Invalid feed parameters: {e}'}, 400
+    except Exception as e:
+        return {'error': str(e)}, 500
+
+
+async def serve(host, port):
+    """Run the HTTP server and, if configured, the bot until interrupted"""
+    server = uvicorn.Server(uvicorn.Config(asgi_app, host=host, port=port, lifespan='off'))
+    token = os.getenv('TELEGRAM_BOT_TOKEN')
+    try:
+        if not token:
+            logger.warning('TELEGRAM_BOT_TOKEN not set, serving the Mini App API only')
+            await server.serve()
+            return
+
+        import bot
+        global webhook
+        # The bot shares the web app's user cache, ranking and snapshot file
+        application = bot.build_application(token, database=web.db, leaderboard=web.leaderboard)
+        async with application:
+            await application.start()
+            await bot.start_background_tasks(application)
+            serving = asyncio.create_task(server.serve())
+            try:
+                if WEBHOOK_URL:
+                    # Register once the endpoint is listening, Telegram backs off on failed deliveries
+                    while not server.started and not serving.done():
+                        await asyncio.sleep(0.05)
+                    webhook = TelegramWebhook(application, webhook_secret(token), WEBHOOK_URL)
+                    await webhook.register()
+                    logger.info('Bot started, receiving updates at %s', webhook.path)
+                else:
+                    await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+                    logger.info('Bot started!')
+                await serving
+            finally:
+                webhook = None
+                await bot.stop_background_tasks(application)
+                if application.updater.running:
+                    await application.updater.stop()
+                await application.stop()
+    finally:
+        await adb.close()
+
+
+def main():
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    port = int(os.environ.get('PORT', 5000))
+    asyncio.run(serve('0.0.0.0', port))
+
+
+if __name__ == '__main__':
+    main()
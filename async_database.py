@@ -0,0 +1,78 @@
+"""Asyncio data access for code running on an event loop.
+
+AsyncDatabase mirrors the read paths of Database on SQLAlchemy's asyncio
+extension (aiosqlite for SQLite, asyncpg for PostgreSQL), so queries never
+block the loop they run on. It shares the models, the engine settings and
+the task feed query with Database. Schema creation and migrations stay with
+Database; create one before serving requests.
+"""
+import asyncio
+import os
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from database import (
+    Transaction, User, assign_referral_code, database_url, expand_compacted, new_user, task_feed_page,
+    task_feed_statement
+)
+from db_engine import make_async_engine
+from ledger_archive import LedgerArchive
+
+
+class AsyncDatabase:
+    def __init__(self, db_path=None, profile=None):
+        self.engine = make_async_engine(database_url(db_path), profile=profile)
+        self.Session = async_sessionmaker(self.engine, expire_on_commit=False)
+        self.ledger_archive = LedgerArchive(os.environ.get('LEDGER_ARCHIVE_DIR', 'ledger_archive'))
+
+    async def close(self):
+        await self.engine.dispose()
+
+    async def get_user(self, telegram_id):
+        async with self.Session() as session:
+            result = await session.execute(select(User).where(User.telegram_id == telegram_id))
+            return result.scalars().first()
+
+    async def get_or_create_user(self, telegram_id, username=None, first_name=None):
+        user = await self.get_user(telegram_id)
+        if user:
+            return user
+        async with self.Session() as session:
+            user = new_user(telegram_id, username, first_name)
+            session.add(user)
+            try:
+                await session.flush()
+                assign_referral_code(user)
+                await session.commit()
+            except IntegrityError:
+                # Created concurrently by another request
+                await session.rollback()
+                return await self.get_user(telegram_id)
+            return user
+
+    async def get_leaderboard(self, limit=10):
+        async with self.Session() as session:
+            result = await session.execute(select(User).order_by(User.coins.desc()).limit(limit))
+            return result.scalars().all()
+
+    async def get_transactions(self, user_id, limit=20):
+        async with self.Session() as session:
+            result = await session.execute(
+                select(Transaction)
+                .where(Transaction.user_id == user_id)
+                .order_by(Transaction.created_at.desc(), Transaction.id.desc())
+                .limit(limit)
+            )
+            transactions = result.scalars().all()
+        # Archive segments are read from disk, keep that off the loop
+        return await asyncio.to_thread(expand_compacted, transactions, self.ledger_archive, limit)
+
+    async def get_task_feed(self, cursor=None, limit=20, status='available',
+                            min_reward=None, max_reward=None, creator_id=None):
+        """Async version of Database.get_task_feed"""
+        stmt = task_feed_statement(cursor, limit, status, min_reward, max_reward, creator_id)
+        async with self.Session() as session:
+            result = await session.execute(stmt)
+            return task_feed_page(result.unique().scalars().all(), limit)
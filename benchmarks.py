@@ -0,0 +1,534 @@
+"""Benchmarks for the hot paths of the bot and the Mini App API.
+
+Usage: python benchmarks.py <name> [options]
+
+Every benchmark runs against a throwaway database in a temporary directory.
+"""
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import hmac
+import json
+import multiprocessing
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlencode
+
+from sqlalchemy import event, func, or_
+from sqlalchemy.exc import OperationalError
+from telegram import Bot
+from telegram.ext import Application, CommandHandler
+from telegram.request import HTTPXRequest
+
+from database import COIN_SCALE, Database, Task, Transaction, User
+from fake_telegram import FakeBotApi, serve
+from notifications import NotificationQueue
+from reconcile import Reconciler
+from telegram_auth import TelegramAuth
+from webhook import TelegramWebhook
+
+
+class QueryCounter:
+    """Count SQL statements executed on an engine"""
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+
+def bench_tasks(args):
+    """Query count and latency of the Tasks tab as the number of tasks grows"""
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'))
+        user = db.get_or_create_user(telegram_id=1, first_name='Bench')
+        other = db.get_or_create_user(telegram_id=2, first_name='Other')
+        counter = QueryCounter(db.engine)
+
+        created = 0
+        print(f"{'tasks':>8} {'queries':>8} {'ms':>8}")
+        for size in args.sizes:
+            session = db.get_session()
+            for i in range(created, size):
+                session.add(Task(
+                    title=f'Task {i}',
+                    created_by=other.id if i % 2 else user.id,
+                    # 30 assigned to the user, so the rest of the open list is available tasks
+                    assigned_to=user.id if i < 90 and i % 3 == 0 else None
+                ))
+            session.commit()
+            session.close()
+            created = size
+
+            counter.count = 0
+            start = time.perf_counter()
+            assigned, available, mine = db.get_user_tasks(user.id)
+            for task in assigned + available + mine:
+                (task.creator.first_name, task.assignee.first_name if task.assignee else None)
+            elapsed = (time.perf_counter() - start) * 1000
+            print(f'{size:>8} {counter.count:>8} {elapsed:>8.2f}')
+
+
+def _sqlite_worker(db_path, profile, seed, seconds, write_ratio, user_count):
+    db = Database(db_path, profile=profile)
+    rng = random.Random(seed)
+    reads = writes = errors = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        telegram_id = rng.randint(1, user_count)
+        try:
+            if rng.random() < write_ratio:
+                user = db.get_or_create_user(telegram_id=telegram_id)
+                db.add_coins(user.id, 1.0, 'bench')
+                writes += 1
+            else:
+                db.get_or_create_user(telegram_id=telegram_id)
+                reads += 1
+        except OperationalError:
+            errors += 1
+    db.engine.dispose()
+    return reads, writes, errors
+
+
+def bench_sqlite(args):
+    """Reads and writes per second from concurrent processes, legacy vs tuned SQLite"""
+    print(f"{'profile':>8} {'reads/s':>10} {'writes/s':>10} {'errors':>8}")
+    for profile in args.profiles:
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, 'bench.db')
+            db = Database(db_path, profile=profile)
+            for telegram_id in range(1, args.users + 1):
+                db.get_or_create_user(telegram_id=telegram_id)
+            db.engine.dispose()
+
+            jobs = [(db_path, profile, seed, args.seconds, args.write_ratio, args.users)
+                    for seed in range(args.workers)]
+            with multiprocessing.get_context('fork').Pool(args.workers) as pool:
+                results = pool.starmap(_sqlite_worker, jobs)
+
+            reads, writes, errors = (sum(column) for column in zip(*results))
+            print(f'{profile:>8} {reads / args.seconds:>10.0f} {writes / args.seconds:>10.0f} {errors:>8}')
+
+
+def _credit_worker(db_path, seed, threads, credits, user_count, bulk_every):
+    db = Database(db_path)
+    applied = {}
+    errors = [0]
+    lock = threading.Lock()
+
+    def run(thread_seed):
+        rng = random.Random(thread_seed)
+        mine = {}
+        failed = 0
+        for i in range(credits):
+            try:
+                if bulk_every and i % bulk_every == 0:
+                    batch = [(user_id, 1.0, 'bench', None)
+                             for user_id in rng.sample(range(1, user_count + 1), min(5, user_count))]
+                    db.credit_many(batch)
+                else:
+                    batch = [(rng.randint(1, user_count), 1.0, 'bench', None)]
+                    db.add_coins(*batch[0])
+            except OperationalError:
+                # Timed out waiting for the write lock; rolled back, so not applied
+                failed += 1
+                continue
+            for user_id, amount, _, _ in batch:
+                mine[user_id] = mine.get(user_id, 0.0) + amount
+        with lock:
+            errors[0] += failed
+            for user_id, amount in mine.items():
+                applied[user_id] = applied.get(user_id, 0.0) + amount
+
+    workers = [threading.Thread(target=run, args=(seed * 1000 + t,)) for t in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    db.engine.dispose()
+    return applied, errors[0]
+
+
+def bench_credits(args):
+    """Parallel add_coins/credit_many writers on a few hot users; fails on any lost update"""
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'bench.db')
+        db = Database(db_path)
+        for telegram_id in range(1, args.users + 1):
+            db.get_or_create_user(telegram_id=telegram_id)
+        db.engine.dispose()
+
+        jobs = [(db_path, seed, args.threads, args.credits, args.users, args.bulk_every)
+                for seed in range(args.workers)]
+        start = time.perf_counter()
+        with multiprocessing.get_context('fork').Pool(args.workers) as pool:
+            results = pool.starmap(_credit_worker, jobs)
+        elapsed = time.perf_counter() - start
+
+        expected = {}
+        errors = sum(failed for _, failed in results)
+        for applied, _ in results:
+            for user_id, amount in applied.items():
+                expected[user_id] = expected.get(user_id, 0.0) + amount
+
+        session = db.get_session()
+        balances = dict(session.query(User.id, User.coins).all())
+        ledger = dict(session.query(Transaction.user_id, func.sum(Transaction.amount)).group_by(Transaction.user_id).all())
+        session.close()
+
+        lost = sum(1 for user_id in balances if balances[user_id] != expected.get(user_id, 0.0))
+        unbalanced = sum(1 for user_id in balances if balances[user_id] != ledger.get(user_id, 0.0))
+        total = sum(expected.values())
+        print(f'{args.workers} processes x {args.threads} threads, {total:.0f} coins credited '
+              f'in {elapsed:.2f}s ({total / elapsed:.0f}/s)')
+        print(f'users with lost updates: {lost}, balance != ledger: {unbalanced}, lock timeouts: {errors}')
+        return 1 if lost or unbalanced else 0
+
+
+def _fill_ledger(db, rows, user_count, start_id=0):
+    """Append synthetic ledger rows and the matching balance changes; returns the totals"""
+    rng = random.Random(start_id)
+    totals = {}
+    now = time.strftime('%Y-%m-%d %H:%M:%S')
+    with db.engine.begin() as conn:
+        for offset in range(0, rows, 100000):
+            batch = []
+            for _ in range(min(100000, rows - offset)):
+                user_id = rng.randint(1, user_count)
+                amount = rng.randint(1, 500)  # Minor units
+                totals[user_id] = totals.get(user_id, 0) + amount
+                batch.append((user_id, amount, 'tap_reward', now))
+            conn.exec_driver_sql(
+                'INSERT INTO transactions (user_id, amount, transaction_type, created_at) VALUES (?, ?, ?, ?)', batch
+            )
+        conn.exec_driver_sql('UPDATE users SET coins = coins + ? WHERE id = ?',
+                             [(amount, user_id) for user_id, amount in totals.items()])
+    return totals
+
+
+def bench_reconcile(args):
+    """Full and incremental reconciliation throughput on a synthetic ledger; fails if drift is missed"""
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'))
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql('INSERT INTO users (telegram_id, coins) VALUES (?, 0)',
+                                 [(telegram_id,) for telegram_id in range(1, args.users + 1)])
+        start = time.perf_counter()
+        _fill_ledger(db, args.rows, args.users)
+        print(f'{args.rows} ledger rows for {args.users} users written in {time.perf_counter() - start:.1f}s')
+
+        reconciler = Reconciler(db, settle=0)
+        print(f"{'run':<12} {'rows':>10} {'users':>8} {'drift':>6} {'s':>8} {'rows/s':>10}")
+        missed = 0
+        for name, full, rows, drifted in (('full', True, 0, 0), ('incremental', False, args.increment, args.drift),
+                                          ('idle', False, 0, 0), ('full', True, 0, 0)):
+            if rows:
+                totals = _fill_ledger(db, rows, args.users, start_id=args.rows)
+                with db.engine.begin() as conn:
+                    # Unexplained balance changes the run has to find
+                    conn.exec_driver_sql('UPDATE users SET coins = coins + ? WHERE id = ?',
+                                         [(COIN_SCALE, user_id) for user_id in sorted(totals)[:drifted]])
+            report = reconciler.run(full=full)
+            rate = report['rows'] / report['seconds'] if report['seconds'] else 0
+            print(f"{name:<12} {report['rows']:>10} {report['users']:>8} {len(report['drift']):>6} "
+                  f"{report['seconds']:>8.2f} {rate:>10.0f}")
+            missed += drifted - len(report['drift']) if rows else 0
+        return 1 if missed else 0
+
+
+def _timed(fn, repeat):
+    """Median milliseconds of fn() and its last result"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return sorted(timings)[len(timings) // 2], result
+
+
+def bench_search(args):
+    """User search latency (indexed vs. LIKE '%q%') as the users table grows"""
+    syllables = ['al', 'ex', 'an', 'dr', 'ma', 'ri', 'jo', 'hn', 'ka', 'te', 'li', 'na', 'ser', 'gei', 'vo', 'va']
+    rng = random.Random(1)
+
+    def name():
+        return ''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4)))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'))
+        queries = ['jo', 'alex', 'serg', 'marina', 'kate li', str(args.sizes[-1] // 2)]
+        created = 0
+        print(f"{'users':>9} {'query':>8} {'indexed ms':>11} {'LIKE ms':>9} {'results':>8}")
+        for size in args.sizes:
+            with db.engine.begin() as conn:
+                conn.exec_driver_sql(
+                    'INSERT INTO users (telegram_id, username, first_name, coins) VALUES (?, ?, ?, 0)',
+                    [(i, f'{name()}{i % 100}', name().capitalize()) for i in range(created + 1, size + 1)]
+                )
+            created = size
+            for query in queries:
+                indexed_ms, users = _timed(lambda: db.search_users(query), args.repeat)
+                like_ms, _ = _timed(lambda: _like_search(db, query), args.repeat)
+                print(f'{size:>9} {query:>8} {indexed_ms:>11.2f} {like_ms:>9.2f} {len(users):>8}')
+
+
+def _like_search(db, query):
+    # The unindexed substring search /api/users/search used to run
+    session = db.get_session()
+    try:
+        conditions = [User.username.icontains(query, autoescape=True), User.first_name.icontains(query, autoescape=True)]
+        if query.isdigit():
+            conditions.append(User.telegram_id == int(query))
+        return session.query(User).filter(or_(*conditions)).limit(10).all()
+    finally:
+        session.close()
+
+
+def bench_notifications(args):
+    """Notification bursts sent directly vs. through the queue, against a local fake Bot API; fails if the queue loses any"""
+    return asyncio.run(_bench_notifications(args))
+
+
+async def _bench_notifications(args):
+    rng = random.Random(1)
+    events = [(1000 + rng.randrange(args.chats), f'🔔 Event {i}: your task was completed') for i in range(args.events)]
+    print(f'{args.events} events to {args.chats} chats at {args.rate}/s, {args.latency * 1000:.0f}ms API latency')
+    print(f"{'mode':<8} {'messages':>9} {'429s':>6} {'lost':>6} {'s':>7} {'p50 s':>7} {'p99 s':>7}")
+
+    # Every event sent from its handler, as the bot used to
+    api = FakeBotApi(latency=args.latency)
+    async with api.serve(), _fake_bot(api) as bot:
+        created, tasks = {}, []
+        start = time.monotonic()
+        async for at, first, batch in _arrivals(events, args.rate):
+            for i, (chat_id, text) in enumerate(batch, first):
+                created[i] = at
+                tasks.append(asyncio.create_task(bot.send_message(chat_id=chat_id, text=text)))
+        await asyncio.gather(*tasks, return_exceptions=True)
+        _delivery_report('direct', api, created, time.monotonic() - start)
+
+    # Through the queue, restarted halfway through the burst
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'))
+        api = FakeBotApi(latency=args.latency)
+        async with api.serve(), _fake_bot(api) as bot:
+            queue = NotificationQueue(db, global_rate=args.global_rate)
+            queue.start(bot)
+            created = {}
+            start = time.monotonic()
+            async for at, first, batch in _arrivals(events, args.rate):
+                await queue.notify_many(batch)
+                created.update((i, at) for i in range(first, first + len(batch)))
+                if first <= len(events) // 2 < first + len(batch):
+                    # Only the database carries queued messages over to the new instance
+                    await queue.stop()
+                    queue = NotificationQueue(db, global_rate=args.global_rate)
+                    queue.start(bot)
+            deadline = time.monotonic() + args.timeout
+            while db.due_notifications(limit=1, now=datetime.max) and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+            await queue.stop()
+            lost = _delivery_report('queue', api, created, time.monotonic() - start)
+    return 1 if lost else 0
+
+
+@contextlib.asynccontextmanager
+async def _fake_bot(api):
+    bot = Bot('1:fake', base_url=api.base_url, request=HTTPXRequest(connection_pool_size=256, pool_timeout=60))
+    async with bot:
+        yield bot
+
+
+async def _arrivals(events, rate, tick=0.01):
+    """Yield (time, index of the first, events) batches at `rate` events a second"""
+    start = time.monotonic()
+    sent = 0
+    while sent < len(events):
+        now = time.monotonic()
+        due = min(len(events), int((now - start) * rate) + 1)
+        if due > sent:
+            yield now, sent, events[sent:due]
+            sent = due
+        await asyncio.sleep(tick)
+
+
+def _delivery_report(mode, api, created, seconds):
+    """Print what reached the fake API and return the number of events lost"""
+    delivered = {}
+    for at, _, text in api.messages:
+        for i in re.findall(r'Event (\d+)', text):
+            delivered.setdefault(int(i), at - created[int(i)])
+    delays = sorted(delivered.values()) or [0]
+    lost = len(created) - len(delivered)
+    print(f'{mode:<8} {len(api.messages):>9} {api.rejected:>6} {lost:>6} {seconds:>7.1f} '
+          f'{delays[len(delays) // 2]:>7.2f} {delays[int(len(delays) * 0.99)]:>7.2f}')
+    return lost
+
+
+def bench_updates(args):
+    """Update-to-reply latency with long polling vs. the webhook, against a local fake Bot API"""
+    return asyncio.run(_bench_updates(args))
+
+
+async def _bench_updates(args):
+    print(f'{args.updates} /ping updates from {args.chats} chats at {args.rate}/s, '
+          f'{args.latency * 1000:.0f}ms API latency')
+    print(f"{'mode':<8} {'replies':>8} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    missing = 0
+    for mode in ('polling', 'webhook'):
+        # Flood limits don't matter here, replies are a few per chat
+        api = FakeBotApi(per_chat_rate=1000, per_chat_burst=1000, global_rate=100000, latency=args.latency)
+        async with api.serve():
+            builder = Application.builder().token('1:fake').base_url(api.base_url).concurrent_updates(256)
+            if mode == 'webhook':
+                builder = builder.updater(None)
+            application = builder.build()
+
+            async def ping(update, context):
+                await update.message.reply_text(f'pong {context.args[0]}')
+            application.add_handler(CommandHandler('ping', ping))
+
+            async with application, contextlib.AsyncExitStack() as stack:
+                await application.start()
+                if mode == 'webhook':
+                    endpoint = TelegramWebhook(application, 'bench-secret', 'http://127.0.0.1/telegram/webhook')
+                    port = await stack.enter_async_context(serve(endpoint))
+                    endpoint.url = f'http://127.0.0.1:{port}{endpoint.path}'
+                    await endpoint.register()
+                else:
+                    await application.updater.start_polling(poll_interval=0)
+                missing += await _measure_replies(api, args, mode)
+                if application.updater:
+                    await application.updater.stop()
+                await application.stop()
+    return 1 if missing else 0
+
+
+async def _measure_replies(api, args, mode):
+    """Send /ping updates at args.rate and print how long the replies took"""
+    created = {}
+    start = time.monotonic()
+    for i in range(args.updates):
+        await asyncio.sleep(max(0, start + i / args.rate - time.monotonic()))
+        created[i] = time.monotonic()
+        api.deliver(api.message_update(1000 + i % args.chats, f'/ping {i}'))
+    deadline = time.monotonic() + args.timeout
+    while len(api.messages) < args.updates and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    delays = sorted((at - created[int(text.split()[1])]) * 1000 for at, _, text in api.messages) or [0]
+    print(f'{mode:<8} {len(api.messages):>8} {delays[len(delays) // 2]:>8.1f} {delays[int(len(delays) * 0.9)]:>8.1f} '
+          f'{delays[int(len(delays) * 0.99)]:>8.1f} {delays[-1]:>8.1f}')
+    return args.updates - len(api.messages)
+
+
+def bench_auth(args):
+    """initData verification: keys derived per request vs. TelegramAuth, uncached and cached, and session tokens"""
+    token = '123456:bench-token'
+    auth = TelegramAuth(token, cache_size=args.users)
+    now = int(time.time())
+    init_data = []
+    for i in range(args.users):
+        fields = {
+            'query_id': f'AAH{i:08d}',
+            'user': json.dumps({'id': 1000 + i, 'first_name': f'User {i}', 'username': f'user{i}', 'language_code': 'en'}),
+            'auth_date': str(now),
+        }
+        check = '\n'.join(f'{k}={v}' for k, v in sorted(fields.items()))
+        fields['hash'] = hmac.new(auth.secret_key, check.encode(), hashlib.sha256).hexdigest()
+        init_data.append(urlencode(fields))
+    sessions = [auth.issue_session(1000 + i) for i in range(args.users)]
+
+    def per_request(data):
+        # The same check deriving the key from the bot token every time, without a cache
+        return TelegramAuth(token, cache_size=0).verify(data)
+
+    print(f"{'check':<24} {'us/request':>11}")
+    for name, fn, items, repeat in (('key derived per request', per_request, init_data, args.repeat),
+                                    ('TelegramAuth, uncached', auth.verify, init_data, 1),  # Fills the cache
+                                    ('TelegramAuth, cached', auth.verify, init_data, args.repeat),
+                                    ('session token', auth.session_telegram_id, sessions, args.repeat)):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for item in items:
+                fn(item)
+        elapsed = time.perf_counter() - start
+        print(f'{name:<24} {elapsed / (repeat * len(items)) * 1e6:>11.2f}')
+
+
+BENCHMARKS = {
+    'tasks': bench_tasks,
+    'sqlite': bench_sqlite,
+    'credits': bench_credits,
+    'reconcile': bench_reconcile,
+    'search': bench_search,
+    'notifications': bench_notifications,
+    'updates': bench_updates,
+    'auth': bench_auth,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest='name', required=True)
+
+    tasks = sub.add_parser('tasks', help=bench_tasks.__doc__)
+    tasks.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000, 100000])
+
+    sqlite = sub.add_parser('sqlite', help=bench_sqlite.__doc__)
+    sqlite.add_argument('--profiles', nargs='+', default=['legacy', 'tuned'])
+    sqlite.add_argument('--workers', type=int, default=8)
+    sqlite.add_argument('--seconds', type=float, default=10)
+    sqlite.add_argument('--write-ratio', type=float, default=0.2)
+    sqlite.add_argument('--users', type=int, default=1000)
+
+    credits = sub.add_parser('credits', help=bench_credits.__doc__)
+    credits.add_argument('--workers', type=int, default=4)
+    credits.add_argument('--threads', type=int, default=4)
+    credits.add_argument('--credits', type=int, default=250, help='credits per thread')
+    credits.add_argument('--users', type=int, default=5)
+    credits.add_argument('--bulk-every', type=int, default=10, help='every Nth credit is a 5-user credit_many')
+
+    reconcile = sub.add_parser('reconcile', help=bench_reconcile.__doc__)
+    reconcile.add_argument('--rows', type=int, default=2000000, help='ledger rows before the first run')
+    reconcile.add_argument('--users', type=int, default=50000)
+    reconcile.add_argument('--increment', type=int, default=50000, help='ledger rows added before the incremental run')
+    reconcile.add_argument('--drift', type=int, default=3, help='balances changed without a ledger entry')
+
+    search = sub.add_parser('search', help=bench_search.__doc__)
+    search.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    search.add_argument('--repeat', type=int, default=5)
+
+    notifications = sub.add_parser('notifications', help=bench_notifications.__doc__)
+    notifications.add_argument('--events', type=int, default=2000)
+    notifications.add_argument('--chats', type=int, default=200)
+    notifications.add_argument('--rate', type=float, default=200, help='events per second')
+    notifications.add_argument('--latency', type=float, default=0.05, help='fake API response time in seconds')
+    notifications.add_argument('--global-rate', type=float, default=25, help="queue's overall messages per second")
+    notifications.add_argument('--timeout', type=float, default=120, help='seconds to wait for the queue to drain')
+
+    updates = sub.add_parser('updates', help=bench_updates.__doc__)
+    updates.add_argument('--updates', type=int, default=1000)
+    updates.add_argument('--chats', type=int, default=100)
+    updates.add_argument('--rate', type=float, default=50, help='updates per second')
+    updates.add_argument('--latency', type=float, default=0.05, help='fake API response time in seconds')
+    updates.add_argument('--timeout', type=float, default=30, help='seconds to wait for the last replies')
+
+    auth = sub.add_parser('auth', help=bench_auth.__doc__)
+    auth.add_argument('--users', type=int, default=10000, help='distinct initData strings')
+    auth.add_argument('--repeat', type=int, default=5)
+
+    args = parser.parse_args()
+    return BENCHMARKS[args.name](args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,16 @@
 import os
+import asyncio
+import atexit
 import logging
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
 from dotenv import load_dotenv
-from database import Database
-from datetime import datetime
+from database import EARNING_WINDOWS, REFERRAL_BONUSES, Database, Task
+from db_executor import DatabaseExecutor
+from leaderboard import Leaderboard
+from notifications import NotificationQueue
+import referral_codes
+from rendering import fragments, leaderboard_text, render_task_list, render_transactions
 
 # Load environment variables
 load_dotenv()
@@ -16,13 +22,65 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Initialize database
-db = Database()
+# Handlers reach the database through db_executor so a slow query never
+# blocks the event loop. db, rankings and notifications are set by setup(),
+# which build_application() calls: asgi.py hands in the web app's Database
+# and Leaderboard so one process keeps one user cache and one ranking.
+db = None
+db_executor = DatabaseExecutor(max_workers=int(os.getenv('DB_EXECUTOR_WORKERS', 8)))
+rankings = None
+owns_rankings = False  # Started and stopped by the bot, not by the web app
+# Messages to other users go through a persistent, rate limited queue
+notifications = None
 
 # Constants
-REFERRAL_BONUS = 5.0  # Coins for referring someone
+REFERRAL_BONUS = REFERRAL_BONUSES[0]  # Coins for referring someone
 TASK_CREATION_COST = 2.0  # Coins to create a task
 TASK_COMPLETION_REWARD = 10.0  # Default reward for completing a task
+COMPLETION_ERRORS = {
+    'not_found': "❌ Task not found!",
+    'completed': "❌ This task is already completed!",
+    'not_assigned': "❌ This task is not assigned to you!",
+}
+TASKS_PAGE_SIZE = 10  # Tasks per /available_tasks page
+LEADERBOARD_WINDOW_TITLES = {'day': 'today', 'week': 'this week', '24h': 'last 24 hours'}
+CONCURRENT_UPDATES = int(os.getenv('BOT_CONCURRENT_UPDATES', 32))  # Updates processed at once
+METRICS_INTERVAL = int(os.getenv('BOT_METRICS_INTERVAL', 300))  # Seconds between executor stats, 0 disables
+
+def setup(database=None, leaderboard=None):
+    """Use an existing Database and Leaderboard, creating any not given"""
+    global db, rankings, owns_rankings, notifications
+    db = database if database is not None else Database()
+    owns_rankings = leaderboard is None
+    # An empty Leaderboard is falsy, so test for None
+    rankings = leaderboard if not owns_rankings else Leaderboard(
+        db,
+        snapshot_path=os.getenv('LEADERBOARD_SNAPSHOT_PATH', 'leaderboard_snapshot.json'),
+        refresh_interval=float(os.getenv('LEADERBOARD_REFRESH_SECONDS', 1.0))
+    )
+    notifications = NotificationQueue(db, run=db_executor.run)
+
+async def run_db(fn, *args, **kwargs):
+    """Run a blocking database call on the executor"""
+    return await db_executor.run(fn, *args, **kwargs)
+
+async def reply_chunks(message, chunks, reply_markup=None):
+    """Reply with a message per chunk, the keyboard under the last one"""
+    for i, chunk in enumerate(chunks, 1):
+        await message.reply_text(chunk, reply_markup=reply_markup if i == len(chunks) else None)
+
+def assign_task_to(task_id, telegram_id):
+    """Assign an open task to a user; returns the task, or None if not found"""
+    target_user = db.get_or_create_user(telegram_id=telegram_id)
+    session = db.get_session()
+    try:
+        task = session.get(Task, task_id)
+        if task and not task.completed:
+            task.assigned_to = target_user.id
+            session.commit()
+        return task
+    finally:
+        session.close()
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command"""
@@ -30,7 +88,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     referral_code = context.args[0] if context.args else None
     
     # Get or create user
-    db_user = db.get_or_create_user(
+    db_user = await run_db(
+        db.get_or_create_user,
         telegram_id=user.id,
         username=user.username,
         first_name=user.first_name
@@ -38,22 +97,15 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Handle referral
     if referral_code and not db_user.referred_by:
-        referrer = db.get_user_by_referral_code(referral_code)
-        if referrer and referrer.id != db_user.id:
-            session = db.get_session()
-            try:
-                db_user.referred_by = referrer.id
-                session.add(db_user)
-                session.commit()
-                # Give bonus to referrer
-                db.add_coins(referrer.id, REFERRAL_BONUS, 'referral_bonus', 
-                           f'Referred user {user.first_name}')
-                await context.bot.send_message(
-                    chat_id=referrer.telegram_id,
-                    text=f"🎉 You earned {REFERRAL_BONUS} coins for referring {user.first_name}!"
-                )
-            finally:
-                session.close()
+        bonuses = await run_db(db.attach_referral, db_user.id, referral_code, user.first_name)
+        messages = []
+        for level, _, telegram_id, amount in bonuses:
+            if level == 1:
+                text = f"🎉 You earned {amount} coins for referring {user.first_name}!"
+            else:
+                text = f"🎉 You earned {amount} coins: {user.first_name} joined through your referral network!"
+            messages.append((telegram_id, text))
+        await notifications.notify_many(messages)
     
     # Get web app URL from environment or use default
     web_app_url = os.getenv('WEB_APP_URL', 'http://localhost:5000')
@@ -91,7 +143,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 👥 Social:
 /referral - Get your referral link
-/leaderboard - View top coin earners
+/leaderboard [day|week|24h] - View top coin earners
 
 ❓ Help:
 /help - Show this help message
@@ -101,7 +153,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show user's coin balance"""
     user = update.effective_user
-    db_user = db.get_or_create_user(telegram_id=user.id)
+    db_user = await run_db(db.get_or_create_user, telegram_id=user.id)
     
     text = f"💰 Your Balance: {db_user.coins} coins"
     await update.message.reply_text(text)
@@ -109,7 +161,7 @@ async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def create_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Create a new task"""
     user = update.effective_user
-    db_user = db.get_or_create_user(telegram_id=user.id)
+    db_user = await run_db(db.get_or_create_user, telegram_id=user.id)
     
     if db_user.coins < TASK_CREATION_COST:
         await update.message.reply_text(
@@ -133,49 +185,28 @@ async def create_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
         description = ' '.join(context.args[1:-1]) if len(context.args) > 2 else context.args[1]
         reward = float(context.args[-1]) if len(context.args) > 2 and context.args[-1].replace('.', '').isdigit() else TASK_COMPLETION_REWARD
         
-        session = db.get_session()
-        try:
-            from database import Task
-            task = Task(
-                title=title,
-                description=description,
-                created_by=db_user.id,
-                reward_coins=reward
-            )
-            session.add(task)
-            
-            # Deduct coins
-            db_user.coins -= TASK_CREATION_COST
-            from database import Transaction
-            transaction = Transaction(
-                user_id=db_user.id,
-                amount=-TASK_CREATION_COST,
-                transaction_type='task_creation',
-                description=f'Created task: {title}'
-            )
-            session.add(transaction)
-            
-            session.commit()
-            session.refresh(task)
-            
+        task, coins = await run_db(db.create_task, db_user.id, title, description, reward, cost=TASK_CREATION_COST)
+        if task is None:
             await update.message.reply_text(
-                f"✅ Task created!\n\n"
-                f"📋 Task ID: {task.id}\n"
-                f"📝 Title: {title}\n"
-                f"📄 Description: {description}\n"
-                f"💰 Reward: {reward} coins\n\n"
-                f"Share this task ID with others to assign it!"
+                f"❌ Insufficient coins! You need {TASK_CREATION_COST} coins to create a task.\n"
+                f"Your balance: {coins} coins"
             )
-        finally:
-            session.close()
+            return
+        
+        await update.message.reply_text(
+            f"✅ Task created!\n\n"
+            f"📋 Task ID: {task.id}\n"
+            f"📝 Title: {title}\n"
+            f"📄 Description: {description}\n"
+            f"💰 Reward: {reward} coins\n\n"
+            f"Share this task ID with others to assign it!"
+        )
     except Exception as e:
         logger.error(f"Error creating task: {e}")
         await update.message.reply_text("❌ Error creating task. Please try again.")
 
 async def assign_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Assign a task to a user"""
-    user = update.effective_user
-    
     if not context.args or len(context.args) < 2:
         await update.message.reply_text(
             "📋 To assign a task, use:\n"
@@ -197,35 +228,26 @@ async def assign_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Please specify a user ID or reply to a message.")
             return
         
-        session = db.get_session()
-        try:
-            from database import Task, User
-            task = session.query(Task).filter_by(id=task_id).first()
-            target_user = db.get_or_create_user(telegram_id=target_user_id)
-            
-            if not task:
-                await update.message.reply_text("❌ Task not found!")
-                return
-            
-            if task.completed:
-                await update.message.reply_text("❌ This task is already completed!")
-                return
-            
-            task.assigned_to = target_user.id
-            session.commit()
-            
-            await context.bot.send_message(
-                chat_id=target_user_id,
-                text=f"📋 New Task Assigned!\n\n"
-                     f"📝 Title: {task.title}\n"
-                     f"📄 Description: {task.description}\n"
-                     f"💰 Reward: {task.reward_coins} coins\n\n"
-                     f"Use /complete_task {task.id} to complete it!"
-            )
-            
-            await update.message.reply_text(f"✅ Task {task_id} assigned to user {target_user_id}!")
-        finally:
-            session.close()
+        task = await run_db(assign_task_to, task_id, target_user_id)
+        
+        if not task:
+            await update.message.reply_text("❌ Task not found!")
+            return
+        
+        if task.completed:
+            await update.message.reply_text("❌ This task is already completed!")
+            return
+        
+        await notifications.notify(
+            target_user_id,
+            f"📋 New Task Assigned!\n\n"
+            f"📝 Title: {task.title}\n"
+            f"📄 Description: {task.description}\n"
+            f"💰 Reward: {task.reward_coins} coins\n\n"
+            f"Use /complete_task {task.id} to complete it!"
+        )
+        
+        await update.message.reply_text(f"✅ Task {task_id} assigned to user {target_user_id}!")
     except ValueError:
         await update.message.reply_text("❌ Invalid task ID or user ID!")
     except Exception as e:
@@ -235,59 +257,71 @@ async def assign_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def my_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show user's assigned tasks"""
     user = update.effective_user
-    db_user = db.get_or_create_user(telegram_id=user.id)
+    db_user = await run_db(db.get_or_create_user, telegram_id=user.id)
+    tasks = await run_db(db.get_assigned_tasks, db_user.id)
     
-    session = db.get_session()
-    try:
-        from database import Task
-        tasks = session.query(Task).filter_by(assigned_to=db_user.id, completed=False).all()
-        
-        if not tasks:
-            await update.message.reply_text("📋 You have no assigned tasks.")
-            return
-        
-        text = "📋 Your Tasks:\n\n"
-        for task in tasks:
-            text += f"🆔 Task ID: {task.id}\n"
-            text += f"📝 Title: {task.title}\n"
-            text += f"📄 Description: {task.description}\n"
-            text += f"💰 Reward: {task.reward_coins} coins\n"
-            text += f"📅 Created: {task.created_at.strftime('%Y-%m-%d %H:%M')}\n\n"
-        
-        await update.message.reply_text(text)
-    finally:
-        session.close()
+    if not tasks:
+        await update.message.reply_text("📋 You have no assigned tasks.")
+        return
+    
+    await reply_chunks(update.message, render_task_list("📋 Your Tasks:\n\n", tasks, show_created=True))
+
+def render_available_tasks(tasks, next_cursor):
+    """Build the message chunks and "next page" keyboard for a page of available tasks"""
+    chunks = render_task_list(
+        "📋 Available Tasks:\n\n", tasks,
+        footer="Use /assign_task <task_id> <your_user_id> to assign a task to yourself!"
+    )
+    
+    reply_markup = None
+    if next_cursor:
+        reply_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton("Next page ▶️", callback_data=f"tasks:{next_cursor}")]
+        ])
+    return chunks, reply_markup
 
 async def available_tasks(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show available tasks"""
+    """Show the first page of available tasks"""
     user = update.effective_user
-    db_user = db.get_or_create_user(telegram_id=user.id)
+    await run_db(db.get_or_create_user, telegram_id=user.id)
+    
+    tasks, next_cursor = await run_db(db.get_task_feed, status='available', limit=TASKS_PAGE_SIZE)
+    
+    if not tasks:
+        await update.message.reply_text("📋 No available tasks at the moment.")
+        return
+    
+    chunks, reply_markup = render_available_tasks(tasks, next_cursor)
+    await reply_chunks(update.message, chunks, reply_markup)
+
+async def available_tasks_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle the "next page" button under the available tasks list"""
+    query = update.callback_query
+    cursor = query.data.split(':', 1)[1]
     
-    session = db.get_session()
     try:
-        from database import Task
-        tasks = session.query(Task).filter_by(assigned_to=None, completed=False).all()
-        
-        if not tasks:
-            await update.message.reply_text("📋 No available tasks at the moment.")
-            return
-        
-        text = "📋 Available Tasks:\n\n"
-        for task in tasks:
-            text += f"🆔 Task ID: {task.id}\n"
-            text += f"📝 Title: {task.title}\n"
-            text += f"📄 Description: {task.description}\n"
-            text += f"💰 Reward: {task.reward_coins} coins\n\n"
-        
-        text += "Use /assign_task <task_id> <your_user_id> to assign a task to yourself!"
-        await update.message.reply_text(text)
-    finally:
-        session.close()
+        tasks, next_cursor = await run_db(
+            db.get_task_feed, cursor=cursor, status='available', limit=TASKS_PAGE_SIZE
+        )
+    except ValueError:
+        await query.answer("❌ This page is no longer available.")
+        return
+    
+    await query.answer()
+    if not tasks:
+        await query.edit_message_text("📋 No more available tasks.")
+        return
+    
+    chunks, reply_markup = render_available_tasks(tasks, next_cursor)
+    # The button's message shows the page; overflow, if any, follows it
+    await query.edit_message_text(chunks[0], reply_markup=reply_markup if len(chunks) == 1 else None)
+    if len(chunks) > 1:
+        await reply_chunks(query.message, chunks[1:], reply_markup)
 
 async def complete_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Complete a task"""
     user = update.effective_user
-    db_user = db.get_or_create_user(telegram_id=user.id)
+    db_user = await run_db(db.get_or_create_user, telegram_id=user.id)
     
     if not context.args:
         await update.message.reply_text("❌ Please provide a task ID:\n/complete_task <task_id>")
@@ -295,53 +329,27 @@ async def complete_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         task_id = int(context.args[0])
-        session = db.get_session()
-        try:
-            from database import Task
-            task = session.query(Task).filter_by(id=task_id).first()
-            
-            if not task:
-                await update.message.reply_text("❌ Task not found!")
-                return
-            
-            if task.completed:
-                await update.message.reply_text("❌ This task is already completed!")
-                return
-            
-            if task.assigned_to != db_user.id:
-                await update.message.reply_text("❌ This task is not assigned to you!")
-                return
-            
-            # Mark task as completed
-            task.completed = True
-            task.completed_at = datetime.utcnow()
-            session.commit()
-            
-            # Give reward
-            new_balance = db.add_coins(
-                db_user.id,
-                task.reward_coins,
-                'task_reward',
-                f'Completed task: {task.title}'
-            )
-            
-            await update.message.reply_text(
-                f"✅ Task completed!\n\n"
-                f"💰 You earned {task.reward_coins} coins!\n"
-                f"💵 New balance: {new_balance} coins"
+        error, result = await run_db(db.complete_task, task_id, db_user.id)
+        
+        if error:
+            await update.message.reply_text(COMPLETION_ERRORS[error])
+            return
+        
+        text = (
+            f"✅ Task completed!\n\n"
+            f"💰 You earned {result['reward']} coins!\n"
+            f"💵 New balance: {result['balance']} coins"
+        )
+        if result['level_up']:
+            text += f"\n⭐ Level up! You're now level {result['level']}"
+        await update.message.reply_text(text)
+        
+        # Notify task creator
+        if result['created_by'] != db_user.id:
+            await notifications.notify(
+                result['creator_telegram_id'],
+                f"🎉 Your task '{result['title']}' has been completed by {user.first_name}!"
             )
-            
-            # Notify task creator
-            if task.created_by != db_user.id:
-                from database import User
-                creator = session.query(User).filter_by(id=task.created_by).first()
-                if creator:
-                    await context.bot.send_message(
-                        chat_id=creator.telegram_id,
-                        text=f"🎉 Your task '{task.title}' has been completed by {user.first_name}!"
-                    )
-        finally:
-            session.close()
     except ValueError:
         await update.message.reply_text("❌ Invalid task ID!")
     except Exception as e:
@@ -351,7 +359,7 @@ async def complete_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def referral(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show user's referral link"""
     user = update.effective_user
-    db_user = db.get_or_create_user(telegram_id=user.id)
+    db_user = await run_db(db.get_or_create_user, telegram_id=user.id)
     
     bot_username = context.bot.username
     referral_link = f"https://t.me/{bot_username}?start={db_user.referral_code}"
@@ -362,67 +370,90 @@ async def referral(update: Update, context: ContextTypes.DEFAULT_TYPE):
 {referral_link}
 
 👥 Share this link with friends!
-💰 You'll earn {REFERRAL_BONUS} coins when someone joins using your link!
+💰 You'll earn {REFERRAL_BONUS} coins when someone joins using your link,
+and {REFERRAL_BONUSES[1]} coins when they invite someone ({REFERRAL_BONUSES[2]} one level further)!
+
+📊 Referrals: {db_user.direct_referrals or 0} (+{db_user.indirect_referrals or 0} through them)
+💵 Earned from referrals: {db_user.referral_earnings or 0} coins
     """
     
     await update.message.reply_text(text)
 
 async def leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show leaderboard"""
-    session = db.get_session()
-    try:
-        from database import User
-        top_users = session.query(User).order_by(User.coins.desc()).limit(10).all()
-        
-        if not top_users:
+    """Show the all-time leaderboard, or /leaderboard day|week|24h"""
+    window = context.args[0].lower() if context.args else 'all'
+    if window not in ('all',) + EARNING_WINDOWS:
+        await update.message.reply_text("❌ Usage: /leaderboard [day|week|24h]")
+        return
+    
+    if window == 'all':
+        if not len(rankings):
             await update.message.reply_text("📊 No users yet!")
             return
-        
-        text = "🏆 Top Coin Earners:\n\n"
-        for i, user in enumerate(top_users, 1):
-            medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
-            name = user.first_name or user.username or f"User {user.telegram_id}"
-            text += f"{medal} {name}: {user.coins} coins\n"
-        
-        await update.message.reply_text(text)
-    finally:
-        session.close()
+        # Only the shown rows count, balance changes below them keep the text cached
+        title = "🏆 Top Coin Earners:"
+        top = [(user, user.coins) for user in rankings.top(10)]
+    else:
+        top = await run_db(rankings.window_top, window)
+        if not top:
+            await update.message.reply_text("📊 No earnings yet in this window!")
+            return
+        title = f"🏆 Top Earners ({LEADERBOARD_WINDOW_TITLES[window]}):"
+    version = tuple((user.id, user.first_name, user.username, coins) for user, coins in top)
+    text = fragments.get(('leaderboard', window), version, lambda: leaderboard_text(title, top))
+    
+    if window == 'all':
+        rank, db_user = rankings.rank(update.effective_user.id)
+        if rank:
+            text += f"\n📍 Your rank: #{rank} of {len(rankings)} ({db_user.coins} coins)"
+    
+    await update.message.reply_text(text)
 
 async def transactions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show user's transaction history"""
     user = update.effective_user
-    db_user = db.get_or_create_user(telegram_id=user.id)
+    db_user = await run_db(db.get_or_create_user, telegram_id=user.id)
+    transactions = await run_db(db.get_transactions, db_user.id, 10)
     
-    session = db.get_session()
-    try:
-        from database import Transaction
-        transactions = session.query(Transaction).filter_by(user_id=db_user.id).order_by(Transaction.created_at.desc()).limit(10).all()
-        
-        if not transactions:
-            await update.message.reply_text("📊 No transactions yet!")
-            return
-        
-        text = "📊 Recent Transactions:\n\n"
-        for txn in transactions:
-            sign = "+" if txn.amount > 0 else ""
-            text += f"{sign}{txn.amount} coins - {txn.transaction_type}\n"
-            if txn.description:
-                text += f"   {txn.description}\n"
-            text += f"   {txn.created_at.strftime('%Y-%m-%d %H:%M')}\n\n"
-        
-        await update.message.reply_text(text)
-    finally:
-        session.close()
-
-def main():
-    """Start the bot"""
-    token = os.getenv('TELEGRAM_BOT_TOKEN')
-    if not token:
-        logger.error("TELEGRAM_BOT_TOKEN not found in environment variables!")
+    if not transactions:
+        await update.message.reply_text("📊 No transactions yet!")
         return
     
-    # Create application
-    application = Application.builder().token(token).build()
+    await reply_chunks(update.message, render_transactions(transactions))
+
+async def log_executor_metrics():
+    """Periodically log database executor queue depth, wait times and cache hit ratio"""
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL)
+        logger.info("DB executor: %s", db_executor.metrics(reset=True))
+        logger.info("User cache: %s", db.user_cache.stats())
+        logger.info("Render cache: %d hits, %d misses", fragments.hits, fragments.misses)
+        logger.info("Notifications: %s", notifications.stats())
+
+async def start_background_tasks(application):
+    """Start the bot's background jobs; called once the Application is running"""
+    if owns_rankings:
+        await run_db(rankings.start)
+        atexit.register(rankings.stop)
+    notifications.start(application.bot)
+    if METRICS_INTERVAL > 0:
+        application.create_task(log_executor_metrics())
+
+async def stop_background_tasks(application):
+    """Stop the bot's background jobs; queued notifications are sent after the next start"""
+    await notifications.stop()
+
+def build_application(token, database=None, leaderboard=None):
+    """Create the bot Application with all handlers registered, see setup()"""
+    setup(database, leaderboard)
+    application = (
+        Application.builder()
+        .token(token)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(start_background_tasks)
+        .post_stop(stop_background_tasks)
+        .build()
+    )
     
     # Add handlers
     application.add_handler(CommandHandler("start", start))
@@ -432,10 +463,27 @@ def main():
     application.add_handler(CommandHandler("assign_task", assign_task))
     application.add_handler(CommandHandler("my_tasks", my_tasks))
     application.add_handler(CommandHandler("available_tasks", available_tasks))
+    application.add_handler(CallbackQueryHandler(available_tasks_page, pattern=r"^tasks:"))
     application.add_handler(CommandHandler("complete_task", complete_task))
     application.add_handler(CommandHandler("referral", referral))
     application.add_handler(CommandHandler("leaderboard", leaderboard))
     application.add_handler(CommandHandler("transactions", transactions))
+    return application
+
+def main():
+    """Start the bot"""
+    token = os.getenv('TELEGRAM_BOT_TOKEN')
+    if not token:
+        logger.error("TELEGRAM_BOT_TOKEN not found in environment variables!")
+        return
+    if os.getenv('TELEGRAM_WEBHOOK_URL'):
+        # Polling would remove the webhook
+        logger.error("TELEGRAM_WEBHOOK_URL is set: run python asgi.py, which receives the webhook")
+        return
+    referral_codes.require_secret()
+    
+    # Create application
+    application = build_application(token)
     
     # Start bot
     logger.info("Bot started!")
@@ -443,4 +491,3 @@ def main():
 
 if __name__ == '__main__':
     main()
-
@@ -1,26 +1,75 @@
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, ForeignKey, Float
+from sqlalchemy import event, select, insert, update, case, func, literal, true, tuple_, or_, and_, Column, Integer, BigInteger, String, Boolean, DateTime, ForeignKey, Float, UniqueConstraint, Index, TypeDecorator
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
-from datetime import datetime
+from sqlalchemy.orm import sessionmaker, relationship, joinedload, make_transient_to_detached
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import itertools
+import logging
 import os
+import threading
+
+import referral_codes
+from db_engine import make_engine
+from ledger_archive import LedgerArchive
+from migrations import upgrade
+from referral_codes import ReferralCodes
+from user_cache import UserCache
+from user_search import create_search_index, search_user_ids, telegram_id_query
+
+logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
+COIN_SCALE = 100  # Coin amounts are stored as integer hundredths
+BALANCE_STAMPS_KEPT = 10000  # Users whose latest balance notification is remembered
+_balance_stamps = itertools.count(1)
+
+class Coins(TypeDecorator):
+    """A coin amount, stored exactly as integer minor units (BIGINT).
+    
+    Python code and the API keep working in coins; sums and comparisons in
+    SQL run on integers, so ledger totals never drift.
+    """
+    impl = BigInteger
+    cache_ok = True
+    
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return round(value * COIN_SCALE)
+    
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        # A SUM over the column comes back from PostgreSQL as NUMERIC
+        return int(value) / COIN_SCALE
+
 class User(Base):
     __tablename__ = 'users'
+    __table_args__ = (
+        Index('ix_users_referred_by', 'referred_by'),
+        Index('ix_users_coins', 'coins'),
+    )
     
     id = Column(Integer, primary_key=True)
-    telegram_id = Column(Integer, unique=True, nullable=False)
+    telegram_id = Column(BigInteger, unique=True, nullable=False)  # Telegram ids exceed 32 bits
     username = Column(String)
     first_name = Column(String)
-    coins = Column(Float, default=0.0)
+    coins = Column(Coins, default=0)
     referral_code = Column(String, unique=True)
     referred_by = Column(Integer, ForeignKey('users.id'), nullable=True)
     is_admin = Column(Boolean, default=False)
     level = Column(Integer, default=1)
-    total_earned = Column(Float, default=0.0)
+    total_earned = Column(Coins, default=0)
     tasks_completed = Column(Integer, default=0)
     created_at = Column(DateTime, default=datetime.utcnow)
+    # Referral graph, maintained by Database.attach_referral
+    referral_path = Column(String, default='')  # Referrer ids, nearest first, at most REFERRAL_DEPTH
+    direct_referrals = Column(Integer, default=0)
+    indirect_referrals = Column(Integer, default=0)  # Referred by referrals, down to REFERRAL_DEPTH levels
+    referral_earnings = Column(Coins, default=0)
     
     # Relationships
     assigned_tasks = relationship('Task', foreign_keys='Task.assigned_to', back_populates='assignee')
@@ -28,15 +77,22 @@ class User(Base):
     referrals = relationship('User', remote_side=[id], backref='referrer')
     transactions = relationship('Transaction', back_populates='user')
 
+# New databases get the search index with the table, existing ones from migration 6
+event.listen(User.__table__, 'after_create', lambda target, conn, **kw: create_search_index(conn))
+
 class Task(Base):
     __tablename__ = 'tasks'
+    __table_args__ = (
+        Index('ix_tasks_assigned_to_completed_created_at', 'assigned_to', 'completed', 'created_at', 'id'),
+        Index('ix_tasks_created_by_created_at', 'created_by', 'created_at'),
+    )
     
     id = Column(Integer, primary_key=True)
     title = Column(String, nullable=False)
     description = Column(String)
     created_by = Column(Integer, ForeignKey('users.id'), nullable=False)
     assigned_to = Column(Integer, ForeignKey('users.id'), nullable=True)
-    reward_coins = Column(Float, default=10.0)
+    reward_coins = Column(Coins, default=10)
     completed = Column(Boolean, default=False)
     completed_at = Column(DateTime, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -47,10 +103,13 @@ class Task(Base):
 
 class Transaction(Base):
     __tablename__ = 'transactions'
+    __table_args__ = (
+        Index('ix_transactions_user_id_created_at', 'user_id', 'created_at'),
+    )
     
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
-    amount = Column(Float, nullable=False)
+    amount = Column(Coins, nullable=False)
     transaction_type = Column(String, nullable=False)  # 'task_reward', 'referral_bonus', 'task_creation'
     description = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -58,66 +117,1024 @@ class Transaction(Base):
     # Relationships
     user = relationship('User', back_populates='transactions')
 
+class TapBatch(Base):
+    __tablename__ = 'tap_batches'
+    __table_args__ = (
+        UniqueConstraint('user_id', 'seq', name='uq_tap_batches_user_seq'),
+    )
+    
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    seq = Column(BigInteger, nullable=False)  # Client sequence number, unique per user
+    taps = Column(Integer, nullable=False)
+    amount = Column(Coins, nullable=False)
+    window_start = Column(DateTime, nullable=True)
+    window_end = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class EarningBucket(Base):
+    """Coins earned per user per hour and per day, kept in step with the ledger"""
+    __tablename__ = 'earning_buckets'
+    
+    granularity = Column(String, primary_key=True)  # 'hour' or 'day'
+    bucket_start = Column(DateTime, primary_key=True)  # UTC start of the hour/day
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    earned = Column(Coins, nullable=False, default=0)  # All credits
+    tap_earned = Column(Coins, nullable=False, default=0)  # tap_reward credits only
+
+class EnergyCheckpoint(Base):
+    __tablename__ = 'energy_states'
+    
+    telegram_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    energy = Column(Float, nullable=False)
+    updated_at = Column(DateTime, nullable=False)  # Time the energy value was computed at
+    taps_today = Column(Integer, default=0)
+    taps_day = Column(String)  # UTC date taps_today belongs to, YYYY-MM-DD
+
+class BalanceCheckpoint(Base):
+    """A user's ledger position and balance as last verified by reconcile.py"""
+    __tablename__ = 'balance_checkpoints'
+    
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True, autoincrement=False)
+    last_txn_id = Column(Integer, nullable=False)  # Highest ledger id included in balance
+    balance = Column(Coins, nullable=False)  # Ledger sum up to last_txn_id
+    verified_at = Column(DateTime, nullable=False)
+
+class LedgerWatermark(Base):
+    """Highest ledger id a background job has fully processed"""
+    __tablename__ = 'ledger_watermarks'
+    
+    name = Column(String, primary_key=True)
+    txn_id = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+class OutboundNotification(Base):
+    """A bot message waiting to be sent by notifications.py"""
+    __tablename__ = 'outbound_notifications'
+    __table_args__ = (
+        Index('ix_outbound_notifications_next_attempt_at', 'next_attempt_at', 'id'),
+    )
+    
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(BigInteger, nullable=False)
+    text = Column(String, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    attempts = Column(Integer, nullable=False, default=0)  # Failed sends so far
+    next_attempt_at = Column(DateTime, nullable=False)
+
+EPOCH = datetime(1970, 1, 1)
+
+EARNING_WINDOWS = ('day', 'week', '24h')
+EARNING_METRICS = {'earned': EarningBucket.earned, 'taps': EarningBucket.tap_earned}
+HOURLY_BUCKET_RETENTION = timedelta(hours=48)  # Covers the current and previous 24h window
+DAILY_BUCKET_RETENTION = timedelta(days=35)  # Covers the current and previous weeks
+# Largest `ago` whose window still lies within the retained buckets
+EARNING_WINDOW_MAX_AGO = {
+    'day': DAILY_BUCKET_RETENTION.days - 1,
+    'week': (DAILY_BUCKET_RETENTION.days - 7) // 7,  # The current week started up to 6 days ago
+    '24h': HOURLY_BUCKET_RETENTION // timedelta(hours=24) - 1,
+}
+
+def earning_window(window, now=None, ago=0):
+    """(granularity, first_bucket, last_bucket) for a window, `ago` windows back"""
+    if window not in EARNING_WINDOW_MAX_AGO:
+        raise ValueError(f'Unknown window: {window}')
+    if not 0 <= ago <= EARNING_WINDOW_MAX_AGO[window]:
+        raise ValueError(f'ago must be between 0 and {EARNING_WINDOW_MAX_AGO[window]} for window {window}')
+    now = now or datetime.utcnow()
+    hour = now.replace(minute=0, second=0, microsecond=0)
+    day = hour.replace(hour=0)
+    if window == 'day':
+        start = day - timedelta(days=ago)
+        return 'day', start, start
+    if window == 'week':
+        start = day - timedelta(days=day.weekday(), weeks=ago)
+        return 'day', start, start + timedelta(days=6)
+    if window == '24h':
+        end = hour - timedelta(hours=24 * ago)
+        return 'hour', end - timedelta(hours=23), end
+    raise ValueError(f'Unknown window: {window}')
+
+ADJUSTMENT_TYPE = 'reconcile_adjustment'  # Written by reconcile.py --repair, never earned
+
+def record_earnings(session, entries, now=None):
+    """Add ledger entries to the hourly and daily earning buckets.
+    
+    entries are (user_id, amount, transaction_type); only credits count,
+    and not reconciliation adjustments. Call in the session that writes the
+    ledger entries.
+    """
+    totals = {}
+    for user_id, amount, transaction_type in entries:
+        if amount <= 0 or transaction_type == ADJUSTMENT_TYPE:
+            continue
+        earned, tap_earned = totals.get(user_id, (0.0, 0.0))
+        if transaction_type == 'tap_reward':
+            tap_earned += amount
+        totals[user_id] = (earned + amount, tap_earned)
+    if not totals:
+        return
+    
+    now = now or datetime.utcnow()
+    hour = now.replace(minute=0, second=0, microsecond=0)
+    rows = [
+        {'granularity': granularity, 'bucket_start': start, 'user_id': user_id,
+         'earned': earned, 'tap_earned': tap_earned}
+        for granularity, start in (('hour', hour), ('day', hour.replace(hour=0)))
+        for user_id, (earned, tap_earned) in sorted(totals.items())
+    ]
+    upsert(session, EarningBucket, rows, ['granularity', 'bucket_start', 'user_id'],
+           increment=('earned', 'tap_earned'))
+
+TASK_FEED_STATUSES = ('available', 'assigned', 'completed', 'open', 'all')
+
+def encode_task_cursor(task):
+    """Compact keyset cursor for a task: created_at in microseconds and id, hex"""
+    micros = (task.created_at - EPOCH) // timedelta(microseconds=1)
+    return f'{micros:x}.{task.id:x}'
+
+def decode_task_cursor(cursor):
+    """Inverse of encode_task_cursor; raises ValueError on malformed input"""
+    micros, task_id = cursor.split('.')
+    return EPOCH + timedelta(microseconds=int(micros, 16)), int(task_id, 16)
+
+def task_feed_statement(cursor=None, limit=20, status='available',
+                        min_reward=None, max_reward=None, creator_id=None):
+    """SELECT for one task feed page plus one extra row to detect the next page"""
+    if status not in TASK_FEED_STATUSES:
+        raise ValueError(f'Unknown task status: {status}')
+    
+    stmt = select(Task).options(joinedload(Task.creator), joinedload(Task.assignee))
+    if status == 'available':
+        stmt = stmt.where(Task.assigned_to == None, Task.completed == False)
+    elif status == 'assigned':
+        stmt = stmt.where(Task.assigned_to != None, Task.completed == False)
+    elif status == 'completed':
+        stmt = stmt.where(Task.completed == True)
+    elif status == 'open':
+        stmt = stmt.where(Task.completed == False)
+    if min_reward is not None:
+        stmt = stmt.where(Task.reward_coins >= min_reward)
+    if max_reward is not None:
+        stmt = stmt.where(Task.reward_coins <= max_reward)
+    if creator_id is not None:
+        stmt = stmt.where(Task.created_by == creator_id)
+    if cursor:
+        created_at, task_id = decode_task_cursor(cursor)
+        stmt = stmt.where(or_(
+            Task.created_at < created_at,
+            and_(Task.created_at == created_at, Task.id < task_id)
+        ))
+    return stmt.order_by(Task.created_at.desc(), Task.id.desc()).limit(limit + 1)
+
+def task_feed_page(tasks, limit):
+    """Split the rows of task_feed_statement into (page, next_cursor)"""
+    next_cursor = encode_task_cursor(tasks[limit - 1]) if len(tasks) > limit else None
+    return tasks[:limit], next_cursor
+
+def database_url(db_path=None):
+    """SQLAlchemy URL for a SQLite file path or URL, DATABASE_URL or bot.db"""
+    url = db_path or os.environ.get('DATABASE_URL') or 'bot.db'
+    if '://' not in url:
+        url = f'sqlite:///{url}'
+    return url
+
+def new_user(telegram_id, username=None, first_name=None):
+    """A new, not yet persisted User; see assign_referral_code"""
+    return User(
+        telegram_id=telegram_id,
+        username=username,
+        first_name=first_name
+    )
+
+def assign_referral_code(user):
+    """Give a flushed new user the referral code derived from its id"""
+    user.referral_code = referral_codes.encode(user.id)
+
+def upsert(session, model, rows, index_elements, increment=()):
+    """INSERT ... ON CONFLICT DO UPDATE for SQLite and PostgreSQL.
+    
+    Columns in `increment` are added to the existing row instead of replacing it.
+    """
+    dialect = session.get_bind().dialect.name
+    insert_fn = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+    table = model.__table__
+    stmt = insert_fn(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={c.name: table.c[c.name] + stmt.excluded[c.name] if c.name in increment else stmt.excluded[c.name]
+              for c in table.columns if c.name not in index_elements}
+    )
+    session.execute(stmt, rows)
+
+REFERRAL_BONUSES = (5.0, 2.0, 1.0)  # Paid to the referrer, their referrer and so on
+REFERRAL_DEPTH = len(REFERRAL_BONUSES)
+
+def referral_ancestors(path):
+    """User ids in a referral_path, nearest referrer first"""
+    return [int(user_id) for user_id in path.split(',')] if path else []
+
+LEDGER_SUMMARY_TYPE = 'tap_reward_summary'  # One compacted user-day of tap_reward rows
+
+def expand_compacted(transactions, archive, limit):
+    """Replace summary rows in a newest-first ledger page with their archived rows"""
+    if not any(t.transaction_type == LEDGER_SUMMARY_TYPE for t in transactions):
+        return transactions
+    rows = []
+    expanded = set()  # A day compacted twice has two summaries over one segment
+    for transaction in transactions:
+        archived = []
+        if transaction.transaction_type == LEDGER_SUMMARY_TYPE:
+            archived = [row for row in archive.read(transaction.user_id, transaction.created_at.date())
+                        if row['id'] <= transaction.id]
+        if archived:
+            rows.extend(Transaction(**row) for row in archived if row['id'] not in expanded)
+            expanded.update(row['id'] for row in archived)
+        else:
+            rows.append(transaction)
+    if len(transactions) == limit:
+        # Archived rows older than the last live row may be preceded by live rows not fetched
+        oldest = transactions[-1].created_at
+        rows = [row for row in rows if row.created_at >= oldest]
+    rows.sort(key=lambda row: (row.created_at, row.id), reverse=True)
+    return rows[:limit]
+
+def increment_balances(session, amounts):
+    """Atomically add {user_id: amount} to balances; returns {user_id: new_balance}.
+    
+    One UPDATE ... RETURNING per 500 users, so concurrent writers never
+    overwrite each other's changes. Unknown users are missing from the result.
+    PostgreSQL locks the rows of an UPDATE in whatever order it scans them,
+    so they are locked in id order first to keep concurrent multi-user
+    credits from deadlocking.
+    """
+    users = User.__table__
+    balances = {}
+    items = sorted(amounts.items())
+    lock = session.get_bind().dialect.name == 'postgresql'
+    for i in range(0, len(items), 500):
+        chunk = dict(items[i:i + 500])
+        if lock and len(chunk) > 1:
+            session.execute(select(users.c.id).where(users.c.id.in_(list(chunk))).order_by(users.c.id).with_for_update())
+        if len(chunk) == 1:
+            delta = literal(next(iter(chunk.values())), Coins)
+        else:
+            delta = case({user_id: literal(amount, Coins) for user_id, amount in chunk.items()}, value=users.c.id)
+        rows = session.execute(
+            update(users)
+            .where(users.c.id.in_(list(chunk)))
+            .values(coins=users.c.coins + delta)
+            .returning(users.c.id, users.c.coins)
+        ).all()
+        balances.update(rows)
+    return balances
+
+def write_ledger(session, entries):
+    """Insert (user_id, amount, transaction_type, description) ledger entries.
+    
+    Every balance change goes through here, which keeps the earning buckets
+    in the same transaction as the ledger. Returns the stamp to pass to
+    Database.balance_changed: it is taken while the updated users are still
+    locked, so stamps of changes to a user increase in commit order.
+    """
+    stamp = next(_balance_stamps)
+    if not entries:
+        return stamp
+    session.execute(insert(Transaction), [
+        {'user_id': user_id, 'amount': amount, 'transaction_type': transaction_type, 'description': description}
+        for user_id, amount, transaction_type, description in entries
+    ])
+    record_earnings(session, [(user_id, amount, transaction_type) for user_id, amount, transaction_type, _ in entries])
+    return stamp
+
 class Database:
-    def __init__(self, db_path='bot.db'):
-        self.engine = create_engine(f'sqlite:///{db_path}', echo=False)
-        Base.metadata.create_all(self.engine)
-        self.Session = sessionmaker(bind=self.engine)
+    def __init__(self, db_path=None, profile=None):
+        """Open a SQLite file path or any SQLAlchemy URL.
+        
+        Defaults to DATABASE_URL from the environment, then sqlite:///bot.db.
+        """
+        self.engine = make_engine(database_url(db_path), profile=profile)
+        upgrade(self.engine, Base.metadata)
+        # Objects are handed out after their session closes, keep loaded state
+        self.Session = sessionmaker(bind=self.engine, expire_on_commit=False)
+        # Called with {user_id: coins} after a balance change commits
+        self.balance_listeners = [self._update_cached_balances]
+        self._notified_stamps = OrderedDict()  # user_id -> stamp of the last balance notified
+        self._notify_lock = threading.Lock()
+        self.user_cache = UserCache(
+            max_size=int(os.environ.get('USER_CACHE_SIZE', 10000)),
+            ttl=float(os.environ.get('USER_CACHE_TTL', 30))
+        )
+        self.ledger_archive = LedgerArchive(os.environ.get('LEDGER_ARCHIVE_DIR', 'ledger_archive'))
+        self.referral_codes = ReferralCodes(
+            self._legacy_referral_code_owner,
+            max_size=int(os.environ.get('REFERRAL_CODE_CACHE_SIZE', 100000))
+        )
     
     def get_session(self):
         return self.Session()
     
+    def balance_changed(self, balances, stamp):
+        """Notify balance listeners of committed balances.
+        
+        `stamp` comes from the write_ledger call of the change. Writers to
+        the same user can get here out of commit order; a balance older than
+        one already notified is dropped so listeners never go back to it.
+        """
+        with self._notify_lock:
+            newer = {}
+            for user_id, coins in balances.items():
+                if self._notified_stamps.get(user_id, 0) < stamp:
+                    newer[user_id] = coins
+                    self._notified_stamps[user_id] = stamp
+                    self._notified_stamps.move_to_end(user_id)
+            while len(self._notified_stamps) > BALANCE_STAMPS_KEPT:
+                self._notified_stamps.popitem(last=False)
+            if not newer:
+                return
+            for listener in self.balance_listeners:
+                try:
+                    listener(newer)
+                except Exception:
+                    logger.exception('Balance listener failed')
+    
     def get_or_create_user(self, telegram_id, username=None, first_name=None):
+        user = self._cached_user(telegram_id)
+        if user and (not username or user.username == username) and (not first_name or user.first_name == first_name):
+            return user
+        
         session = self.get_session()
         try:
             user = session.query(User).filter_by(telegram_id=telegram_id).first()
             if not user:
-                import secrets
-                referral_code = secrets.token_urlsafe(8)
-                user = User(
-                    telegram_id=telegram_id,
-                    username=username,
-                    first_name=first_name,
-                    referral_code=referral_code
-                )
+                user = new_user(telegram_id, username, first_name)
                 session.add(user)
+                session.flush()
+                assign_referral_code(user)
                 session.commit()
                 session.refresh(user)
             else:
                 # Update username if changed
+                changed = False
                 if username and user.username != username:
                     user.username = username
+                    changed = True
                 if first_name and user.first_name != first_name:
                     user.first_name = first_name
-                session.commit()
+                    changed = True
+                if changed:
+                    session.commit()
+            self.user_cache.put({c.key: getattr(user, c.key) for c in User.__table__.columns})
             return user
         finally:
             session.close()
     
+    def invalidate_user(self, user_id):
+        """Drop a user from the cache after changing it outside Database"""
+        self.user_cache.invalidate(user_id)
+    
+    def _cached_user(self, telegram_id):
+        values = self.user_cache.get(telegram_id)
+        if values is None:
+            return None
+        # A detached copy per caller, so changes to it never leak into the cache
+        user = User(**values)
+        make_transient_to_detached(user)
+        return user
+    
+    def _update_cached_balances(self, balances):
+        for user_id, coins in balances.items():
+            self.user_cache.update(user_id, coins=coins)
+    
     def get_user_by_referral_code(self, referral_code):
+        user_id = self.referral_codes.resolve(referral_code)
+        return self.get_user(user_id) if user_id is not None else None
+    
+    def search_users(self, query, limit=10):
+        """Users matching a name prefix or an exact telegram_id, best match first"""
+        session = self.get_session()
+        try:
+            ids = []
+            telegram_id = telegram_id_query(query)
+            if telegram_id is not None:
+                ids = [row.id for row in session.query(User.id).filter_by(telegram_id=telegram_id)]
+            ids += [user_id for user_id in search_user_ids(session.connection(), query, limit) if user_id not in ids]
+            ids = ids[:limit]
+            users = {user.id: user for user in session.query(User).filter(User.id.in_(ids))}
+            return [users[user_id] for user_id in ids if user_id in users]
+        finally:
+            session.close()
+    
+    def _legacy_referral_code_owner(self, referral_code):
+        with self.engine.connect() as conn:
+            return conn.execute(select(User.id).where(User.referral_code == referral_code)).scalar()
+    
+    def get_user(self, user_id):
         session = self.get_session()
         try:
-            return session.query(User).filter_by(referral_code=referral_code).first()
+            return session.get(User, user_id)
         finally:
             session.close()
     
+    def attach_referral(self, user_id, referral_code, name=None):
+        """Record who referred a user and pay bonuses up REFERRAL_DEPTH levels.
+        
+        The user's path is their referrer's path with the referrer in
+        front, so the ancestors to pay are known without walking the graph:
+        one UPDATE credits all of them and bumps their referral counts, in
+        the same transaction as the ledger entries. Only users who are not
+        referred yet and have no referrals of their own can be attached,
+        which keeps every path complete and the graph acyclic.
+        
+        Returns [(level, user_id, telegram_id, amount)] for the bonuses
+        paid, empty if the code is unknown or the user can't be attached.
+        """
+        referrer_id = self.referral_codes.resolve(referral_code)
+        if referrer_id is None or referrer_id == user_id:
+            return []
+        users = User.__table__
+        session = self.get_session()
+        try:
+            referrer = session.execute(
+                select(users.c.id, users.c.referral_path).where(users.c.id == referrer_id)
+            ).first()
+            if referrer is None:
+                return []
+            ancestors = ([referrer.id] + referral_ancestors(referrer.referral_path))[:REFERRAL_DEPTH]
+            attached = session.execute(
+                update(users)
+                .where(users.c.id == user_id, users.c.referred_by.is_(None),
+                       func.coalesce(users.c.direct_referrals, 0) == 0)
+                .values(referred_by=referrer.id, referral_path=','.join(map(str, ancestors)))
+            ).rowcount
+            if not attached:
+                session.rollback()
+                return []
+            
+            bonuses = dict(zip(ancestors, REFERRAL_BONUSES))
+            bonus = case({ancestor: literal(amount, Coins) for ancestor, amount in bonuses.items()}, value=users.c.id)
+            rows = session.execute(
+                update(users)
+                .where(users.c.id.in_(ancestors))
+                .values(
+                    coins=users.c.coins + bonus,
+                    referral_earnings=func.coalesce(users.c.referral_earnings, 0) + bonus,
+                    direct_referrals=func.coalesce(users.c.direct_referrals, 0)
+                    + case((users.c.id == referrer.id, 1), else_=0),
+                    indirect_referrals=func.coalesce(users.c.indirect_referrals, 0)
+                    + case((users.c.id == referrer.id, 0), else_=1)
+                )
+                .returning(users.c.id, users.c.telegram_id, users.c.coins, users.c.direct_referrals,
+                           users.c.indirect_referrals, users.c.referral_earnings)
+            ).all()
+            paid = {row.id for row in rows}
+            stamp = write_ledger(session, [
+                (ancestor, amount, 'referral_bonus',
+                 f'Referred user {name}' if level == 1 else f'Level {level} referral: {name}')
+                for level, (ancestor, amount) in enumerate(bonuses.items(), 1) if ancestor in paid
+            ])
+            session.commit()
+        finally:
+            session.close()
+        
+        self.user_cache.update(user_id, referred_by=referrer.id, referral_path=','.join(map(str, ancestors)))
+        for row in rows:
+            self.user_cache.update(row.id, direct_referrals=row.direct_referrals,
+                                   indirect_referrals=row.indirect_referrals,
+                                   referral_earnings=row.referral_earnings)
+        self.balance_changed({row.id: row.coins for row in rows}, stamp)
+        telegram_ids = {row.id: row.telegram_id for row in rows}
+        return [(level, ancestor, telegram_ids[ancestor], amount)
+                for level, (ancestor, amount) in enumerate(bonuses.items(), 1) if ancestor in telegram_ids]
+    
     def add_coins(self, user_id, amount, transaction_type, description=None):
+        """Credit (or debit, if negative) a user; returns the new balance or None"""
+        session = self.get_session()
+        try:
+            balances = increment_balances(session, {user_id: amount})
+            if not balances:
+                return None
+            stamp = write_ledger(session, [(user_id, amount, transaction_type, description)])
+            session.commit()
+            self.balance_changed(balances, stamp)
+            return balances[user_id]
+        finally:
+            session.close()
+    
+    def credit_many(self, credits):
+        """Apply many (user_id, amount, transaction_type, description) credits at once.
+        
+        All balances change in one UPDATE and the ledger entries are written
+        in the same transaction. Credits for unknown users are dropped.
+        Returns {user_id: new_balance}.
+        """
+        totals = {}
+        for user_id, amount, _, _ in credits:
+            totals[user_id] = totals.get(user_id, 0.0) + amount
+        if not totals:
+            return {}
+        session = self.get_session()
+        try:
+            balances = increment_balances(session, totals)
+            stamp = write_ledger(session, [credit for credit in credits if credit[0] in balances])
+            session.commit()
+            self.balance_changed(balances, stamp)
+            return balances
+        finally:
+            session.close()
+    
+    def create_task(self, creator_id, title, description, reward_coins, cost=0.0):
+        """Create a task, charging its creator `cost` in the same transaction.
+        
+        Returns (task, balance); task is None if the creator can't afford it.
+        """
         session = self.get_session()
         try:
-            user = session.query(User).filter_by(id=user_id).first()
-            if user:
-                user.coins += amount
-                transaction = Transaction(
-                    user_id=user_id,
-                    amount=amount,
-                    transaction_type=transaction_type,
-                    description=description
+            users = User.__table__
+            # A free task never depends on the balance, even a negative one
+            affordable = users.c.coins >= cost if cost else true()
+            balance = session.execute(
+                update(users)
+                .where(users.c.id == creator_id, affordable)
+                .values(coins=users.c.coins - cost)
+                .returning(users.c.coins)
+            ).scalar()
+            if balance is None:
+                session.rollback()
+                return None, session.execute(select(users.c.coins).where(users.c.id == creator_id)).scalar()
+            
+            task = Task(title=title, description=description, created_by=creator_id, reward_coins=reward_coins)
+            session.add(task)
+            if cost:
+                stamp = write_ledger(session, [(creator_id, -cost, 'task_creation', f'Created task: {title}')])
+            session.commit()
+            if cost:
+                self.balance_changed({creator_id: balance}, stamp)
+            return task, balance
+        finally:
+            session.close()
+    
+    def complete_task(self, task_id, user_id):
+        """Complete a task assigned to a user, paying its reward and updating stats.
+        
+        Claiming the task, the balance and stats update and the ledger entry
+        commit together, so a task is paid exactly once. Returns (error,
+        result): error is 'not_found', 'completed' or 'not_assigned' and
+        result None, or error is None and result a dict with the task's id,
+        title, reward, created_by and creator_telegram_id, and the user's new
+        balance, total_earned, tasks_completed, level and level_up.
+        """
+        tasks = Task.__table__
+        users = User.__table__
+        session = self.get_session()
+        try:
+            claimed = session.execute(
+                update(tasks)
+                .where(tasks.c.id == task_id, tasks.c.assigned_to == user_id, tasks.c.completed.is_not(True))
+                .values(completed=True, completed_at=datetime.utcnow())
+                .returning(
+                    tasks.c.title,
+                    tasks.c.reward_coins,
+                    tasks.c.created_by,
+                    select(users.c.telegram_id).where(users.c.id == tasks.c.created_by).scalar_subquery()
+                )
+            ).first()
+            if claimed is None:
+                session.rollback()
+                task = session.execute(
+                    select(tasks.c.completed, tasks.c.assigned_to).where(tasks.c.id == task_id)
+                ).first()
+                if task is None:
+                    return 'not_found', None
+                return ('completed' if task.completed else 'not_assigned'), None
+            title, reward, created_by, creator_telegram_id = claimed
+            
+            # Every 10 completed tasks is a level
+            tasks_completed = func.coalesce(users.c.tasks_completed, 0) + 1
+            earned_level = tasks_completed // 10 + 1
+            level = func.coalesce(users.c.level, 1)
+            stats = session.execute(
+                update(users)
+                .where(users.c.id == user_id)
+                .values(
+                    coins=users.c.coins + literal(reward, Coins),
+                    total_earned=func.coalesce(users.c.total_earned, 0) + literal(reward, Coins),
+                    tasks_completed=tasks_completed,
+                    level=case((earned_level > level, earned_level), else_=level)
                 )
-                session.add(transaction)
+                .returning(users.c.coins, users.c.total_earned, users.c.tasks_completed, users.c.level)
+            ).one()
+            stamp = write_ledger(session, [(user_id, reward, 'task_reward', f'Completed task: {title}')])
+            session.commit()
+        finally:
+            session.close()
+        
+        balance, total_earned, completed_count, new_level = stats
+        self.balance_changed({user_id: balance}, stamp)
+        self.user_cache.update(user_id, total_earned=total_earned, tasks_completed=completed_count, level=new_level)
+        return None, {
+            'task_id': task_id,
+            'title': title,
+            'reward': reward,
+            'created_by': created_by,
+            'creator_telegram_id': creator_telegram_id,
+            'balance': balance,
+            'total_earned': total_earned,
+            'tasks_completed': completed_count,
+            'level': new_level,
+            'level_up': completed_count % 10 == 0 and new_level == completed_count // 10 + 1,
+        }
+    
+    def record_tap_batch(self, user_id, seq, taps, amount, window_start=None, window_end=None):
+        """Apply a batch of taps as one balance update and one ledger entry.
+        
+        Returns (new_balance, duplicate). A batch whose (user_id, seq) was
+        already applied is not credited again, so clients can safely retry.
+        """
+        session = self.get_session()
+        try:
+            users = User.__table__
+            if session.query(TapBatch.id).filter_by(user_id=user_id, seq=seq).first():
+                return session.execute(select(users.c.coins).where(users.c.id == user_id)).scalar(), True
+            
+            balances = increment_balances(session, {user_id: amount})
+            if not balances:
+                return None, False
+            stamp = write_ledger(session, [(user_id, amount, 'tap_reward', f'Tap to earn: {taps} taps')])
+            session.add(TapBatch(
+                user_id=user_id,
+                seq=seq,
+                taps=taps,
+                amount=amount,
+                window_start=window_start,
+                window_end=window_end
+            ))
+            try:
                 session.commit()
-                return user.coins
-            return None
+            except IntegrityError:
+                # Lost a race against a concurrent retry of the same batch
+                session.rollback()
+                return session.execute(select(users.c.coins).where(users.c.id == user_id)).scalar(), True
+            self.balance_changed(balances, stamp)
+            return balances[user_id], False
+        finally:
+            session.close()
+    
+    def tap_batch_applied(self, user_id, seq):
+        """Whether the tap batch (user_id, seq) is already recorded in tap_batches"""
+        session = self.get_session()
+        try:
+            return session.query(TapBatch.id).filter_by(user_id=user_id, seq=seq).first() is not None
+        finally:
+            session.close()
+    
+    def latest_tap_seq(self, user_id):
+        """The highest seq recorded in tap_batches for a user, 0 if none"""
+        session = self.get_session()
+        try:
+            return session.query(func.max(TapBatch.seq)).filter_by(user_id=user_id).scalar() or 0
+        finally:
+            session.close()
+    
+    def apply_tap_batches(self, batches):
+        """Credit many tap batches in a single transaction.
+        
+        Each batch is a dict with user_id, seq, taps, amount, window_start and
+        window_end. Batches already recorded in tap_batches, and those of
+        unknown users, are skipped. Every user gets one balance update and
+        one aggregated ledger entry. Returns the number of batches applied.
+        """
+        for attempt in range(3):
+            session = self.get_session()
+            try:
+                unique = {}
+                for batch in batches:
+                    unique.setdefault((batch['user_id'], batch['seq']), batch)
+                
+                keys = list(unique)
+                for i in range(0, len(keys), 500):
+                    chunk = keys[i:i + 500]
+                    applied = session.query(TapBatch.user_id, TapBatch.seq).filter(
+                        tuple_(TapBatch.user_id, TapBatch.seq).in_(chunk)
+                    ).all()
+                    for key in applied:
+                        unique.pop(tuple(key), None)
+                
+                if not unique:
+                    return 0
+                
+                totals = {}
+                for batch in unique.values():
+                    taps, amount = totals.get(batch['user_id'], (0, 0.0))
+                    totals[batch['user_id']] = (taps + batch['taps'], amount + batch['amount'])
+                
+                balances = increment_balances(session, {user_id: amount for user_id, (taps, amount) in totals.items()})
+                # Batches of unknown users are dropped, not recorded as applied
+                applied = [batch for batch in unique.values() if batch['user_id'] in balances]
+                if not applied:
+                    session.rollback()
+                    return 0
+                stamp = write_ledger(session, [(user_id, amount, 'tap_reward', f'Tap to earn: {taps} taps')
+                                               for user_id, (taps, amount) in totals.items() if user_id in balances])
+                session.execute(insert(TapBatch), applied)
+                session.commit()
+                self.balance_changed(balances, stamp)
+                return len(applied)
+            except IntegrityError:
+                # Another process applied some of these batches first, filter again
+                session.rollback()
+                if attempt == 2:
+                    raise
+            finally:
+                session.close()
+    
+    def load_energy_state(self, telegram_id):
+        session = self.get_session()
+        try:
+            return session.get(EnergyCheckpoint, telegram_id)
+        finally:
+            session.close()
+    
+    def save_energy_states(self, rows):
+        """Checkpoint many energy states in one statement"""
+        session = self.get_session()
+        try:
+            upsert(session, EnergyCheckpoint, rows, ['telegram_id'])
+            session.commit()
+        finally:
+            session.close()
+    
+    def get_assigned_tasks(self, user_id):
+        session = self.get_session()
+        try:
+            return session.query(Task).filter_by(assigned_to=user_id, completed=False).all()
+        finally:
+            session.close()
+    
+    def get_ranking_rows(self, after_txn_id=None, after_user_id=None, user_ids=()):
+        """Users whose balance may have changed since the given watermarks.
+        
+        Returns (txn_id, user_id, rows): the highest ids at the time of the
+        read, to pass once no lower id can still commit (see leaderboard.py), and
+        (id, telegram_id, username, first_name, coins) rows for users with
+        newer ledger entries, newer accounts, or listed in user_ids. Without
+        watermarks every user is returned.
+        """
+        session = self.get_session()
+        try:
+            txn_mark = session.query(func.max(Transaction.id)).scalar() or 0
+            user_mark = session.query(func.max(User.id)).scalar() or 0
+            query = session.query(User.id, User.telegram_id, User.username, User.first_name, User.coins)
+            if after_txn_id is not None:
+                changed = select(Transaction.user_id).where(Transaction.id > after_txn_id)
+                query = query.filter(or_(
+                    User.id.in_(changed),
+                    User.id > after_user_id,
+                    User.id.in_(list(user_ids))
+                ))
+            return txn_mark, user_mark, [tuple(row) for row in query.all()]
+        finally:
+            session.close()
+    
+    def get_window_leaderboard(self, window='day', metric='earned', limit=10, ago=0, now=None):
+        """Top earners of a day, week or rolling 24h window as [(user, amount)].
+        
+        Sums at most 7 daily or 24 hourly buckets per user instead of
+        scanning the ledger.
+        """
+        if metric not in EARNING_METRICS:
+            raise ValueError(f'Unknown metric: {metric}')
+        granularity, first, last = earning_window(window, now, ago)
+        total = func.sum(EARNING_METRICS[metric]).label('total')
+        ranked = (
+            select(EarningBucket.user_id, total)
+            .where(
+                EarningBucket.granularity == granularity,
+                EarningBucket.bucket_start >= first,
+                EarningBucket.bucket_start <= last
+            )
+            .group_by(EarningBucket.user_id)
+            .having(total > 0)
+            .order_by(total.desc(), EarningBucket.user_id)
+            .limit(limit)
+            .subquery()
+        )
+        session = self.get_session()
+        try:
+            rows = (
+                session.query(User, ranked.c.total)
+                .join(ranked, User.id == ranked.c.user_id)
+                .order_by(ranked.c.total.desc(), User.id)
+                .all()
+            )
+            return [(user, amount) for user, amount in rows]
+        finally:
+            session.close()
+    
+    def compact_earnings(self, now=None):
+        """Drop buckets no window reaches any more; returns rows deleted.
+        
+        Hourly totals are already included in the daily buckets, so expired
+        hours are simply removed.
+        """
+        now = now or datetime.utcnow()
+        session = self.get_session()
+        try:
+            deleted = 0
+            for granularity, retention in (('hour', HOURLY_BUCKET_RETENTION), ('day', DAILY_BUCKET_RETENTION)):
+                deleted += session.query(EarningBucket).filter(
+                    EarningBucket.granularity == granularity,
+                    EarningBucket.bucket_start < now - retention
+                ).delete(synchronize_session=False)
+            session.commit()
+            return deleted
+        finally:
+            session.close()
+    
+    def get_leaderboard(self, limit=10):
+        session = self.get_session()
+        try:
+            return session.query(User).order_by(User.coins.desc()).limit(limit).all()
+        finally:
+            session.close()
+    
+    def get_watermark(self, name):
+        """Ledger id processed by a background job, or None if it never ran"""
+        session = self.get_session()
+        try:
+            return session.query(LedgerWatermark.txn_id).filter_by(name=name).scalar()
+        finally:
+            session.close()
+    
+    def queue_notifications(self, messages, delay=0.0):
+        """Persist (chat_id, text) messages to be sent in `delay` seconds"""
+        now = datetime.utcnow()
+        at = now + timedelta(seconds=delay)
+        session = self.get_session()
+        try:
+            session.execute(insert(OutboundNotification), [
+                {'chat_id': chat_id, 'text': text, 'created_at': now, 'attempts': 0, 'next_attempt_at': at}
+                for chat_id, text in messages
+            ])
+            session.commit()
+        finally:
+            session.close()
+    
+    def due_notifications(self, limit=1000, now=None):
+        """(id, chat_id, text, attempts) of queued messages due by now, oldest first"""
+        session = self.get_session()
+        try:
+            return session.execute(
+                select(OutboundNotification.id, OutboundNotification.chat_id,
+                       OutboundNotification.text, OutboundNotification.attempts)
+                .where(OutboundNotification.next_attempt_at <= (now or datetime.utcnow()))
+                .order_by(OutboundNotification.next_attempt_at, OutboundNotification.id)
+                .limit(limit)
+            ).all()
+        finally:
+            session.close()
+    
+    def delete_notifications(self, ids):
+        """Remove sent or abandoned messages from the queue"""
+        session = self.get_session()
+        try:
+            session.execute(OutboundNotification.__table__.delete().where(OutboundNotification.id.in_(ids)))
+            session.commit()
+        finally:
+            session.close()
+    
+    def retry_notifications(self, ids, delay, failed=True):
+        """Send queued messages again in `delay` seconds, counting a failed attempt if `failed`"""
+        session = self.get_session()
+        try:
+            session.execute(
+                update(OutboundNotification)
+                .where(OutboundNotification.id.in_(ids))
+                .values(
+                    next_attempt_at=datetime.utcnow() + timedelta(seconds=delay),
+                    attempts=OutboundNotification.attempts + (1 if failed else 0)
+                )
+            )
+            session.commit()
+        finally:
+            session.close()
+    
+    def get_transactions(self, user_id, limit=20):
+        """A user's newest ledger entries, including archived ones"""
+        session = self.get_session()
+        try:
+            transactions = (
+                session.query(Transaction)
+                .filter_by(user_id=user_id)
+                .order_by(Transaction.created_at.desc(), Transaction.id.desc())
+                .limit(limit)
+                .all()
+            )
+        finally:
+            session.close()
+        return expand_compacted(transactions, self.ledger_archive, limit)
+    
+    def compact_ledger(self, before, page_size=50000):
+        """Fold tap_reward rows from days before `before` into daily summaries.
+        
+        Each user's rows of one UTC day are archived, then replaced by one
+        LEDGER_SUMMARY_TYPE row with the same total that reuses the group's
+        highest id, so balances still equal the ledger sum. Works through
+        whole users page by page. Rows the reconciler hasn't verified yet
+        are left alone. Returns (rows_archived, summaries_written).
+        """
+        before = before.replace(hour=0, minute=0, second=0, microsecond=0)
+        archived = summaries = 0
+        last_user = 0
+        columns = (Transaction.id, Transaction.user_id, Transaction.amount,
+                   Transaction.transaction_type, Transaction.description, Transaction.created_at)
+        reconciled = self.get_watermark('reconcile')
+        while True:
+            session = self.get_session()
+            try:
+                query = session.query(*columns).filter(
+                    Transaction.transaction_type == 'tap_reward',
+                    Transaction.created_at < before
+                )
+                if reconciled is not None:
+                    # A summary reuses its group's highest id; keep it behind the reconciler
+                    query = query.filter(Transaction.id <= reconciled)
+                rows = query.filter(Transaction.user_id > last_user).order_by(
+                    Transaction.user_id, Transaction.id
+                ).limit(page_size).all()
+                if not rows:
+                    return archived, summaries
+                if len(rows) == page_size:
+                    # Only compact users whose rows are all in this page
+                    partial = rows[-1].user_id
+                    rows = [row for row in rows if row.user_id != partial]
+                    if not rows:
+                        rows = query.filter(Transaction.user_id == partial).order_by(Transaction.id).all()
+                last_user = rows[-1].user_id
+                
+                groups = {}
+                for row in rows:
+                    groups.setdefault((row.user_id, row.created_at.date()), []).append(row)
+                self.ledger_archive.append([row._asdict() for row in rows])
+                
+                ids = [row.id for row in rows]
+                for i in range(0, len(ids), 500):
+                    session.query(Transaction).filter(Transaction.id.in_(ids[i:i + 500])).delete(synchronize_session=False)
+                session.execute(insert(Transaction), [{
+                    'id': group[-1].id,
+                    'user_id': user_id,
+                    'amount': sum(round(row.amount * COIN_SCALE) for row in group) / COIN_SCALE,
+                    'transaction_type': LEDGER_SUMMARY_TYPE,
+                    'description': f'Tap to earn: {len(group)} batches on {day.isoformat()}',
+                    'created_at': max(row.created_at for row in group)
+                } for (user_id, day), group in groups.items()])
+                session.commit()
+                archived += len(rows)
+                summaries += len(groups)
+            finally:
+                session.close()
+    
+    def get_user_tasks(self, user_id, open_limit=100, created_limit=20):
+        """Load a user's task lists with creator and assignee eager-loaded.
+        
+        Returns (assigned, available, created), at most open_limit assigned
+        and available tasks together, assigned first. Each list is one
+        query walking an index in order and stopping at its LIMIT; a single
+        query for assigned OR unassigned tasks had SQLite merge two index
+        scans and sort every open task.
+        """
+        session = self.get_session()
+        try:
+            eager = (joinedload(Task.creator), joinedload(Task.assignee))
+            assigned = session.query(Task).options(*eager).filter(
+                Task.assigned_to == user_id,
+                Task.completed == False
+            ).order_by(Task.created_at.desc(), Task.id.desc()).limit(open_limit).all()
+            
+            available = []
+            if len(assigned) < open_limit:
+                limit = open_limit - len(assigned)
+                tasks = session.execute(task_feed_statement(limit=limit)).unique().scalars().all()
+                available, _ = task_feed_page(tasks, limit)
+            
+            created = session.query(Task).options(*eager).filter_by(
+                created_by=user_id
+            ).order_by(Task.created_at.desc()).limit(created_limit).all()
+            return assigned, available, created
+        finally:
+            session.close()
+    
+    def get_task_feed(self, cursor=None, limit=20, status='available',
+                      min_reward=None, max_reward=None, creator_id=None):
+        """One page of tasks, newest first, keyset-paginated on (created_at, id).
+        
+        Returns (tasks, next_cursor); next_cursor is None on the last page.
+        Each page costs one indexed range scan however large the table is.
+        """
+        stmt = task_feed_statement(cursor, limit, status, min_reward, max_reward, creator_id)
+        session = self.get_session()
+        try:
+            tasks = session.execute(stmt).unique().scalars().all()
+            return task_feed_page(tasks, limit)
         finally:
             session.close()
-
-
@@ -0,0 +1,151 @@
+"""Engine factory for the database layer.
+
+Any SQLAlchemy URL is accepted. PostgreSQL gets a QueuePool with pre-ping
+(dropped connections are replaced instead of failing a request) and
+periodic recycling; the legacy postgres:// scheme used by hosting providers
+is rewritten to postgresql://.
+
+For SQLite, the "tuned" profile (default) configures the file for several
+processes and threads sharing it: WAL journaling so readers never block the
+writer, synchronous=NORMAL (durable at checkpoints, safe with WAL), a larger
+page cache, memory-mapped reads and a busy timeout so a briefly locked
+database waits instead of failing with "database is locked". The "legacy" profile is
+SQLAlchemy's defaults, kept for comparison.
+
+Settings are read from the environment:
+
+    DB_PROFILE                tuned | legacy (default tuned)
+    SQLITE_JOURNAL_MODE       default WAL
+    SQLITE_SYNCHRONOUS        default NORMAL
+    SQLITE_BUSY_TIMEOUT_MS    default 5000
+    SQLITE_CACHE_SIZE_KB      default 65536
+    SQLITE_MMAP_SIZE          bytes, default 268435456
+    DB_POOL_SIZE              default 10
+    DB_MAX_OVERFLOW           default 20
+    DB_POOL_TIMEOUT           seconds, default 30
+    DB_POOL_RECYCLE           seconds, default 1800 (PostgreSQL only)
+"""
+import os
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+PROFILES = ('tuned', 'legacy')
+
+
+def sqlite_settings():
+    return {
+        'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+        'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+        'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+        'cache_size': -int(os.environ.get('SQLITE_CACHE_SIZE_KB', 65536)),  # Negative means KiB
+        'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+    }
+
+
+def pool_settings(poolclass=QueuePool):
+    return {
+        'poolclass': poolclass,
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+    }
+
+
+def normalize_url(url):
+    if url.startswith('postgres://'):
+        return 'postgresql://' + url[len('postgres://'):]
+    return url
+
+
+def make_engine(url, profile=None, echo=False):
+    """Create an engine for `url` using the given or configured profile"""
+    url = normalize_url(url)
+    profile = profile or os.environ.get('DB_PROFILE', 'tuned')
+    if profile not in PROFILES:
+        raise ValueError(f'Unknown DB_PROFILE: {profile}')
+
+    if profile == 'legacy':
+        return create_engine(url, echo=echo)
+
+    if url.startswith('postgresql'):
+        return create_engine(
+            url,
+            echo=echo,
+            pool_pre_ping=True,
+            pool_recycle=int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+            **pool_settings()
+        )
+
+    if not url.startswith('sqlite'):
+        return create_engine(url, echo=echo, pool_pre_ping=True)
+
+    settings = sqlite_settings()
+    in_memory = url in ('sqlite://', 'sqlite:///:memory:')
+    engine = create_engine(
+        url,
+        echo=echo,
+        connect_args={
+            'check_same_thread': False,
+            'timeout': settings['busy_timeout'] / 1000.0,
+        },
+        **({} if in_memory else pool_settings())
+    )
+    install_sqlite_pragmas(engine, settings, in_memory)
+    return engine
+
+
+def async_url(url):
+    """Map a sync URL to the matching asyncio driver"""
+    url = normalize_url(url)
+    scheme, rest = url.split('://', 1)
+    backend = scheme.split('+')[0]
+    driver = {'sqlite': 'aiosqlite', 'postgresql': 'asyncpg'}.get(backend)
+    if driver is None:
+        raise ValueError(f'No asyncio driver configured for {backend}')
+    return f'{backend}+{driver}://{rest}'
+
+
+def make_async_engine(url, profile=None, echo=False):
+    """Async counterpart of make_engine, sharing its settings"""
+    url = async_url(url)
+    profile = profile or os.environ.get('DB_PROFILE', 'tuned')
+    if profile not in PROFILES:
+        raise ValueError(f'Unknown DB_PROFILE: {profile}')
+
+    if profile == 'legacy':
+        return create_async_engine(url, echo=echo)
+
+    if url.startswith('postgresql'):
+        return create_async_engine(
+            url,
+            echo=echo,
+            pool_pre_ping=True,
+            pool_recycle=int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+            **pool_settings(AsyncAdaptedQueuePool)
+        )
+
+    settings = sqlite_settings()
+    in_memory = url.split('://', 1)[1] in ('', '/:memory:')
+    engine = create_async_engine(
+        url,
+        echo=echo,
+        connect_args={'timeout': settings['busy_timeout'] / 1000.0},
+        **({} if in_memory else pool_settings(AsyncAdaptedQueuePool))
+    )
+    install_sqlite_pragmas(engine.sync_engine, settings, in_memory)
+    return engine
+
+
+def install_sqlite_pragmas(engine, settings, in_memory=False):
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if not in_memory:
+            cursor.execute(f"PRAGMA journal_mode={settings['journal_mode']}")
+            cursor.execute(f"PRAGMA mmap_size={settings['mmap_size']}")
+        cursor.execute(f"PRAGMA synchronous={settings['synchronous']}")
+        cursor.execute(f"PRAGMA busy_timeout={settings['busy_timeout']}")
+        cursor.execute(f"PRAGMA cache_size={settings['cache_size']}")
+        cursor.close()
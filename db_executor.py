@@ -0,0 +1,77 @@
+"""Run blocking Database calls from asyncio code on a bounded thread pool.
+
+Bot handlers run on a single event loop; a synchronous query made directly
+in a handler stalls every other update until it returns. DatabaseExecutor
+hands such calls to a fixed number of worker threads and awaits the result,
+and keeps queue depth and wait/run time metrics so an undersized pool shows
+up in the logs.
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class DatabaseExecutor:
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='db')
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._reset_stats()
+
+    async def run(self, fn, *args, **kwargs):
+        """Call fn(*args, **kwargs) on the pool and await its result"""
+        submitted = time.perf_counter()
+        with self._lock:
+            self._queued += 1
+            self._max_queue_depth = max(self._max_queue_depth, self._queued)
+
+        def call():
+            started = time.perf_counter()
+            with self._lock:
+                self._queued -= 1
+                self._running += 1
+                wait = started - submitted
+                self._wait_total += wait
+                self._wait_max = max(self._wait_max, wait)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                with self._lock:
+                    self._running -= 1
+                    self._calls += 1
+                    self._run_total += elapsed
+                    self._run_max = max(self._run_max, elapsed)
+
+        return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+
+    def metrics(self, reset=False):
+        """Snapshot of queue depth and timings, in milliseconds"""
+        with self._lock:
+            calls = self._calls
+            snapshot = {
+                'workers': self.max_workers,
+                'queued': self._queued,
+                'running': self._running,
+                'calls': calls,
+                'max_queue_depth': self._max_queue_depth,
+                'avg_wait_ms': round(self._wait_total / calls * 1000, 2) if calls else 0.0,
+                'max_wait_ms': round(self._wait_max * 1000, 2),
+                'avg_run_ms': round(self._run_total / calls * 1000, 2) if calls else 0.0,
+                'max_run_ms': round(self._run_max * 1000, 2),
+            }
+            if reset:
+                self._reset_stats()
+            return snapshot
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+    def _reset_stats(self):
+        self._calls = 0
+        self._max_queue_depth = self._queued
+        self._wait_total = self._wait_max = 0.0
+        self._run_total = self._run_max = 0.0
@@ -0,0 +1,180 @@
+"""Server-side tap energy and rate limiting.
+
+Energy is never ticked by timers. Each user's state stores the energy level
+and the time it was last updated; the current level is derived lazily from
+the elapsed time whenever a tap batch arrives. A second bucket caps the
+sustained tap rate so scripted clients cannot drain energy faster than a
+human can tap. Both checks are O(1) and run before any database access.
+
+States live in memory and are checkpointed to the energy_states table in one
+bulk write, so restarts resume from the last checkpoint.
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+
+class EnergyState:
+    __slots__ = ('energy', 'rate_tokens', 'updated_at', 'taps_today', 'day', 'dirty', 'last_seen')
+
+    def __init__(self, energy, rate_tokens, updated_at, taps_today=0, day=None):
+        self.energy = energy
+        self.rate_tokens = rate_tokens
+        self.updated_at = updated_at
+        self.taps_today = taps_today
+        self.day = day
+        self.dirty = False
+        self.last_seen = updated_at
+
+
+class EnergyEngine:
+    def __init__(self, db, max_energy=100, recharge_per_second=1.0,
+                 max_taps_per_second=15, rate_burst_seconds=3,
+                 checkpoint_interval=30, idle_ttl=600):
+        self.db = db
+        self.max_energy = max_energy
+        self.recharge_per_second = recharge_per_second
+        self.max_taps_per_second = max_taps_per_second
+        self.rate_capacity = max_taps_per_second * rate_burst_seconds
+        self.checkpoint_interval = checkpoint_interval
+        self.idle_ttl = idle_ttl
+
+        self._states = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start periodic checkpointing"""
+        self._thread = threading.Thread(target=self._run, name='energy-checkpoint', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self.checkpoint()
+
+    def consume(self, telegram_id, taps, now=None):
+        """Grant up to `taps` taps; returns (granted, status)"""
+        now = time.time() if now is None else now
+        state = self._get(telegram_id, now)
+        with self._lock:
+            state = self._attach(telegram_id, state, now)
+            self._recharge(state, now)
+            granted = int(min(taps, state.energy, state.rate_tokens))
+            if granted > 0:
+                state.energy -= granted
+                state.rate_tokens -= granted
+                state.taps_today += granted
+                state.dirty = True
+            return granted, self._status(state)
+
+    def refund(self, telegram_id, taps):
+        """Give back energy for taps that were not credited (e.g. duplicate batch)"""
+        with self._lock:
+            state = self._states.get(telegram_id)
+            if state and taps > 0:
+                state.energy = min(self.max_energy, state.energy + taps)
+                state.rate_tokens = min(self.rate_capacity, state.rate_tokens + taps)
+                state.taps_today = max(0, state.taps_today - taps)
+                state.dirty = True
+
+    def status(self, telegram_id, now=None):
+        """Current energy for a user without consuming any"""
+        now = time.time() if now is None else now
+        state = self._get(telegram_id, now)
+        with self._lock:
+            state = self._attach(telegram_id, state, now)
+            self._recharge(state, now)
+            return self._status(state)
+
+    def checkpoint(self):
+        """Persist changed states in one write and drop idle ones from memory"""
+        now = time.time()
+        with self._lock:
+            rows = []
+            for telegram_id, state in self._states.items():
+                if state.dirty:
+                    rows.append({
+                        'telegram_id': telegram_id,
+                        'energy': state.energy,
+                        'updated_at': datetime.utcfromtimestamp(state.updated_at),
+                        'taps_today': state.taps_today,
+                        'taps_day': state.day
+                    })
+                    state.dirty = False
+            idle = [tid for tid, s in self._states.items()
+                    if not s.dirty and now - s.last_seen > self.idle_ttl]
+        if rows:
+            try:
+                self.db.save_energy_states(rows)
+            except Exception:
+                logger.exception('Energy checkpoint failed')
+                with self._lock:
+                    for row in rows:
+                        state = self._states.get(row['telegram_id'])
+                        if state:
+                            state.dirty = True
+                return 0
+        with self._lock:
+            for telegram_id in idle:
+                state = self._states.get(telegram_id)
+                if state and not state.dirty and now - state.last_seen > self.idle_ttl:
+                    del self._states[telegram_id]
+        return len(rows)
+
+    def _get(self, telegram_id, now):
+        # Called without the lock: a cache miss reads the last checkpoint
+        with self._lock:
+            state = self._states.get(telegram_id)
+        if state is None:
+            saved = self.db.load_energy_state(telegram_id)
+            if saved:
+                updated_at = saved.updated_at.replace(tzinfo=timezone.utc).timestamp()
+                state = EnergyState(saved.energy, self.rate_capacity, updated_at,
+                                    saved.taps_today or 0, saved.taps_day)
+            else:
+                state = EnergyState(self.max_energy, self.rate_capacity, now)
+        return state
+
+    def _attach(self, telegram_id, state, now):
+        # Called with self._lock held
+        state = self._states.setdefault(telegram_id, state)
+        state.last_seen = now
+        return state
+
+    def _recharge(self, state, now):
+        elapsed = max(0.0, now - state.updated_at)
+        state.energy = min(self.max_energy, state.energy + elapsed * self.recharge_per_second)
+        state.rate_tokens = min(self.rate_capacity, state.rate_tokens + elapsed * self.max_taps_per_second)
+        state.updated_at = max(state.updated_at, now)
+        today = datetime.utcfromtimestamp(now).strftime('%Y-%m-%d')
+        if state.day != today:
+            state.day = today
+            state.taps_today = 0
+            state.dirty = True
+
+    def _status(self, state):
+        wait = max(
+            (1 - state.energy) / self.recharge_per_second,
+            (1 - state.rate_tokens) / self.max_taps_per_second,
+            0
+        )
+        return {
+            'energy': int(state.energy),
+            'max_energy': self.max_energy,
+            'recharge_per_second': self.recharge_per_second,
+            'taps_today': state.taps_today,
+            'retry_after': round(wait, 3)
+        }
+
+    def _run(self):
+        while not self._stop.wait(self.checkpoint_interval):
+            try:
+                self.checkpoint()
+            except Exception:
+                logger.exception('Unexpected error in energy checkpoint')
@@ -0,0 +1,186 @@
+"""A local stand-in for the Telegram Bot API, for benchmarks and manual testing.
+
+FakeBotApi answers getMe and sendMessage (recording every accepted message)
+and enforces flood limits the way Telegram does: a chat takes about
+`per_chat_rate` messages a second with short bursts, the bot about
+`global_rate` in total, and anything over that gets a 429 with a
+retry_after. Chats in `blocked` answer 403 like a user who blocked the bot.
+
+Incoming updates are made with message_update() and handed over by
+deliver(): to a long-polling getUpdates, or POSTed to the webhook set with
+setWebhook, secret token header included. Every response and every webhook
+delivery takes `latency` seconds.
+
+    api = FakeBotApi()
+    async with api.serve():
+        bot = Bot(token, base_url=api.base_url)
+"""
+import asyncio
+import contextlib
+import inspect
+import json
+import math
+import time
+from urllib.parse import parse_qs
+
+import httpx
+import uvicorn
+
+from notifications import TokenBucket
+
+
+class FakeBotApi:
+    def __init__(self, per_chat_rate=1.0, per_chat_burst=3, global_rate=30.0, latency=0.0, blocked=()):
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self.latency = latency
+        self.blocked = set(blocked)
+        self.port = None
+        self.messages = []  # (time.monotonic(), chat_id, text) of every accepted message
+        self.rejected = 0  # 429 responses
+        self.requests = 0
+        self.webhook_url = None
+        self.webhook_secret = None
+        self._chats = {}
+        self._updates = []  # Waiting for getUpdates
+        self._update_id = 0
+        self._arrived = asyncio.Event()
+        self._client = None
+        self._deliveries = set()
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.port}/bot'
+
+    @contextlib.asynccontextmanager
+    async def serve(self, host='127.0.0.1', port=0):
+        """Run the server on the current event loop; port 0 picks a free one"""
+        async with serve(self, host, port) as self.port, httpx.AsyncClient() as self._client:
+            yield self
+            await asyncio.gather(*self._deliveries)
+
+    def message_update(self, chat_id, text):
+        """An update for a private text message, e.g. a command"""
+        self._update_id += 1
+        message = {
+            'message_id': self._update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': f'User {chat_id}'},
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'update_id': self._update_id, 'message': message}
+
+    def deliver(self, update):
+        """Hand an update to the bot the way it asked for them"""
+        if self.webhook_url:
+            task = asyncio.create_task(self._post(update))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+        else:
+            self._updates.append(update)
+            self._arrived.set()
+
+    async def _post(self, update):
+        await asyncio.sleep(self.latency)
+        headers = {'X-Telegram-Bot-Api-Secret-Token': self.webhook_secret} if self.webhook_secret else {}
+        response = await self._client.post(self.webhook_url, json=update, headers=headers)
+        response.raise_for_status()
+
+    async def __call__(self, scope, receive, send):
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        self.requests += 1
+        # Paths look like /bot<token>/<method>
+        method = scope['path'].rsplit('/', 1)[-1]
+        if body.startswith(b'{'):
+            params = json.loads(body)
+        else:
+            params = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+        handler = getattr(self, f'api_{method}', None)
+        if handler is None:
+            status, payload = 404, {'ok': False, 'error_code': 404, 'description': 'Not Found'}
+        else:
+            result = handler(params)
+            status, payload = await result if inspect.isawaitable(result) else result
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        data = json.dumps(payload).encode()
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(data)).encode())],
+        })
+        await send({'type': 'http.response.body', 'body': data})
+
+    def api_getMe(self, params):
+        return 200, {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}}
+
+    async def api_getUpdates(self, params):
+        if self.webhook_url:
+            return 409, {'ok': False, 'error_code': 409,
+                         'description': "Conflict: can't use getUpdates method while webhook is active"}
+        offset = int(params.get('offset') or 0)
+        self._updates = [update for update in self._updates if update['update_id'] >= offset]
+        if not self._updates:
+            self._arrived.clear()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._arrived.wait(), float(params.get('timeout') or 0))
+        return 200, {'ok': True, 'result': self._updates[:int(params.get('limit') or 100)]}
+
+    def api_setWebhook(self, params):
+        self.webhook_url = params['url']
+        self.webhook_secret = params.get('secret_token')
+        return 200, {'ok': True, 'result': True}
+
+    def api_deleteWebhook(self, params):
+        self.webhook_url = self.webhook_secret = None
+        return 200, {'ok': True, 'result': True}
+
+    def api_sendMessage(self, params):
+        chat_id = int(params['chat_id'])
+        if chat_id in self.blocked:
+            return 403, {'ok': False, 'error_code': 403, 'description': 'Forbidden: bot was blocked by the user'}
+        chat = self._chats.setdefault(chat_id, TokenBucket(self.per_chat_rate, capacity=self.per_chat_burst))
+        wait = max(chat.delay(), self.global_bucket.delay())
+        if wait > 0:
+            self.rejected += 1
+            retry_after = math.ceil(wait)
+            return 429, {
+                'ok': False,
+                'error_code': 429,
+                'description': f'Too Many Requests: retry after {retry_after}',
+                'parameters': {'retry_after': retry_after},
+            }
+        chat.tokens -= 1
+        self.global_bucket.tokens -= 1
+        self.messages.append((time.monotonic(), chat_id, params['text']))
+        return 200, {'ok': True, 'result': {
+            'message_id': len(self.messages),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': params['text'],
+        }}
+
+
+@contextlib.asynccontextmanager
+async def serve(app, host='127.0.0.1', port=0):
+    """Serve an ASGI app with uvicorn on the current event loop, yielding its port"""
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, lifespan='off', log_level='warning'))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            task.result()
+        await asyncio.sleep(0.01)
+    try:
+        yield server.servers[0].sockets[0].getsockname()[1]
+    finally:
+        server.should_exit = True
+        await task
@@ -0,0 +1,347 @@
+"""In-memory leaderboard with O(log n) rank lookups.
+
+Users are kept in an indexable skip list ordered by (coins desc, user id), so
+the top N, a user's rank and the users ranked around them never need a sort
+in the database. Balance changes made through Database are applied as soon
+as they commit; changes made by other processes are picked up by a
+background refresh that reads only the users with ledger entries (or
+accounts) newer than the last refresh. PostgreSQL can commit ids out of
+order, so a watermark is only trusted SETTLE_SECONDS after it was read;
+until then every refresh reads again from the last settled one.
+
+The ranking is saved to a snapshot file together with the ledger position it
+reflects, so a restart loads the snapshot and catches up from there instead
+of reading every user.
+
+Daily, weekly and rolling 24h rankings come from the hourly/daily earning
+buckets written alongside the ledger. The most recently used ones are cached
+for a few seconds, and the refresh loop also drops buckets that have aged
+out of every window.
+"""
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+SETTLE_SECONDS = float(os.environ.get('LEADERBOARD_SETTLE_SECONDS', 5))
+
+
+class _Node:
+    __slots__ = ('key', 'value', 'forward', 'span')
+
+    def __init__(self, key, value, level):
+        self.key = key
+        self.value = value
+        self.forward = [None] * level
+        self.span = [0] * level
+
+
+class RankedSkipList:
+    """Sorted map with O(log n) insert, remove, rank and lookup by rank.
+
+    Ranks are 1-based. Every forward link stores how many positions it skips,
+    which is what makes rank queries logarithmic.
+    """
+    MAX_LEVEL = 32
+    P = 0.25
+
+    def __init__(self):
+        self._head = _Node(None, None, self.MAX_LEVEL)
+        self._level = 1
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def insert(self, key, value=None):
+        update = [None] * self.MAX_LEVEL
+        rank = [0] * self.MAX_LEVEL
+        x = self._head
+        for i in reversed(range(self._level)):
+            rank[i] = 0 if i == self._level - 1 else rank[i + 1]
+            while x.forward[i] is not None and x.forward[i].key < key:
+                rank[i] += x.span[i]
+                x = x.forward[i]
+            update[i] = x
+
+        level = self._random_level()
+        if level > self._level:
+            for i in range(self._level, level):
+                rank[i] = 0
+                update[i] = self._head
+                self._head.span[i] = self._size
+            self._level = level
+
+        node = _Node(key, value, level)
+        for i in range(level):
+            node.forward[i] = update[i].forward[i]
+            update[i].forward[i] = node
+            node.span[i] = update[i].span[i] - (rank[0] - rank[i])
+            update[i].span[i] = rank[0] - rank[i] + 1
+        for i in range(level, self._level):
+            update[i].span[i] += 1
+        self._size += 1
+
+    def remove(self, key):
+        update = [None] * self.MAX_LEVEL
+        x = self._head
+        for i in reversed(range(self._level)):
+            while x.forward[i] is not None and x.forward[i].key < key:
+                x = x.forward[i]
+            update[i] = x
+
+        node = x.forward[0]
+        if node is None or node.key != key:
+            raise KeyError(key)
+        for i in range(self._level):
+            if update[i].forward[i] is node:
+                update[i].span[i] += node.span[i] - 1
+                update[i].forward[i] = node.forward[i]
+            else:
+                update[i].span[i] -= 1
+        while self._level > 1 and self._head.forward[self._level - 1] is None:
+            self._level -= 1
+        self._size -= 1
+
+    def rank(self, key):
+        """1-based position of key, or None if absent"""
+        x = self._head
+        rank = 0
+        for i in reversed(range(self._level)):
+            while x.forward[i] is not None and x.forward[i].key <= key:
+                rank += x.span[i]
+                x = x.forward[i]
+        if x is not self._head and x.key == key:
+            return rank
+        return None
+
+    def slice(self, start, count):
+        """Up to `count` (key, value) pairs starting at 1-based rank `start`"""
+        if count <= 0 or start > self._size:
+            return []
+        start = max(start, 1)
+        x = self._head
+        traversed = 0
+        for i in reversed(range(self._level)):
+            while x.forward[i] is not None and traversed + x.span[i] <= start:
+                traversed += x.span[i]
+                x = x.forward[i]
+        items = []
+        while x is not None and len(items) < count:
+            items.append((x.key, x.value))
+            x = x.forward[0]
+        return items
+
+    def _random_level(self):
+        level = 1
+        while level < self.MAX_LEVEL and random.random() < self.P:
+            level += 1
+        return level
+
+
+class RankedUser:
+    """The user fields the leaderboard needs; read like a User by the views"""
+    __slots__ = ('id', 'telegram_id', 'username', 'first_name', 'coins', 'touched')
+
+    def __init__(self, id, telegram_id, username, first_name, coins):
+        self.id = id
+        self.telegram_id = telegram_id
+        self.username = username
+        self.first_name = first_name
+        self.coins = coins or 0.0
+        self.touched = 0
+
+    @property
+    def key(self):
+        return (-self.coins, self.id)
+
+
+class Leaderboard:
+    def __init__(self, db, snapshot_path=None, refresh_interval=1.0, snapshot_interval=300,
+                 window_ttl=5.0, window_cache_size=128, compact_interval=3600, settle=SETTLE_SECONDS):
+        self.db = db
+        self.snapshot_path = snapshot_path
+        self.refresh_interval = refresh_interval
+        self.snapshot_interval = snapshot_interval
+        self.window_ttl = window_ttl
+        self.window_cache_size = window_cache_size  # Windowed rankings kept, least recently used dropped
+        self.compact_interval = compact_interval
+        self.settle = settle  # Wait for writes holding lower ids to commit
+
+        self._ranking = RankedSkipList()
+        self._users = {}
+        self._by_telegram_id = {}
+        self._txn_mark = None
+        self._user_mark = None
+        self._marks = deque()  # (time, txn_mark, user_mark) of reads not yet settled
+        self._generation = 0
+        self._recheck = set()
+        self._windows = OrderedDict()  # (window, metric, limit, ago) -> (expires, top)
+        self._windows_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        db.balance_listeners.append(self.apply_balances)
+
+    def __len__(self):
+        return len(self._ranking)
+
+    def start(self):
+        """Load the ranking and keep it in sync in the background"""
+        self.load()
+        self._thread = threading.Thread(target=self._run, name='leaderboard-refresh', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self.save_snapshot()
+
+    def load(self):
+        """Rebuild from the snapshot if there is one, else from the users table"""
+        if self.snapshot_path and os.path.exists(self.snapshot_path):
+            try:
+                with open(self.snapshot_path) as f:
+                    snapshot = json.load(f)
+                with self._lock:
+                    for row in snapshot['users']:
+                        self._set(RankedUser(*row))
+                    self._txn_mark = snapshot['txn_mark']
+                    self._user_mark = snapshot['user_mark']
+                self.refresh()
+                return
+            except (OSError, ValueError, KeyError, TypeError):
+                logger.exception('Unreadable leaderboard snapshot %s, rebuilding', self.snapshot_path)
+                with self._lock:
+                    self._ranking = RankedSkipList()
+                    self._users.clear()
+                    self._by_telegram_id.clear()
+                    self._txn_mark = self._user_mark = None
+                    self._marks.clear()
+        self.refresh()
+
+    def refresh(self):
+        """Re-read users whose balance changed since the last refresh"""
+        with self._lock:
+            generation = self._generation
+            recheck, self._recheck = self._recheck, set()
+            after_txn, after_user = self._txn_mark, self._user_mark
+        read_at = time.monotonic()
+        txn_mark, user_mark, rows = self.db.get_ranking_rows(after_txn, after_user, recheck)
+        with self._lock:
+            for row in rows:
+                current = self._users.get(row[0])
+                if current is not None and current.touched > generation:
+                    # Updated by a commit in this process after our read; verify next time
+                    self._recheck.add(row[0])
+                    continue
+                self._set(RankedUser(*row))
+            self._marks.append((read_at, txn_mark, user_mark))
+            while self._marks and self._marks[0][0] <= time.monotonic() - self.settle:
+                _, self._txn_mark, self._user_mark = self._marks.popleft()
+        return len(rows)
+
+    def apply_balances(self, balances):
+        """Database balance listener: {user_id: coins} of a committed change"""
+        with self._lock:
+            self._generation += 1
+            for user_id, coins in balances.items():
+                user = self._users.get(user_id)
+                if user is None:
+                    # New to this process, the next refresh loads it
+                    continue
+                self._ranking.remove(user.key)
+                user.coins = coins
+                user.touched = self._generation
+                self._ranking.insert(user.key, user)
+
+    def add_user(self, user):
+        """Rank a user (e.g. just created) before the next refresh sees it"""
+        with self._lock:
+            if user.id not in self._users:
+                self._set(RankedUser(user.id, user.telegram_id, user.username, user.first_name, user.coins))
+
+    def top(self, limit=10):
+        with self._lock:
+            return [user for _, user in self._ranking.slice(1, limit)]
+
+    def rank(self, telegram_id):
+        """(rank, user) for a Telegram user, or (None, None) if not ranked"""
+        with self._lock:
+            user = self._by_telegram_id.get(telegram_id)
+            if user is None:
+                return None, None
+            return self._ranking.rank(user.key), user
+
+    def around(self, telegram_id, radius=2):
+        """A user's rank and the [(rank, user)] list within `radius` places of it"""
+        with self._lock:
+            user = self._by_telegram_id.get(telegram_id)
+            if user is None:
+                return None, []
+            rank = self._ranking.rank(user.key)
+            start = max(1, rank - radius)
+            items = self._ranking.slice(start, rank + radius - start + 1)
+            return rank, [(start + i, u) for i, (_, u) in enumerate(items)]
+
+    def window_top(self, window='day', metric='earned', limit=10, ago=0):
+        """[(user, amount)] for a day/week/24h window, see Database.get_window_leaderboard"""
+        key = (window, metric, limit, ago)
+        now = time.monotonic()
+        with self._windows_lock:
+            cached = self._windows.get(key)
+            if cached and cached[0] > now:
+                self._windows.move_to_end(key)
+                return cached[1]
+        top = self.db.get_window_leaderboard(window, metric, limit, ago)
+        with self._windows_lock:
+            self._windows[key] = (now + self.window_ttl, top)
+            self._windows.move_to_end(key)
+            while len(self._windows) > self.window_cache_size:
+                self._windows.popitem(last=False)
+        return top
+
+    def save_snapshot(self):
+        if not self.snapshot_path or self._txn_mark is None:
+            return
+        with self._lock:
+            snapshot = {
+                'txn_mark': self._txn_mark,
+                'user_mark': self._user_mark,
+                'users': [[u.id, u.telegram_id, u.username, u.first_name, u.coins]
+                          for _, u in self._ranking.slice(1, len(self._ranking))],
+            }
+        tmp_path = f'{self.snapshot_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f, separators=(',', ':'))
+        os.replace(tmp_path, self.snapshot_path)
+
+    def _set(self, user):
+        # Called with self._lock held
+        old = self._users.get(user.id)
+        if old is not None:
+            self._ranking.remove(old.key)
+            user.touched = old.touched
+        self._users[user.id] = user
+        self._by_telegram_id[user.telegram_id] = user
+        self._ranking.insert(user.key, user)
+
+    def _run(self):
+        last_snapshot = last_compaction = time.monotonic()
+        while not self._stop.wait(self.refresh_interval):
+            try:
+                self.refresh()
+                if time.monotonic() - last_snapshot >= self.snapshot_interval:
+                    self.save_snapshot()
+                    last_snapshot = time.monotonic()
+                if time.monotonic() - last_compaction >= self.compact_interval:
+                    self.db.compact_earnings()
+                    last_compaction = time.monotonic()
+            except Exception:
+                logger.exception('Leaderboard refresh failed')
@@ -0,0 +1,144 @@
+"""Compressed, append-only archive of compacted ledger rows.
+
+Old tap_reward rows are folded into one summary row per user per day by
+Database.compact_ledger; the raw rows are written here first. Each UTC day
+has its own directory of gzip segments sharded by user id, and every
+compaction run writes new segments next to the ones it touches, so existing
+data is never rewritten. A segment is written under a temporary name,
+fsynced and renamed into place, so a run that dies mid-write leaves no torn
+segment behind. Reads decode every gzip member on its own, so a corrupt
+member costs only its own rows (archives written before segments per run
+appended every run's member to one file per shard and day), and drop
+duplicate ids, which makes an interrupted run safe to repeat.
+
+Run the compaction job (e.g. daily from cron) with:
+    python ledger_archive.py compact [--days 7]
+"""
+import argparse
+import gzip
+import json
+import logging
+import os
+import secrets
+import sys
+import time
+import zlib
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+SUFFIX = '.jsonl.gz'
+GZIP_MAGIC = b'\x1f\x8b\x08'
+
+
+class LedgerArchive:
+    SHARDS = 64
+
+    def __init__(self, directory='ledger_archive'):
+        self.directory = directory
+
+    def append(self, rows):
+        """Durably write rows (dicts with the Transaction columns) as new segments"""
+        segments = defaultdict(list)
+        for row in rows:
+            segments[(row['created_at'].date(), row['user_id'] % self.SHARDS)].append(row)
+        run = f"{time.strftime('%Y%m%dT%H%M%S')}-{secrets.token_hex(4)}"
+        for (day, shard), segment_rows in segments.items():
+            directory = os.path.join(self.directory, day.isoformat())
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f'{shard:02x}.{run}{SUFFIX}')
+            with open(path + '.tmp', 'wb') as f:
+                with gzip.GzipFile(fileobj=f, mode='wb') as member:
+                    for row in segment_rows:
+                        member.write(json.dumps([
+                            row['id'], row['user_id'], row['amount'], row['transaction_type'],
+                            row['description'], row['created_at'].isoformat()
+                        ]).encode() + b'\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + '.tmp', path)
+            fsync_directory(directory)
+        return len(rows)
+
+    def read(self, user_id, day):
+        """Archived rows of one user on one UTC day, oldest first"""
+        rows = {}
+        for path in self._segments(user_id, day):
+            with open(path, 'rb') as f:
+                data = f.read()
+            for member in gzip_members(data, path):
+                for line in member.splitlines():
+                    row_id, row_user_id, amount, transaction_type, description, created_at = json.loads(line)
+                    if row_user_id == user_id:
+                        rows[row_id] = {
+                            'id': row_id,
+                            'user_id': row_user_id,
+                            'amount': amount,
+                            'transaction_type': transaction_type,
+                            'description': description,
+                            'created_at': datetime.fromisoformat(created_at),
+                        }
+        return sorted(rows.values(), key=lambda row: (row['created_at'], row['id']))
+
+    def _segments(self, user_id, day):
+        directory = os.path.join(self.directory, day.isoformat())
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return []
+        shard = f'{user_id % self.SHARDS:02x}'
+        # <shard>.jsonl.gz from before segments per run, then <shard>.<run>.jsonl.gz
+        return [os.path.join(directory, name) for name in sorted(names)
+                if name.endswith(SUFFIX) and name.split('.', 1)[0] == shard]
+
+
+def gzip_members(data, path=''):
+    """The decompressed members of gzip `data`, skipping any that are torn or corrupt"""
+    offset = 0
+    while offset < len(data):
+        decompressor = zlib.decompressobj(wbits=31)
+        try:
+            member = decompressor.decompress(data[offset:])
+            if not decompressor.eof:
+                raise zlib.error('member is truncated')
+            member.decode()
+        except (zlib.error, UnicodeDecodeError) as e:
+            # A run died mid-append; its rows were never removed from the live table
+            logger.warning('Skipping a corrupt gzip member at offset %d of %s: %s', offset, path, e)
+            offset = data.find(GZIP_MAGIC, offset + 1)
+            if offset == -1:
+                return
+            continue
+        yield member
+        offset = len(data) - len(decompressor.unused_data)
+
+
+def fsync_directory(directory):
+    """Make a rename in `directory` durable"""
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def main(argv):
+    from database import Database
+
+    parser = argparse.ArgumentParser(description='Ledger compaction')
+    sub = parser.add_subparsers(dest='command', required=True)
+    compact = sub.add_parser('compact', help='fold old tap_reward rows into daily summaries')
+    compact.add_argument('--days', type=int, default=int(os.environ.get('LEDGER_COMPACT_AFTER_DAYS', 7)),
+                         help='keep this many recent days uncompacted')
+    args = parser.parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    db = Database()
+    before = datetime.utcnow() - timedelta(days=args.days)
+    archived, summaries = db.compact_ledger(before)
+    print(f'Archived {archived} rows into {summaries} summary rows')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
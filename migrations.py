@@ -0,0 +1,351 @@
+"""Versioned schema migrations.
+
+Base.metadata.create_all only creates tables that are missing; it never
+changes a table that already exists. Changes to existing deployments are
+applied here in version order, and every applied version is recorded in the
+schema_version table. A brand new database gets the current schema from
+create_all and is stamped with the latest version.
+
+Migrations must be idempotent: the bot and the web app may start at the same
+time against the same database.
+
+Usage:
+    python migrations.py            apply pending migrations
+    python migrations.py status     show applied and pending versions
+    python migrations.py explain    check that hot queries use an index
+"""
+import logging
+import sys
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import (
+    BigInteger, Column, DateTime, Integer, MetaData, String, Table, bindparam, column, func, inspect, select, table, text
+)
+from sqlalchemy.exc import IntegrityError
+
+from user_search import SEARCH_SQL, create_search_index
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """Register a migration function taking a connection"""
+    def register(fn):
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return register
+
+
+version_metadata = MetaData()
+schema_version = Table(
+    'schema_version', version_metadata,
+    Column('version', Integer, primary_key=True, autoincrement=False),
+    Column('description', String),
+    Column('applied_at', DateTime, default=datetime.utcnow)
+)
+
+
+def latest_version():
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def current_version(conn):
+    versions = conn.execute(select(schema_version.c.version)).scalars().all()
+    return max(versions, default=0)
+
+
+def upgrade(engine, metadata):
+    """Create missing tables and apply pending migrations"""
+    with engine.begin() as conn:
+        fresh = not inspect(conn).has_table('users')
+        metadata.create_all(conn)
+        schema_version.create(conn, checkfirst=True)
+        if fresh:
+            # create_all already built the latest schema
+            for version, description, _ in MIGRATIONS:
+                conn.execute(schema_version.insert().values(version=version, description=description))
+            return
+
+    for version, description, fn in MIGRATIONS:
+        with engine.connect() as conn:
+            if version <= current_version(conn):
+                continue
+        logger.info('Applying migration %d: %s', version, description)
+        try:
+            with engine.begin() as conn:
+                if version <= current_version(conn):
+                    continue
+                fn(conn)
+                conn.execute(schema_version.insert().values(version=version, description=description))
+        except IntegrityError:
+            # Another process recorded this version first
+            logger.info('Migration %d was applied concurrently', version)
+
+
+@migration(1, 'Composite indexes for hot query paths')
+def add_hot_path_indexes(conn):
+    for statement in (
+        'CREATE INDEX IF NOT EXISTS ix_tasks_assigned_to_completed_created_at '
+        'ON tasks (assigned_to, completed, created_at, id)',
+        'CREATE INDEX IF NOT EXISTS ix_tasks_created_by_created_at ON tasks (created_by, created_at)',
+        'CREATE INDEX IF NOT EXISTS ix_transactions_user_id_created_at ON transactions (user_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS ix_users_referred_by ON users (referred_by)',
+        'CREATE INDEX IF NOT EXISTS ix_users_coins ON users (coins)',
+    ):
+        conn.execute(text(statement))
+
+
+@migration(2, 'Widen users.telegram_id to 64 bits')
+def widen_telegram_id(conn):
+    # SQLite integers are already 64-bit
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text('ALTER TABLE users ALTER COLUMN telegram_id TYPE BIGINT'))
+
+
+@migration(3, 'Backfill hourly and daily earning buckets from the ledger')
+def backfill_earning_buckets(conn):
+    # The table itself is created by create_all; windows reach back at most 35 days
+    since = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=35)
+    ledger = table('transactions', column('user_id'), column('amount'), column('transaction_type'),
+                   column('created_at', DateTime))
+    buckets = table('earning_buckets', column('granularity'), column('bucket_start', DateTime),
+                    column('user_id'), column('earned'), column('tap_earned'))
+    totals = {}  # Amounts are summed in whatever unit the ledger currently stores
+    rows = conn.execute(
+        select(ledger.c.user_id, ledger.c.amount, ledger.c.transaction_type, ledger.c.created_at)
+        .where(ledger.c.created_at >= since, ledger.c.amount > 0)
+    )
+    for user_id, amount, transaction_type, created_at in rows:
+        hour = created_at.replace(minute=0, second=0, microsecond=0)
+        for key in (('hour', hour, user_id), ('day', hour.replace(hour=0), user_id)):
+            earned, tap_earned = totals.get(key, (0, 0))
+            totals[key] = (earned + amount, tap_earned + (amount if transaction_type == 'tap_reward' else 0))
+    conn.execute(buckets.delete())
+    if totals:
+        conn.execute(buckets.insert(), [
+            {'granularity': g, 'bucket_start': start, 'user_id': user_id, 'earned': earned, 'tap_earned': tap_earned}
+            for (g, start, user_id), (earned, tap_earned) in totals.items()
+        ])
+
+
+
+def rebuild_sqlite_table(conn, name, conversions):
+    """Rewrite a SQLite table with new column types.
+    
+    SQLite can't change a column's type in place: the table is copied into
+    a new one, swapped in under the old name and its indexes recreated.
+    `conversions` maps column name to (new type, SQL expression over the old
+    value).
+    """
+    metadata = MetaData()
+    old = Table(name, metadata, autoload_with=conn)
+    indexes = [(index.name, [c.name for c in index.columns], index.unique) for index in old.indexes]
+    new = old.to_metadata(metadata, name=f'{name}__rebuild')
+    new.indexes.clear()
+    for column_name, (type_, _) in conversions.items():
+        new.c[column_name].type = type_
+    new.create(conn)
+
+    columns = [c.name for c in old.columns]
+    selected = [conversions[c][1] if c in conversions else c for c in columns]
+    conn.execute(text(f"INSERT INTO {new.name} ({', '.join(columns)}) SELECT {', '.join(selected)} FROM {name}"))
+    conn.execute(text(f'DROP TABLE {name}'))
+    conn.execute(text(f'ALTER TABLE {new.name} RENAME TO {name}'))
+    for index_name, index_columns, unique in indexes:
+        conn.execute(text(
+            f"CREATE {'UNIQUE ' if unique else ''}INDEX {index_name} ON {name} ({', '.join(index_columns)})"
+        ))
+
+
+COIN_COLUMNS = {
+    'users': ('coins', 'total_earned'),
+    'tasks': ('reward_coins',),
+    'transactions': ('amount',),
+    'tap_batches': ('amount',),
+    'earning_buckets': ('earned', 'tap_earned'),
+}
+
+
+@migration(4, 'Store coin amounts as integer hundredths')
+def coins_to_minor_units(conn):
+    scale = 100  # database.COIN_SCALE
+    inspector = inspect(conn)
+    for table_name, columns in COIN_COLUMNS.items():
+        types = {c['name']: c['type'] for c in inspector.get_columns(table_name)}
+        pending = [c for c in columns if not isinstance(types[c], Integer)]
+        if not pending:
+            continue
+        if conn.dialect.name == 'postgresql':
+            for column_name in pending:
+                conn.execute(text(
+                    f'ALTER TABLE {table_name} ALTER COLUMN {column_name} TYPE BIGINT '
+                    f'USING round({column_name} * {scale})'
+                ))
+        else:
+            rebuild_sqlite_table(conn, table_name, {
+                column_name: (BigInteger(), f'CAST(ROUND({column_name} * {scale}) AS INTEGER)')
+                for column_name in pending
+            })
+    # Totals written by migration 3 may predate the conversion; recompute them
+    backfill_earning_buckets(conn)
+
+
+@migration(5, 'Referral paths and denormalized referral counts')
+def add_referral_graph(conn):
+    depth = 3  # database.REFERRAL_DEPTH
+    existing = {c['name'] for c in inspect(conn).get_columns('users')}
+    for name, ddl in (('referral_path', "VARCHAR DEFAULT ''"),
+                      ('direct_referrals', 'INTEGER DEFAULT 0'),
+                      ('indirect_referrals', 'INTEGER DEFAULT 0'),
+                      ('referral_earnings', 'BIGINT DEFAULT 0')):
+        if name not in existing:
+            conn.execute(text(f'ALTER TABLE users ADD COLUMN {name} {ddl}'))
+
+    users = table('users', column('id'), column('referred_by'), column('referral_path'),
+                  column('direct_referrals'), column('indirect_referrals'), column('referral_earnings'))
+    ledger = table('transactions', column('user_id'), column('amount'), column('transaction_type'))
+    referrers = dict(conn.execute(select(users.c.id, users.c.referred_by)).all())
+    earnings = dict(conn.execute(
+        select(ledger.c.user_id, func.sum(ledger.c.amount))
+        .where(ledger.c.transaction_type == 'referral_bonus')
+        .group_by(ledger.c.user_id)
+    ).all())
+    paths = {}
+    direct = defaultdict(int)
+    indirect = defaultdict(int)
+    for user_id, referrer in referrers.items():
+        path = []
+        # Referrals used to be unchecked, so guard against cycles
+        while referrer is not None and referrer != user_id and referrer not in path and len(path) < depth:
+            path.append(referrer)
+            referrer = referrers.get(referrer)
+        paths[user_id] = path
+        for level, ancestor in enumerate(path):
+            (direct if level == 0 else indirect)[ancestor] += 1
+    if paths:
+        conn.execute(
+            users.update().where(users.c.id == bindparam('user_id')),
+            [{
+                'user_id': user_id,
+                'referral_path': ','.join(map(str, path)),
+                'direct_referrals': direct[user_id],
+                'indirect_referrals': indirect[user_id],
+                'referral_earnings': earnings.get(user_id) or 0,
+            } for user_id, path in paths.items()]
+        )
+
+
+@migration(6, 'Full-text user search index')
+def add_user_search_index(conn):
+    create_search_index(conn)
+
+
+# Representative SQL for the queries behind each endpoint and bot command
+HOT_QUERIES = {
+    'user by telegram_id (all endpoints, all commands)':
+        ('SELECT * FROM users WHERE telegram_id = :id', {'id': 1}),
+    'user by referral code (/api/user, /start)':
+        ('SELECT * FROM users WHERE referral_code = :code', {'code': 'x'}),
+    'assigned tasks for user (/api/tasks)':
+        ('SELECT * FROM tasks WHERE assigned_to = :id AND completed = false '
+         'ORDER BY created_at DESC, id DESC LIMIT 100', {'id': 1}),
+    'available tasks (/api/tasks)':
+        ('SELECT * FROM tasks WHERE assigned_to IS NULL AND completed = false '
+         'ORDER BY created_at DESC, id DESC LIMIT 101', {}),
+    'created tasks (/api/tasks)':
+        ('SELECT * FROM tasks WHERE created_by = :id ORDER BY created_at DESC LIMIT 20', {'id': 1}),
+    'task feed page (/api/tasks/feed, /available_tasks)':
+        ('SELECT * FROM tasks WHERE assigned_to IS NULL AND completed = false '
+         'AND (created_at < :at OR (created_at = :at AND id < :id)) '
+         'ORDER BY created_at DESC, id DESC LIMIT 21', {'at': '2030-01-01 00:00:00', 'id': 1}),
+    'my tasks (/my_tasks)':
+        ('SELECT * FROM tasks WHERE assigned_to = :id AND completed = false', {'id': 1}),
+    'task by id (assign/complete)':
+        ('SELECT * FROM tasks WHERE id = :id', {'id': 1}),
+    'recent transactions (/api/transactions, /transactions)':
+        ('SELECT * FROM transactions WHERE user_id = :id ORDER BY created_at DESC LIMIT 20', {'id': 1}),
+    'leaderboard refresh (background)':
+        ('SELECT id, coins FROM users WHERE id IN (SELECT user_id FROM transactions WHERE id > :txn) '
+         'OR id > :uid', {'txn': 1, 'uid': 1}),
+    'user search (/api/users/search)':
+        (SEARCH_SQL, {'query': '"jo"*', 'term': 'jo', 'prefix': 'jo%', 'limit': 10}),
+    'user by id (/api/users/search)':
+        ('SELECT * FROM users WHERE id IN (:a, :b)', {'a': 1, 'b': 2}),
+    'tap batch dedup (/api/tap)':
+        ('SELECT id FROM tap_batches WHERE user_id = :id AND seq = :seq', {'id': 1, 'seq': 1}),
+    'latest tap batch (/api/tap, once per user)':
+        ('SELECT max(seq) FROM tap_batches WHERE user_id = :id', {'id': 1}),
+    'windowed leaderboard (/api/leaderboard?window=week)':
+        ("SELECT user_id, sum(earned) AS total FROM earning_buckets WHERE granularity = 'day' "
+         'AND bucket_start >= :first AND bucket_start <= :last GROUP BY user_id ORDER BY total DESC LIMIT 10',
+         {'first': '2030-01-01 00:00:00', 'last': '2030-01-07 00:00:00'}),
+    'energy checkpoint (/api/tap)':
+        ('SELECT * FROM energy_states WHERE telegram_id = :id', {'id': 1}),
+    'due notifications (bot notification queue)':
+        ('SELECT id, chat_id, text, attempts FROM outbound_notifications WHERE next_attempt_at <= :now '
+         'ORDER BY next_attempt_at, id LIMIT 1000', {'now': '2030-01-01 00:00:00'}),
+}
+
+
+def is_sqlite_table_scan(step):
+    # "SCAN t USING INDEX ..." walks an index in order, a virtual table answers MATCH
+    # from its own index and a subquery's rows are already bounded; a bare "SCAN t"
+    # reads the table
+    if not step.startswith('SCAN ') or step.startswith('SCAN (subquery'):
+        return False
+    return ' USING ' not in step and ' VIRTUAL TABLE ' not in step
+
+
+def explain_hot_queries(engine):
+    """Return (name, plan, full_scan) for every query in HOT_QUERIES"""
+    results = []
+    with engine.connect() as conn:
+        for name, (sql, params) in HOT_QUERIES.items():
+            if isinstance(sql, dict):
+                sql = sql[engine.dialect.name]
+            if engine.dialect.name == 'sqlite':
+                rows = conn.execute(text(f'EXPLAIN QUERY PLAN {sql}'), params).all()
+                plan = [row[-1] for row in rows]
+                full_scan = any(is_sqlite_table_scan(step) for step in plan)
+            else:
+                plan = [row[0] for row in conn.execute(text(f'EXPLAIN {sql}'), params)]
+                full_scan = any('Seq Scan' in step for step in plan)
+            results.append((name, plan, full_scan))
+    return results
+
+
+def main(argv):
+    from database import Database
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    command = argv[1] if len(argv) > 1 else 'upgrade'
+    db = Database()  # Applies pending migrations
+
+    if command == 'upgrade':
+        with db.engine.connect() as conn:
+            print(f'Schema version {current_version(conn)}')
+    elif command == 'status':
+        with db.engine.connect() as conn:
+            applied = set(conn.execute(select(schema_version.c.version)).scalars())
+        for version, description, _ in MIGRATIONS:
+            print(f"{version:>4} {'applied' if version in applied else 'pending':<8} {description}")
+    elif command == 'explain':
+        scans = 0
+        for name, plan, full_scan in explain_hot_queries(db.engine):
+            scans += full_scan
+            print(f"{'SCAN' if full_scan else 'ok':<5} {name}")
+            for step in plan:
+                print(f'        {step}')
+        return 1 if scans else 0
+    else:
+        print(__doc__)
+        return 2
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
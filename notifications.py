@@ -0,0 +1,261 @@
+"""Outbound bot messages, queued in the database and sent at Telegram's pace.
+
+Handlers call NotificationQueue.notify() instead of bot.send_message(): the
+message is written to outbound_notifications and a background task sends
+it, so a slow or rate limited Bot API never holds up an update. The sender
+
+- keeps to a per-chat and a global token bucket (by default one message a
+  second per chat and 25 a second overall, under Telegram's flood limits),
+- joins messages for the same chat that are due together into one message,
+  so a burst of events (NOTIFY_COALESCE_SECONDS apart, or piled up while
+  the chat was rate limited) costs a single send,
+- on a 429 pauses all sending for the retry_after Telegram asked for and
+  queues the messages again,
+- retries other failures with exponential backoff and drops a message after
+  MAX_ATTEMPTS of them; messages to chats that blocked the bot or don't
+  exist are dropped at once.
+
+Queued messages survive restarts. A message leaves the table only once
+Telegram has accepted it, so a crash mid-send can deliver it twice but
+never loses it.
+"""
+import asyncio
+import logging
+import os
+import time
+
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+from rendering import MESSAGE_LIMIT, chunk_message, message_length
+
+logger = logging.getLogger(__name__)
+
+PER_CHAT_RATE = float(os.environ.get('NOTIFY_PER_CHAT_RATE', 1.0))  # Messages per second to one chat
+GLOBAL_RATE = float(os.environ.get('NOTIFY_GLOBAL_RATE', 25.0))  # Messages per second overall
+COALESCE_SECONDS = float(os.environ.get('NOTIFY_COALESCE_SECONDS', 1.0))  # Wait for more events per chat
+MAX_ATTEMPTS = 8
+BACKOFF_SECONDS = 2.0  # Doubled after every failed attempt
+MAX_BACKOFF_SECONDS = 600.0
+IDLE_POLL_SECONDS = 5.0  # Picks up messages queued by other processes
+SEPARATOR = '\n\n'
+
+
+class TokenBucket:
+    """`rate` tokens a second, holding at most `capacity`"""
+
+    def __init__(self, rate, capacity=1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """Seconds until a token is available"""
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self):
+        while (wait := self.delay()) > 0:
+            await asyncio.sleep(wait)
+        self.tokens -= 1
+
+
+def coalesce(rows, limit=MESSAGE_LIMIT):
+    """Join a chat's queued rows, oldest first, into [(ids, text)] messages under `limit`"""
+    messages = []
+    ids, texts, size = [], [], 0
+    for row in rows:
+        length = message_length(row.text)
+        if texts and size + message_length(SEPARATOR) + length > limit:
+            messages.append((ids, SEPARATOR.join(texts)))
+            ids, texts, size = [], [], 0
+        if texts:
+            size += message_length(SEPARATOR)
+        ids.append(row.id)
+        texts.append(row.text)
+        size += length
+    if texts:
+        messages.append((ids, SEPARATOR.join(texts)))
+    return messages
+
+
+class NotificationQueue:
+    def __init__(self, db, run=asyncio.to_thread, per_chat_rate=PER_CHAT_RATE, global_rate=GLOBAL_RATE,
+                 coalesce_seconds=COALESCE_SECONDS, batch_size=1000, max_in_flight=100):
+        self.db = db
+        self.run = run  # Runs a blocking database call off the event loop
+        self.per_chat_rate = per_chat_rate
+        self.coalesce_seconds = coalesce_seconds
+        self.batch_size = batch_size  # Queued rows read per pass
+        self.max_in_flight = max_in_flight  # Chats being sent to at once
+        self.global_bucket = TokenBucket(global_rate)
+        self.bot = None
+        self._chats = {}  # chat_id -> TokenBucket
+        self._in_flight = {}  # chat_id -> sending task
+        self._finished = set()  # Chats whose sender finished during the current read
+        self._held_back = False  # Due rows were skipped because their chat was busy
+        self._paused_until = 0.0
+        self._next_due = 0.0
+        self._wake = None
+        self._task = None
+        self.queued = 0
+        self.sent = 0  # Messages accepted by Telegram
+        self.delivered = 0  # Notifications in them
+        self.rate_limited = 0
+        self.retried = 0
+        self.dropped = 0
+
+    async def notify(self, chat_id, text):
+        """Queue a message to `chat_id`"""
+        await self.notify_many([(chat_id, text)])
+
+    async def notify_many(self, messages):
+        """Queue (chat_id, text) messages in one write"""
+        if not messages:
+            return
+        await self.run(self.db.queue_notifications, messages, self.coalesce_seconds)
+        self.queued += len(messages)
+        self._due_at(time.monotonic() + self.coalesce_seconds)
+
+    def start(self, bot):
+        """Start sending queued messages, including any left from a previous run"""
+        self.bot = bot
+        self._wake = asyncio.Event()
+        self._next_due = 0.0
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop sending; unsent messages stay queued for the next start"""
+        if self._task is None:
+            return
+        tasks = [self._task, *self._in_flight.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+
+    def stats(self):
+        return {
+            'queued': self.queued,
+            'sent': self.sent,
+            'delivered': self.delivered,
+            'rate_limited': self.rate_limited,
+            'retried': self.retried,
+            'dropped': self.dropped,
+            'in_flight': len(self._in_flight),
+        }
+
+    def _due_at(self, at):
+        if at < self._next_due:
+            self._next_due = at
+            if self._wake is not None:
+                self._wake.set()
+
+    async def _run(self):
+        while True:
+            wait = self._next_due - time.monotonic()
+            if wait > 0:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self._next_due = time.monotonic() + IDLE_POLL_SECONDS
+            try:
+                await self._dispatch()
+            except Exception:
+                logger.exception('Reading the notification queue failed')
+                self._due_at(time.monotonic() + 1)
+
+    async def _dispatch(self):
+        """Start a sender for every chat with due messages that can take one now"""
+        self._finished.clear()
+        rows = await self.run(self.db.due_notifications, self.batch_size)
+        if len(rows) == self.batch_size:
+            # More are due than were read; read again once these are sent
+            self._held_back = True
+        chats = {}
+        for row in rows:
+            chats.setdefault(row.chat_id, []).append(row)
+        for chat_id, chat_rows in chats.items():
+            if chat_id in self._finished:
+                # Its sender finished during the read and may have deleted some of these rows
+                self._due_at(time.monotonic())
+                continue
+            if chat_id in self._in_flight or len(self._in_flight) >= self.max_in_flight:
+                self._held_back = True
+                continue
+            bucket = self._chats.setdefault(chat_id, TokenBucket(self.per_chat_rate))
+            wait = bucket.delay()
+            if wait > 0:
+                # Let more messages for this chat pile up until it may be sent to
+                self._due_at(time.monotonic() + wait)
+                continue
+            chat_rows.sort(key=lambda row: row.id)
+            self._in_flight[chat_id] = asyncio.create_task(self._send(chat_id, chat_rows, bucket))
+        if len(self._chats) > 10 * self.batch_size:
+            self._chats = {chat_id: bucket for chat_id, bucket in self._chats.items()
+                           if chat_id in self._in_flight or not bucket.full()}
+
+    async def _send(self, chat_id, rows, bucket):
+        pending = rows
+        try:
+            for ids, text in coalesce(rows):
+                for chunk in chunk_message([text]):
+                    await bucket.acquire()
+                    while (pause := self._paused_until - time.monotonic()) > 0:
+                        await asyncio.sleep(pause)
+                    await self.global_bucket.acquire()
+                    await self.bot.send_message(chat_id=chat_id, text=chunk)
+                    self.sent += 1
+                await self.run(self.db.delete_notifications, ids)
+                self.delivered += len(ids)
+                pending = pending[len(ids):]
+        except RetryAfter as e:
+            self.rate_limited += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+            await self._retry(pending, e.retry_after, failed=False)
+        except (Forbidden, BadRequest) as e:
+            logger.warning('Dropping %d notifications to chat %s: %s', len(pending), chat_id, e)
+            await self._drop(pending)
+        except Exception as e:
+            attempts = max(row.attempts for row in pending) + 1
+            if attempts >= MAX_ATTEMPTS:
+                logger.error('Dropping %d notifications to chat %s after %d attempts: %s',
+                             len(pending), chat_id, attempts, e)
+                await self._drop(pending)
+            else:
+                logger.warning('Sending to chat %s failed, retrying: %s', chat_id, e)
+                await self._retry(pending, min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2 ** (attempts - 1)))
+        finally:
+            del self._in_flight[chat_id]
+            self._finished.add(chat_id)
+            if self._held_back:
+                self._held_back = False
+                self._due_at(time.monotonic())
+
+    async def _retry(self, rows, delay, failed=True):
+        try:
+            await self.run(self.db.retry_notifications, [row.id for row in rows], delay, failed)
+        except Exception:
+            # Still due, so they are picked up again on the next pass
+            logger.exception('Rescheduling %d notifications failed', len(rows))
+        self.retried += len(rows)
+        self._due_at(time.monotonic() + delay)
+
+    async def _drop(self, rows):
+        try:
+            await self.run(self.db.delete_notifications, [row.id for row in rows])
+        except Exception:
+            logger.exception('Dropping %d notifications failed', len(rows))
+        self.dropped += len(rows)
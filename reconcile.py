@@ -0,0 +1,217 @@
+"""Incremental check that every balance equals its ledger.
+
+users.coins is updated in the same transaction as the ledger entry that
+explains it, so coins should always equal the user's sum of
+transactions.amount. The reconciler verifies that without summing the whole
+ledger on every run: each user has a checkpoint (the ledger sum up to a
+transaction id), and a run only reads ledger rows after the last run's
+watermark, adds them to the checkpoints of the users they touch and compares
+the result with those users' balances. Drift is logged and, with --repair,
+corrected by moving the balance to the ledger value (the ledger is the
+source of truth). A repair writes two ADJUSTMENT_TYPE ledger rows, the
+unrecorded change and its reversal, so the ledger keeps explaining every
+balance change and other processes pick the new balance up from it.
+
+An incremental run only checks users with new ledger rows; a --full run
+re-sums the whole ledger and checks every user. Run it on a schedule, e.g.
+incrementally every few minutes and in full weekly:
+    python reconcile.py [--repair] [--full] [--every SECONDS]
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from datetime import datetime
+
+from sqlalchemy import BigInteger, func, or_, select, type_coerce
+
+from database import (
+    ADJUSTMENT_TYPE, COIN_SCALE, BalanceCheckpoint, LedgerWatermark, Transaction, User, increment_balances,
+    upsert, write_ledger
+)
+
+logger = logging.getLogger(__name__)
+
+WATERMARK = 'reconcile'
+SETTLE_SECONDS = float(os.environ.get('RECONCILE_SETTLE_SECONDS', 5))
+
+
+def minor_units(column):
+    # Read coin columns as the stored integers, so sums are compared exactly
+    return type_coerce(column, BigInteger)
+
+
+class Reconciler:
+    def __init__(self, db, repair=False, chunk_size=200000, batch_size=500, settle=SETTLE_SECONDS):
+        self.db = db
+        self.repair = repair
+        self.chunk_size = chunk_size  # Ledger ids aggregated per query
+        self.batch_size = batch_size  # Users verified per transaction
+        self.settle = settle  # Wait for writes holding lower ids to commit
+
+    def run(self, full=False):
+        """Verify balances against the ledger; returns a summary dict.
+
+        `drift` lists (user_id, balance, ledger_balance) for every mismatch.
+        """
+        started = time.perf_counter()
+        mark = 0 if full else (self.db.get_watermark(WATERMARK) or 0)
+        session = self.db.get_session()
+        try:
+            upto = session.query(func.max(Transaction.id)).scalar() or 0
+        finally:
+            session.close()
+        if upto > mark and self.settle:
+            time.sleep(self.settle)
+
+        totals = self._ledger_totals(mark, upto, full)
+        report = {
+            'from_txn': mark,
+            'to_txn': upto,
+            'rows': sum(count for _, _, count in totals.values()),
+            'users': 0,
+            'drift': [],
+            'repaired': 0,
+        }
+        for user_ids in self._batches(totals, full):
+            self._verify(user_ids, totals, upto, full, report)
+
+        session = self.db.get_session()
+        try:
+            upsert(session, LedgerWatermark, [{'name': WATERMARK, 'txn_id': upto, 'updated_at': datetime.utcnow()}],
+                   index_elements=['name'])
+            session.commit()
+        finally:
+            session.close()
+        report['seconds'] = round(time.perf_counter() - started, 3)
+        return report
+
+    def _ledger_totals(self, mark, upto, full):
+        """{user_id: [amount, last_txn_id, rows]} of ledger rows in (mark, upto]"""
+        amount = func.sum(minor_units(Transaction.amount))
+        totals = {}
+        session = self.db.get_session()
+        try:
+            for low in range(mark, upto, self.chunk_size):
+                high = min(low + self.chunk_size, upto)
+                query = (
+                    select(Transaction.user_id, amount, func.max(Transaction.id), func.count())
+                    .where(Transaction.id > low, Transaction.id <= high)
+                    .group_by(Transaction.user_id)
+                )
+                if not full:
+                    # Skip rows an interrupted run already added to the checkpoint
+                    query = query.outerjoin(
+                        BalanceCheckpoint, BalanceCheckpoint.user_id == Transaction.user_id
+                    ).where(or_(
+                        BalanceCheckpoint.last_txn_id.is_(None),
+                        Transaction.id > BalanceCheckpoint.last_txn_id
+                    ))
+                for user_id, total, last_txn_id, count in session.execute(query):
+                    entry = totals.setdefault(user_id, [0, 0, 0])
+                    entry[0] += total
+                    entry[1] = last_txn_id
+                    entry[2] += count
+        finally:
+            session.close()
+        return totals
+
+    def _batches(self, totals, full):
+        if not full:
+            user_ids = sorted(totals)
+            for i in range(0, len(user_ids), self.batch_size):
+                yield user_ids[i:i + self.batch_size]
+            return
+        # Users without any ledger rows must have a zero balance too
+        last = 0
+        while True:
+            session = self.db.get_session()
+            try:
+                user_ids = session.execute(
+                    select(User.id).where(User.id > last).order_by(User.id).limit(self.batch_size)
+                ).scalars().all()
+            finally:
+                session.close()
+            if not user_ids:
+                return
+            yield user_ids
+            last = user_ids[-1]
+
+    def _verify(self, user_ids, totals, upto, full, report):
+        # Ledger rows after `upto` are already in coins; one statement reads
+        # both so they come from the same snapshot
+        newer = (
+            select(func.coalesce(func.sum(minor_units(Transaction.amount)), 0))
+            .where(Transaction.user_id == User.id, Transaction.id > upto)
+            .scalar_subquery()
+        )
+        session = self.db.get_session()
+        try:
+            rows = session.execute(
+                select(User.id, minor_units(User.coins), newer,
+                       minor_units(BalanceCheckpoint.balance), BalanceCheckpoint.last_txn_id)
+                .outerjoin(BalanceCheckpoint, BalanceCheckpoint.user_id == User.id)
+                .where(User.id.in_(user_ids))
+            ).all()
+            checkpoints = []
+            corrections = {}
+            for user_id, coins, newer_amount, checkpoint, last_txn_id in rows:
+                amount, last_seen, _ = totals.get(user_id, (0, 0, 0))
+                if full or checkpoint is None:
+                    checkpoint, last_txn_id = 0, 0
+                expected = checkpoint + amount
+                actual = (coins or 0) - newer_amount
+                if actual != expected:
+                    report['drift'].append((user_id, actual / COIN_SCALE, expected / COIN_SCALE))
+                    logger.warning('User %s balance %s != ledger %s', user_id,
+                                   actual / COIN_SCALE, expected / COIN_SCALE)
+                    corrections[user_id] = (expected - actual) / COIN_SCALE
+                checkpoints.append({
+                    'user_id': user_id,
+                    'last_txn_id': max(last_txn_id or 0, last_seen),
+                    'balance': expected / COIN_SCALE,
+                    'verified_at': datetime.utcnow(),
+                })
+            upsert(session, BalanceCheckpoint, checkpoints, index_elements=['user_id'])
+            balances = {}
+            if self.repair and corrections:
+                # Relative update, so writes since the read above are kept
+                balances = increment_balances(session, corrections)
+                stamp = write_ledger(session, [
+                    entry for user_id, amount in corrections.items() if user_id in balances
+                    for entry in ((user_id, -amount, ADJUSTMENT_TYPE, 'Balance change missing from the ledger'),
+                                  (user_id, amount, ADJUSTMENT_TYPE, 'Balance reset to the ledger'))
+                ])
+            session.commit()
+            report['users'] += len(rows)
+            if balances:
+                report['repaired'] += len(balances)
+                self.db.balance_changed(balances, stamp)
+        finally:
+            session.close()
+
+
+def main(argv):
+    from database import Database
+
+    parser = argparse.ArgumentParser(description='Balance reconciliation')
+    parser.add_argument('--repair', action='store_true', help='set drifted balances to their ledger value')
+    parser.add_argument('--full', action='store_true', help='re-sum the whole ledger and check every user')
+    parser.add_argument('--every', type=float, default=0, help='repeat every N seconds')
+    args = parser.parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    reconciler = Reconciler(Database(), repair=args.repair)
+    while True:
+        report = reconciler.run(full=args.full)
+        print(f"Ledger {report['from_txn']}..{report['to_txn']}: {report['rows']} rows, "
+              f"{report['users']} users checked, {len(report['drift'])} drifted, "
+              f"{report['repaired']} repaired in {report['seconds']}s")
+        if not args.every:
+            return 1 if len(report['drift']) > report['repaired'] else 0
+        time.sleep(args.every)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
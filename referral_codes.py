@@ -0,0 +1,125 @@
+"""Referral codes that decode to a user id without touching the database.
+
+A code is the user id run through a keyed 32-bit Feistel permutation (so
+consecutive users get unrelated codes and ids can't be enumerated), followed
+by an 18-bit checksum, written as 10 Crockford base32 characters. Decoding
+is pure computation and a mistyped or made-up code fails the checksum, all
+but one in 262144 of them.
+
+Codes of other lengths (random ones from before, and the 8 character codes
+with an 8-bit checksum that came first) still resolve through a bounded
+in-memory cache in front of a single-column lookup. Misses are cached too,
+since those codes are never created again.
+
+REFERRAL_CODE_SECRET keys the permutation and must never change once codes
+have been handed out. The built-in default is public, so servers call
+require_secret() at startup once they can hand codes out to users.
+"""
+import functools
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'  # Crockford base32
+CODE_LENGTH = 10  # 32-bit id + 18-bit checksum
+CHECKSUM_BITS = 18
+ROUNDS = 4
+DEFAULT_SECRET = 'tap-tap-referral'
+
+_DECODE = {char: value for value, char in enumerate(ALPHABET)}
+_DECODE.update({'O': 0, 'I': 1, 'L': 1})  # Crockford's commonly confused letters
+
+
+@functools.lru_cache(maxsize=None)
+def _key():
+    # Read on first use, after the entry point has loaded .env
+    secret = os.environ.get('REFERRAL_CODE_SECRET') or DEFAULT_SECRET
+    return hashlib.blake2b(secret.encode(), digest_size=32).digest()
+
+
+def _round(half, i):
+    digest = hashlib.blake2b(half.to_bytes(2, 'big'), digest_size=2, key=_key(), person=bytes([i]) * 16).digest()
+    return int.from_bytes(digest, 'big')
+
+
+def _checksum(value):
+    digest = hashlib.blake2b(value.to_bytes(4, 'big'), digest_size=3, key=_key()).digest()
+    return int.from_bytes(digest, 'big') >> (24 - CHECKSUM_BITS)
+
+
+def require_secret():
+    """Raise unless REFERRAL_CODE_SECRET is set; anyone could forge codes under the default"""
+    if not os.environ.get('REFERRAL_CODE_SECRET'):
+        raise RuntimeError('REFERRAL_CODE_SECRET is not set; set it to a random value and never change it')
+
+
+def encode(user_id):
+    """The referral code of a user id (1 to 2**32 - 1)"""
+    left, right = user_id >> 16, user_id & 0xFFFF
+    for i in range(ROUNDS):
+        left, right = right, left ^ _round(right, i)
+    value = left << 16 | right
+    number = value << CHECKSUM_BITS | _checksum(value)
+    return ''.join(ALPHABET[(number >> shift) & 31] for shift in range(5 * CODE_LENGTH - 5, -1, -5))
+
+
+def decode(code):
+    """The user id a code was made for, or None if it isn't a valid code"""
+    if len(code) != CODE_LENGTH:
+        return None
+    number = 0
+    for char in code.upper():
+        if char not in _DECODE:
+            return None
+        number = number << 5 | _DECODE[char]
+    value, check = number >> CHECKSUM_BITS, number & ((1 << CHECKSUM_BITS) - 1)
+    if value >> 32 or _checksum(value) != check:
+        return None
+    left, right = value >> 16, value & 0xFFFF
+    for i in reversed(range(ROUNDS)):
+        left, right = right ^ _round(left, i), left
+    return left << 16 | right
+
+
+class ReferralCodes:
+    """Resolves referral codes to user ids, computing new codes and caching legacy ones"""
+
+    def __init__(self, lookup, max_size=100000):
+        self.lookup = lookup  # legacy code -> user id or None, e.g. a database query
+        self.max_size = max_size
+        self._legacy = OrderedDict()
+        self._lock = threading.Lock()
+        self.decoded = 0
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, code):
+        """The user id behind a code, or None if no user has it"""
+        if len(code) == CODE_LENGTH:
+            # Older codes have other lengths, so this is a current code or none at all
+            user_id = decode(code)
+            with self._lock:
+                self.decoded += 1
+            return user_id
+        with self._lock:
+            if code in self._legacy:
+                self._legacy.move_to_end(code)
+                self.hits += 1
+                return self._legacy[code]
+            self.misses += 1
+        user_id = self.lookup(code)
+        with self._lock:
+            self._legacy[code] = user_id
+            while len(self._legacy) > self.max_size:
+                self._legacy.popitem(last=False)
+        return user_id
+
+    def stats(self):
+        with self._lock:
+            return {
+                'decoded': self.decoded,
+                'legacy_size': len(self._legacy),
+                'legacy_hits': self.hits,
+                'legacy_misses': self.misses,
+            }
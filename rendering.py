@@ -0,0 +1,121 @@
+"""Message rendering for the bot's list views.
+
+Every task, ledger entry and leaderboard is rendered once and the text is
+kept in a bounded cache next to a version of what it was rendered from (the
+displayed fields, for a leaderboard those of its shown rows), so repeated
+/my_tasks, /available_tasks, /transactions and /leaderboard commands only
+join cached fragments. A fragment is rendered again as soon as its version
+changes. Lists are split into messages under Telegram's 4096 character
+limit.
+"""
+from collections import OrderedDict
+
+MESSAGE_LIMIT = 4096
+MEDALS = {1: "🥇", 2: "🥈", 3: "🥉"}
+
+
+class FragmentCache:
+    """LRU cache of rendered text by key, valid while the version matches"""
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._entries = OrderedDict()  # key -> (version, text)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version, render):
+        """Cached text for key, or render() if missing or rendered from another version"""
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == version:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        text = render()
+        self._entries[key] = (version, text)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return text
+
+
+fragments = FragmentCache()
+
+
+def task_fragment(task, show_created=False):
+    # created_at never changes, the other displayed fields can
+    version = (task.title, task.description, task.reward_coins)
+    return fragments.get(('task', task.id, show_created), version, lambda: ''.join([
+        f"🆔 Task ID: {task.id}\n",
+        f"📝 Title: {task.title}\n",
+        f"📄 Description: {task.description}\n",
+        f"💰 Reward: {task.reward_coins} coins\n",
+        f"📅 Created: {task.created_at.strftime('%Y-%m-%d %H:%M')}\n" if show_created else "",
+        "\n",
+    ]))
+
+
+def transaction_fragment(txn):
+    # Archived rows share their id with the summary row that replaced them
+    version = (txn.transaction_type, txn.amount)
+    return fragments.get(('transaction', txn.id), version, lambda: ''.join([
+        f"{'+' if txn.amount > 0 else ''}{txn.amount} coins - {txn.transaction_type}\n",
+        f"   {txn.description}\n" if txn.description else "",
+        f"   {txn.created_at.strftime('%Y-%m-%d %H:%M')}\n\n",
+    ]))
+
+
+def leaderboard_text(title, top):
+    """Text of a [(user, coins)] ranking"""
+    lines = [f"{title}\n"]
+    for i, (user, coins) in enumerate(top, 1):
+        name = user.first_name or user.username or f"User {user.telegram_id}"
+        lines.append(f"{MEDALS.get(i, f'{i}.')} {name}: {coins} coins")
+    return '\n'.join(lines) + '\n'
+
+
+def message_length(text):
+    # Telegram counts UTF-16 code units, emoji outside the BMP count twice
+    return len(text.encode('utf-16-le')) // 2
+
+
+def chunk_message(blocks, header='', footer='', limit=MESSAGE_LIMIT):
+    """Join text blocks into as few messages under `limit` characters as possible.
+
+    The header starts the first message and the footer ends the last one.
+    Blocks are never split unless a single block is too long on its own.
+    """
+    chunks = []
+    current = [header] if header else []
+    size = message_length(header)
+    for block in blocks + ([footer] if footer else []):
+        length = message_length(block)
+        while length > limit:
+            # An oversized block gets messages of its own
+            if current:
+                chunks.append(''.join(current))
+                current, size = [], 0
+            cut = limit
+            while message_length(block[:cut]) > limit:
+                cut -= message_length(block[:cut]) - limit
+            chunks.append(block[:cut])
+            block = block[cut:]
+            length = message_length(block)
+        if not block:
+            continue
+        if size + length > limit:
+            chunks.append(''.join(current))
+            current, size = [], 0
+        current.append(block)
+        size += length
+    if current:
+        chunks.append(''.join(current))
+    return chunks
+
+
+def render_task_list(title, tasks, footer='', show_created=False):
+    return chunk_message([task_fragment(task, show_created) for task in tasks], header=title, footer=footer)
+
+
+def render_transactions(transactions):
+    return chunk_message([transaction_fragment(txn) for txn in transactions], header="📊 Recent Transactions:\n\n")
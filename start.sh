@@ -1,7 +1,7 @@
 #!/bin/bash
 
 # Start script for Tap Tap Task Game
-# This script starts both the Flask web server and Telegram bot
+# This script starts the web server and Telegram bot in one process
 
 echo "🚀 Starting Tap Tap Task Game..."
 echo ""
@@ -13,27 +13,17 @@ if [ ! -f .env ]; then
     exit 1
 fi
 
-# Start Flask app in background
-echo "📱 Starting Flask web server..."
-python3 app.py &
-FLASK_PID=$!
-
-# Wait a moment for Flask to start
-sleep 2
-
-# Start Telegram bot
-echo "🤖 Starting Telegram bot..."
-python3 bot.py &
-BOT_PID=$!
+# Start the web server; it also runs the bot when TELEGRAM_BOT_TOKEN is set
+echo "📱 Starting web server and Telegram bot..."
+python3 asgi.py &
+SERVER_PID=$!
 
 echo ""
 echo "✅ Services started!"
-echo "   Flask server PID: $FLASK_PID"
-echo "   Bot PID: $BOT_PID"
+echo "   Server PID: $SERVER_PID"
 echo ""
 echo "Press Ctrl+C to stop all services"
 
 # Wait for user interrupt
-trap "kill $FLASK_PID $BOT_PID 2>/dev/null; exit" INT TERM
+trap "kill $SERVER_PID 2>/dev/null; exit" INT TERM
 wait
-
@@ -0,0 +1,229 @@
+"""Write-behind buffer for tap credits.
+
+Tap batches accepted by /api/tap are summed per user in memory and written to
+the database in one bulk transaction every flush interval, or sooner once
+enough batches are pending. Each batch is appended to a spill file before it
+is acknowledged, so batches that were accepted but not yet flushed survive a
+crash: spill files are replayed on startup, and the unique (user_id, seq) key
+on tap_batches keeps a replay from crediting anything twice.
+
+A batch is a duplicate if it is pending, being flushed, among the last
+`recent_size` flushed, or already in tap_batches. Client sequence numbers
+only grow, so the highest seq seen per user is kept (read from tap_batches
+the first time a user taps in this process): a batch above it is new, and
+only one at or below it, a retry of a batch flushed long ago or sent from
+another device, is looked up in tap_batches before it is acknowledged.
+"""
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class TapAccumulator:
+    def __init__(self, db, spill_path='tap_spill.log', flush_interval_ms=500,
+                 max_entries=1000, fsync=False, recent_size=10000, seq_cache_size=100000):
+        self.db = db
+        self.spill_path = spill_path
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.max_entries = max_entries
+        self.fsync = fsync
+        self.recent_size = recent_size
+        self.seq_cache_size = seq_cache_size  # Users whose highest seq is kept
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = []
+        self._pending_keys = set()
+        self._pending_coins = defaultdict(float)
+        self._inflight_keys = set()
+        self._inflight_coins = defaultdict(float)
+        self._recent_keys = OrderedDict()  # Recently flushed (user_id, seq) pairs
+        self._latest_seqs = OrderedDict()  # user_id -> highest seq accepted or applied
+        self._carried_files = []  # Spill files of batches that failed to flush
+        self._spill_counter = 0
+        self._spill = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Replay leftover spill files, then start the background flusher"""
+        self.replay()
+        self._spill = open(self.spill_path, 'a', encoding='utf-8')
+        self._thread = threading.Thread(target=self._run, name='tap-flusher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the flusher and write out everything still pending"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+        with self._lock:
+            if self._spill:
+                self._spill.close()
+                self._spill = None
+
+    def add(self, user_id, seq, taps, amount, window_start=None, window_end=None):
+        """Accept a tap batch; returns False if it is a known duplicate"""
+        key = (user_id, seq)
+        entry = {
+            'user_id': user_id,
+            'seq': seq,
+            'taps': taps,
+            'amount': amount,
+            'window_start': window_start.isoformat() if window_start else None,
+            'window_end': window_end.isoformat() if window_end else None
+        }
+        with self._lock:
+            if self._seen(key):
+                return False
+            latest = self._latest_seqs.get(user_id)
+        # Lookups run outside the lock, so they never hold up other users' taps
+        if latest is None:
+            latest = self.db.latest_tap_seq(user_id)
+        if seq <= latest and self.db.tap_batch_applied(user_id, seq):
+            with self._lock:
+                self._remember(key)
+                self._raise_latest(user_id, latest)
+            return False
+        with self._lock:
+            # A concurrent retry of the same batch may have been accepted meanwhile
+            if self._seen(key):
+                return False
+            self._spill.write(json.dumps(entry) + '\n')
+            self._spill.flush()
+            if self.fsync:
+                os.fsync(self._spill.fileno())
+            self._pending.append(entry)
+            self._pending_keys.add(key)
+            self._pending_coins[user_id] += amount
+            self._raise_latest(user_id, max(seq, latest))
+            if len(self._pending) >= self.max_entries:
+                self._wake.set()
+        return True
+
+    def pending_coins(self, user_id):
+        """Coins accepted for a user that are not yet committed"""
+        with self._lock:
+            return self._pending_coins.get(user_id, 0.0) + self._inflight_coins.get(user_id, 0.0)
+
+    def flush(self):
+        """Write all pending batches to the database in one transaction"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                entries = self._pending
+                self._pending = []
+                self._inflight_keys |= self._pending_keys
+                self._pending_keys = set()
+                for user_id, coins in self._pending_coins.items():
+                    self._inflight_coins[user_id] += coins
+                self._pending_coins = defaultdict(float)
+                files = self._carried_files + self._rotate_spill()
+                self._carried_files = []
+
+            try:
+                applied = self.db.apply_tap_batches([_decode(e) for e in entries])
+            except Exception:
+                logger.exception('Tap flush failed, %d batches will be retried', len(entries))
+                with self._lock:
+                    self._pending = entries + self._pending
+                    for e in entries:
+                        self._inflight_keys.discard((e['user_id'], e['seq']))
+                        self._pending_keys.add((e['user_id'], e['seq']))
+                        self._pending_coins[e['user_id']] += e['amount']
+                    self._release_inflight(entries)
+                    self._carried_files = files
+                return 0
+
+            with self._lock:
+                self._release_inflight(entries)
+                for e in entries:
+                    self._inflight_keys.discard((e['user_id'], e['seq']))
+                    self._remember((e['user_id'], e['seq']))
+            for path in files:
+                os.remove(path)
+            return applied
+
+    def replay(self):
+        """Apply batches left behind in spill files by a previous run"""
+        paths = sorted(glob.glob(glob.escape(self.spill_path) + '.*.flushing'))
+        if os.path.exists(self.spill_path):
+            paths.append(self.spill_path)
+        entries = []
+        for path in paths:
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # Torn last line from a crash mid-write
+                        continue
+        if entries:
+            applied = self.db.apply_tap_batches([_decode(e) for e in entries])
+            logger.info('Replayed %d spilled tap batches (%d applied)', len(entries), applied)
+        for path in paths:
+            os.remove(path)
+
+    def _rotate_spill(self):
+        # Called with self._lock held
+        self._spill.close()
+        self._spill_counter += 1
+        flushing = f'{self.spill_path}.{int(time.time() * 1000)}-{self._spill_counter}.flushing'
+        os.replace(self.spill_path, flushing)
+        self._spill = open(self.spill_path, 'a', encoding='utf-8')
+        return [flushing]
+
+    def _seen(self, key):
+        # Called with self._lock held
+        return key in self._pending_keys or key in self._inflight_keys or key in self._recent_keys
+
+    def _remember(self, key):
+        # Called with self._lock held
+        self._recent_keys[key] = None
+        self._recent_keys.move_to_end(key)
+        while len(self._recent_keys) > self.recent_size:
+            self._recent_keys.popitem(last=False)
+
+    def _raise_latest(self, user_id, seq):
+        # Called with self._lock held
+        self._latest_seqs[user_id] = max(seq, self._latest_seqs.get(user_id, 0))
+        self._latest_seqs.move_to_end(user_id)
+        while len(self._latest_seqs) > self.seq_cache_size:
+            self._latest_seqs.popitem(last=False)
+
+    def _release_inflight(self, entries):
+        # Called with self._lock held
+        for e in entries:
+            remaining = self._inflight_coins[e['user_id']] - e['amount']
+            if remaining <= 1e-9:
+                self._inflight_coins.pop(e['user_id'], None)
+            else:
+                self._inflight_coins[e['user_id']] = remaining
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Unexpected error in tap flusher')
+
+
+def _decode(entry):
+    batch = dict(entry)
+    for key in ('window_start', 'window_end'):
+        if batch.get(key):
+            batch[key] = datetime.fromisoformat(batch[key])
+    return batch
@@ -0,0 +1,128 @@
+"""Verification of Telegram Mini App initData and sessions for later calls.
+
+Telegram signs initData with HMAC-SHA256 under a secret key that is itself
+HMAC-SHA256("WebAppData", bot token); the key is derived once, when
+TelegramAuth is created. initData is a URL-encoded query string: it is
+split and decoded with parse_qsl, the data-check-string is built from the
+decoded fields, and the hash is compared in constant time. initData older
+than INIT_DATA_MAX_AGE is rejected. Verified results are cached until
+then, keyed by the whole initData string (hash included), so the Mini App
+sending the same initData again costs a dict lookup and no parsing.
+
+A verified user gets a session token, "<telegram_id>.<expires>.<signature>",
+that later API calls send as "Authorization: Bearer <token>". Checking it is
+one HMAC, without parsing initData again. Tokens are short-lived; the Mini
+App gets a new one from its initData when a call is refused.
+"""
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qsl
+
+INIT_DATA_MAX_AGE = int(os.environ.get('INIT_DATA_MAX_AGE', 86400))  # Seconds, 0 to accept any age
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 900))  # Seconds a session token is valid
+JSON_FIELDS = ('user', 'receiver', 'chat')
+
+
+class InitDataError(ValueError):
+    """initData that is malformed, wrongly signed or too old"""
+
+
+def split_init_data(init_data):
+    """The fields of an initData string as URL-decoded strings"""
+    try:
+        return dict(parse_qsl(init_data, keep_blank_values=True, strict_parsing=True))
+    except ValueError as e:
+        raise InitDataError(f'malformed initData: {e}')
+
+
+def parse_init_data(init_data):
+    """The fields of an initData string, with user, receiver and chat decoded from JSON"""
+    return decode_fields(split_init_data(init_data))
+
+
+def decode_fields(fields):
+    fields = dict(fields)
+    for key in JSON_FIELDS:
+        if key in fields:
+            try:
+                fields[key] = json.loads(fields[key])
+            except ValueError:
+                raise InitDataError(f'{key} is not valid JSON')
+    return fields
+
+
+class TelegramAuth:
+    def __init__(self, bot_token, max_age=INIT_DATA_MAX_AGE, session_ttl=SESSION_TTL, cache_size=10000):
+        self.secret_key = hmac.new(b'WebAppData', bot_token.encode(), hashlib.sha256).digest()
+        # A separate key, so a session signature can never pass as an initData hash
+        self.session_key = hmac.new(b'Session', bot_token.encode(), hashlib.sha256).digest()
+        self.max_age = max_age
+        self.session_ttl = session_ttl
+        self.cache_size = cache_size
+        self._verified = OrderedDict()  # initData -> (fields, expires)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def verify(self, init_data, now=None):
+        """The fields of signed, fresh initData (see parse_init_data); raises InitDataError"""
+        now = time.time() if now is None else now
+        with self._lock:
+            cached = self._verified.get(init_data)
+            if cached is not None and now < cached[1]:
+                self._verified.move_to_end(init_data)
+                self.hits += 1
+                return cached[0]
+            self.misses += 1
+
+        pairs = split_init_data(init_data)
+        received = pairs.pop('hash', None)
+        if not received:
+            raise InitDataError('hash missing')
+
+        data_check_string = '\n'.join(f'{key}={value}' for key, value in sorted(pairs.items()))
+        expected = hmac.new(self.secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(expected.encode(), received.encode()):
+            raise InitDataError('hash mismatch')
+        try:
+            auth_date = int(pairs.get('auth_date', ''))
+        except ValueError:
+            raise InitDataError('auth_date missing')
+        expires = auth_date + self.max_age if self.max_age else float('inf')
+        if now >= expires:
+            raise InitDataError('initData expired')
+
+        fields = decode_fields(pairs)
+        with self._lock:
+            self._verified[init_data] = (fields, expires)
+            self._verified.move_to_end(init_data)
+            while len(self._verified) > self.cache_size:
+                self._verified.popitem(last=False)
+        return fields
+
+    def issue_session(self, telegram_id, now=None):
+        """A session token for a verified user"""
+        payload = f'{int(telegram_id)}.{int((time.time() if now is None else now) + self.session_ttl)}'
+        return f'{payload}.{self._sign(payload)}'
+
+    def session_telegram_id(self, token, now=None):
+        """The Telegram id a session token was issued to, or None if it is invalid or expired"""
+        payload, _, signature = token.rpartition('.')
+        if not hmac.compare_digest(self._sign(payload).encode(), signature.encode()):
+            return None
+        telegram_id, _, expires = payload.partition('.')
+        if (time.time() if now is None else now) >= int(expires):
+            return None
+        return int(telegram_id)
+
+    def _sign(self, payload):
+        return hmac.new(self.session_key, payload.encode(), hashlib.sha256).hexdigest()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._verified), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,42 @@
+import asyncio
+
+import httpx
+
+
+def get(api, path):
+    """GET `path` from the ASGI app"""
+    async def fetch():
+        transport = httpx.ASGITransport(app=api.asgi_app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            response = await client.get(path)
+        await api.adb.close()
+        return response
+    return asyncio.run(fetch())
+
+
+def test_window_leaderboard_amounts_are_numbers(api, user):
+    api.web.db.add_coins(user.id, 2.5, 'admin_grant')
+    for window in ('day', 'week', '24h'):
+        response = get(api, f'/api/leaderboard?window={window}')
+        assert response.status_code == 200
+        assert response.json()[0]['coins'] == 2.5
+        response = api.web.app.test_client().get(f'/api/leaderboard?window={window}')
+        assert response.get_json()[0]['coins'] == 2.5
+
+
+def test_transactions_rejects_bad_telegram_id(api, user):
+    for query in ('', '?telegram_id=abc', f'?telegram_id={10 ** 30}'):
+        assert get(api, f'/api/transactions{query}').status_code == 400
+        assert api.web.app.test_client().get(f'/api/transactions{query}').status_code == 400
+    response = get(api, f'/api/transactions?telegram_id={user.telegram_id}')
+    assert response.status_code == 200
+    assert response.json() == []
+
+
+def test_unserializable_response_is_an_error(api, monkeypatch):
+    async def broken(args):
+        return {'value': object()}, 200
+    monkeypatch.setitem(api.ROUTES, '/api/broken', broken)
+    response = get(api, '/api/broken')
+    assert response.status_code == 500
+    assert response.json() == {'error': 'Internal server error'}
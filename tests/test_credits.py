@@ -0,0 +1,63 @@
+"""Concurrent balance writers must never lose an update (see benchmarks.py credits)"""
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import func
+
+from database import Transaction, User
+
+USERS = 5
+THREADS = 8
+CREDITS = 50
+
+
+def credit_worker(db, seed, user_ids):
+    rng = random.Random(seed)
+    applied = {}
+    for i in range(CREDITS):
+        if i % 5 == 0:
+            credits = [(rng.choice(user_ids), rng.randint(1, 500) / 100, 'bonus', None) for _ in range(10)]
+            balances = db.credit_many(credits)
+            for user_id, amount, _, _ in credits:
+                if user_id in balances:
+                    applied[user_id] = applied.get(user_id, 0) + round(amount * 100)
+        else:
+            user_id, amount = rng.choice(user_ids), rng.randint(-200, 500) / 100
+            if db.add_coins(user_id, amount, 'tap_reward') is not None:
+                applied[user_id] = applied.get(user_id, 0) + round(amount * 100)
+    return applied
+
+
+def test_concurrent_credits_lose_no_updates(db):
+    user_ids = [db.get_or_create_user(telegram_id).id for telegram_id in range(1, USERS + 1)]
+    with ThreadPoolExecutor(THREADS) as pool:
+        results = list(pool.map(lambda seed: credit_worker(db, seed, user_ids), range(THREADS)))
+
+    expected = {}
+    for applied in results:
+        for user_id, cents in applied.items():
+            expected[user_id] = expected.get(user_id, 0) + cents
+    session = db.get_session()
+    try:
+        balances = dict(session.query(User.id, User.coins).all())
+        ledger = dict(session.query(Transaction.user_id, func.sum(Transaction.amount))
+                      .group_by(Transaction.user_id).all())
+    finally:
+        session.close()
+    assert {user_id: round(coins * 100) for user_id, coins in balances.items()} == \
+        {user_id: expected.get(user_id, 0) for user_id in user_ids}
+    assert {user_id: round(float(total) * 100) for user_id, total in ledger.items()} == expected
+    # The cached copies were kept in step too
+    for user_id in user_ids:
+        assert round(db.get_or_create_user(user_ids.index(user_id) + 1).coins * 100) == expected.get(user_id, 0)
+
+
+def test_late_balance_notification_is_dropped(db, user):
+    db.get_or_create_user(user.telegram_id)  # Cached
+    seen = []
+    db.balance_listeners.append(seen.append)
+    db.balance_changed({user.id: 7.0}, stamp=2)
+    # Committed before the change above, notified after it
+    db.balance_changed({user.id: 5.0}, stamp=1)
+    assert seen == [{user.id: 7.0}]
+    assert db.get_or_create_user(user.telegram_id).coins == 7.0
@@ -0,0 +1,60 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import update
+
+from database import EARNING_WINDOW_MAX_AGO, Transaction, User, earning_window
+from leaderboard import Leaderboard
+
+
+@pytest.mark.parametrize('window', ['day', 'week', '24h'])
+def test_ago_is_limited_to_retained_buckets(window):
+    now = datetime(2024, 1, 7, 23, 30)
+    earning_window(window, now, EARNING_WINDOW_MAX_AGO[window])
+    for ago in (-1, EARNING_WINDOW_MAX_AGO[window] + 1, 10 ** 30):
+        with pytest.raises(ValueError):
+            earning_window(window, now, ago)
+
+
+def test_window_cache_is_bounded(db, user):
+    db.add_coins(user.id, 5, 'admin_grant')
+    rankings = Leaderboard(db, window_cache_size=3)
+    for ago in range(10):
+        rankings.window_top('day', ago=ago)
+    assert len(rankings._windows) == 3
+    assert rankings.window_top('day')[0][1] == 5
+    with pytest.raises(ValueError):
+        rankings.window_top('day', ago=10 ** 30)
+    assert len(rankings._windows) == 3
+
+
+def commit_elsewhere(db, user_id, txn_id, coins):
+    """A ledger row and balance committed by another process, with an explicit id"""
+    session = db.get_session()
+    try:
+        session.add(Transaction(id=txn_id, user_id=user_id, amount=coins, transaction_type='admin_grant'))
+        session.execute(update(User).where(User.id == user_id).values(coins=coins))
+        session.commit()
+    finally:
+        session.close()
+
+
+def test_refresh_sees_lower_ids_committed_later(db, user):
+    other = db.get_or_create_user(2002, 'bob', 'Bob')
+    rankings = Leaderboard(db, settle=0)
+    rankings.load()
+    rankings.settle = 60
+    commit_elsewhere(db, user.id, 1000, 5)
+    rankings.refresh()
+    # Id 999 was handed out before 1000 but commits after the refresh read 1000
+    commit_elsewhere(db, other.id, 999, 7)
+    rankings.refresh()
+    assert [(u.id, u.coins) for u in rankings.top(2)] == [(other.id, 7), (user.id, 5)]
+
+
+def test_watermark_advances_once_settled(db, user):
+    rankings = Leaderboard(db, settle=0)
+    rankings.load()
+    db.add_coins(user.id, 5, 'admin_grant')
+    rankings.refresh()
+    assert rankings.refresh() == 0
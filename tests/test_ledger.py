@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, update
+
+from database import ADJUSTMENT_TYPE, LEDGER_SUMMARY_TYPE, Transaction, User
+from reconcile import Reconciler
+
+
+def ledger_sum(db, user_id):
+    session = db.get_session()
+    try:
+        # PostgreSQL sums the stored integers as numeric
+        return float(session.query(func.sum(Transaction.amount)).filter_by(user_id=user_id).scalar())
+    finally:
+        session.close()
+
+
+def test_every_balance_change_has_a_ledger_row(db, user):
+    db.add_coins(user.id, 10, 'admin_grant', 'Welcome')
+    db.credit_many([(user.id, 2.5, 'bonus', None), (user.id, -1.25, 'penalty', None)])
+    db.record_tap_batch(user.id, 1, taps=3, amount=0.3)
+    assert db.get_user(user.id).coins == 11.55
+    assert round(ledger_sum(db, user.id), 2) == 11.55
+    assert [t.transaction_type for t in db.get_transactions(user.id)] == ['tap_reward', 'penalty', 'bonus', 'admin_grant']
+
+
+def test_add_coins_unknown_user(db):
+    assert db.add_coins(999999, 1, 'admin_grant') is None
+    assert db.credit_many([(999999, 1, 'admin_grant', None)]) == {}
+
+
+def test_compaction_keeps_history(db, user):
+    for seq in range(1, 6):
+        db.record_tap_batch(user.id, seq, taps=1, amount=0.1)
+    old = datetime.utcnow() - timedelta(days=10)
+    session = db.get_session()
+    try:
+        session.execute(update(Transaction).values(created_at=old))
+        session.commit()
+    finally:
+        session.close()
+    before = db.get_transactions(user.id)
+
+    assert db.compact_ledger(datetime.utcnow() - timedelta(days=7)) == (5, 1)
+    session = db.get_session()
+    try:
+        assert [t.transaction_type for t in session.query(Transaction)] == [LEDGER_SUMMARY_TYPE]
+    finally:
+        session.close()
+    assert [(t.id, t.amount) for t in db.get_transactions(user.id)] == [(t.id, t.amount) for t in before]
+    assert round(ledger_sum(db, user.id), 2) == db.get_user(user.id).coins == 0.5
+
+
+def test_reconciler_finds_drift(db, user):
+    db.add_coins(user.id, 10, 'admin_grant')
+    reconciler = Reconciler(db, settle=0)
+    assert reconciler.run(full=True)['drift'] == []
+
+    session = db.get_session()
+    try:
+        session.execute(update(User).where(User.id == user.id).values(coins=User.coins + 5))
+        session.commit()
+    finally:
+        session.close()
+    drift = reconciler.run(full=True)['drift']
+    assert [(user_id, balance, ledger) for user_id, balance, ledger in drift] == [(user.id, 15, 10)]
+
+
+def test_repair_writes_adjustments(db, user):
+    db.add_coins(user.id, 10, 'admin_grant')
+    session = db.get_session()
+    try:
+        session.execute(update(User).where(User.id == user.id).values(coins=User.coins + 5))
+        session.commit()
+    finally:
+        session.close()
+    txn_mark, user_mark, _ = db.get_ranking_rows()
+
+    report = Reconciler(db, repair=True, settle=0).run()
+    assert report['repaired'] == 1
+    assert db.get_user(user.id).coins == 10
+    assert ledger_sum(db, user.id) == 10
+    assert [(t.transaction_type, t.amount) for t in db.get_transactions(user.id)][:2] == \
+        [(ADJUSTMENT_TYPE, -5), (ADJUSTMENT_TYPE, 5)]
+    # Other processes find the user through the new ledger rows
+    assert [row[1] for row in db.get_ranking_rows(txn_mark, user_mark)[2]] == [user.telegram_id]
+    assert Reconciler(db, settle=0).run()['drift'] == []
+    assert Reconciler(db, settle=0).run(full=True)['drift'] == []
+    assert db.get_window_leaderboard('day')[0][1] == 10
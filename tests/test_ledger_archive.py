@@ -0,0 +1,49 @@
+import gzip
+import json
+import os
+from datetime import date, datetime
+
+from ledger_archive import LedgerArchive
+
+DAY = date(2024, 1, 2)
+
+
+def rows(ids, user_id=1):
+    return [{'id': row_id, 'user_id': user_id, 'amount': 0.1, 'transaction_type': 'tap_reward',
+             'description': None, 'created_at': datetime(2024, 1, 2, 12, 0, row_id)} for row_id in ids]
+
+
+def member(ids, user_id=1):
+    return gzip.compress(b''.join(
+        json.dumps([row['id'], user_id, row['amount'], row['transaction_type'], row['description'],
+                    row['created_at'].isoformat()]).encode() + b'\n'
+        for row in rows(ids, user_id)
+    ))
+
+
+def test_each_run_writes_its_own_segments(tmp_path):
+    archive = LedgerArchive(str(tmp_path))
+    archive.append(rows([1, 2]))
+    archive.append(rows([3]) + rows([4], user_id=2))
+    assert [row['id'] for row in archive.read(1, DAY)] == [1, 2, 3]
+    assert [row['id'] for row in archive.read(2, DAY)] == [4]
+    assert len(os.listdir(tmp_path / DAY.isoformat())) == 3
+
+
+def test_unfinished_segment_is_ignored(tmp_path):
+    archive = LedgerArchive(str(tmp_path))
+    archive.append(rows([1]))
+    (tmp_path / DAY.isoformat() / '01.20240103T000000-00000000.jsonl.gz.tmp').write_bytes(member([2])[:20])
+    assert [row['id'] for row in archive.read(1, DAY)] == [1]
+
+
+def test_torn_member_keeps_later_members(tmp_path):
+    # A segment from before segments per run: a torn member, then the retried run's member
+    path = tmp_path / DAY.isoformat() / '01.jsonl.gz'
+    path.parent.mkdir()
+    path.write_bytes(member([1, 2]) + member([3, 4])[:25] + member([3, 4, 5]))
+    archive = LedgerArchive(str(tmp_path))
+    assert [row['id'] for row in archive.read(1, DAY)] == [1, 2, 3, 4, 5]
+
+    path.write_bytes(member([1]) + member([2])[:-3])
+    assert [row['id'] for row in archive.read(1, DAY)] == [1]
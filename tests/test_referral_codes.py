@@ -0,0 +1,38 @@
+import random
+
+import pytest
+
+import referral_codes
+from referral_codes import CODE_LENGTH, ReferralCodes, decode, encode
+
+
+def test_codes_round_trip():
+    for user_id in (1, 2, 1000, 2 ** 31, 2 ** 32 - 1):
+        code = encode(user_id)
+        assert len(code) == CODE_LENGTH
+        assert decode(code) == user_id
+        assert decode(code.lower()) == user_id
+
+
+def test_made_up_codes_fail_the_checksum():
+    rng = random.Random(1)
+    codes = (''.join(rng.choice(referral_codes.ALPHABET) for _ in range(CODE_LENGTH)) for _ in range(100000))
+    # One in 2**18 passes by chance
+    assert sum(decode(code) is not None for code in codes) <= 3
+
+
+def test_other_lengths_are_looked_up():
+    lookups = []
+    codes = ReferralCodes(lambda code: lookups.append(code) or 7)
+    assert codes.resolve('ABCDEFGH') == 7
+    assert codes.resolve('ABCDEFGH') == 7
+    assert codes.resolve(encode(5)) == 5
+    assert lookups == ['ABCDEFGH']
+
+
+def test_require_secret(monkeypatch):
+    monkeypatch.delenv('REFERRAL_CODE_SECRET', raising=False)
+    with pytest.raises(RuntimeError):
+        referral_codes.require_secret()
+    monkeypatch.setenv('REFERRAL_CODE_SECRET', 'secret')
+    referral_codes.require_secret()
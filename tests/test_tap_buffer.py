@@ -0,0 +1,70 @@
+from tap_buffer import TapAccumulator
+
+
+def make_buffer(db, tmp_path, **kwargs):
+    buffer = TapAccumulator(db, spill_path=str(tmp_path / 'tap_spill.log'), **kwargs)
+    # Flushed by hand, without the background thread
+    buffer.replay()
+    buffer._spill = open(buffer.spill_path, 'a', encoding='utf-8')
+    return buffer
+
+
+def test_duplicates_are_refused_while_pending_and_after_flush(db, user, tmp_path):
+    buffer = make_buffer(db, tmp_path)
+    try:
+        assert buffer.add(user.id, 1, 10, 1.0)
+        assert not buffer.add(user.id, 1, 10, 1.0)
+        assert buffer.pending_coins(user.id) == 1.0
+        assert buffer.flush() == 1
+        assert not buffer.add(user.id, 1, 10, 1.0)
+        assert buffer.pending_coins(user.id) == 0.0
+    finally:
+        buffer.stop()
+    assert db.get_user(user.id).coins == 1.0
+
+
+def test_batch_flushed_long_ago_is_refused(db, user, tmp_path):
+    buffer = make_buffer(db, tmp_path, recent_size=2)
+    try:
+        for seq in range(1, 6):
+            assert buffer.add(user.id, seq, 10, 1.0)
+            buffer.flush()
+        # Seq 1 left the in-memory set, tap_batches still has it
+        assert (user.id, 1) not in buffer._recent_keys
+        assert not buffer.add(user.id, 1, 10, 1.0)
+        assert buffer.pending_coins(user.id) == 0.0
+        assert buffer.add(user.id, 6, 10, 1.0)
+    finally:
+        buffer.stop()
+    assert db.get_user(user.id).coins == 6.0
+
+
+def test_batch_applied_before_a_restart_is_refused(db, user, tmp_path):
+    db.record_tap_batch(user.id, 1, taps=10, amount=1.0)
+    buffer = make_buffer(db, tmp_path)
+    try:
+        assert not buffer.add(user.id, 1, 10, 1.0)
+        assert buffer.add(user.id, 2, 10, 1.0)
+    finally:
+        buffer.stop()
+    assert db.get_user(user.id).coins == 2.0
+
+
+def test_new_batches_are_not_looked_up(db, user, tmp_path, monkeypatch):
+    db.record_tap_batch(user.id, 5, taps=10, amount=1.0)
+    lookups = []
+    applied = db.tap_batch_applied
+    monkeypatch.setattr(db, 'tap_batch_applied', lambda *key: lookups.append(key) or applied(*key))
+    buffer = make_buffer(db, tmp_path)
+    try:
+        for seq in range(6, 20):
+            assert buffer.add(user.id, seq, 1, 0.1)
+        buffer.flush()
+        assert buffer.add(user.id, 20, 1, 0.1)
+        assert lookups == []
+        # At or below the highest seq seen: a retry, or a batch from another device
+        assert not buffer.add(user.id, 5, 10, 1.0)
+        assert buffer.add(user.id, 3, 1, 0.1)
+        assert lookups == [(user.id, 5), (user.id, 3)]
+    finally:
+        buffer.stop()
@@ -0,0 +1,54 @@
+from database import TapBatch, Transaction
+
+
+def test_record_tap_batch_is_idempotent(db, user):
+    assert db.record_tap_batch(user.id, 1, taps=10, amount=1.0) == (1.0, False)
+    assert db.record_tap_batch(user.id, 1, taps=10, amount=1.0) == (1.0, True)
+    assert db.record_tap_batch(user.id, 2, taps=5, amount=0.5) == (1.5, False)
+    assert [t.amount for t in db.get_transactions(user.id)] == [0.5, 1.0]
+
+
+def test_record_tap_batch_unknown_user(db):
+    assert db.record_tap_batch(999999, 1, taps=1, amount=0.1) == (None, False)
+
+
+def test_apply_tap_batches_skips_applied(db, user):
+    other = db.get_or_create_user(2002, 'other')
+    db.record_tap_batch(user.id, 1, taps=10, amount=1.0)
+    batches = [
+        {'user_id': user.id, 'seq': seq, 'taps': 10, 'amount': 1.0, 'window_start': None, 'window_end': None}
+        for seq in (1, 2, 3, 3)
+    ] + [{'user_id': other.id, 'seq': 1, 'taps': 4, 'amount': 0.4, 'window_start': None, 'window_end': None}]
+    assert db.apply_tap_batches(batches) == 3
+    assert db.apply_tap_batches(batches) == 0
+    assert db.get_user(user.id).coins == 3.0
+    assert db.get_user(other.id).coins == 0.4
+    session = db.get_session()
+    try:
+        assert session.query(TapBatch).count() == 4
+        # One aggregated ledger row per user per call
+        assert session.query(Transaction).filter_by(user_id=user.id).count() == 2
+    finally:
+        session.close()
+
+
+def test_tap_amounts_are_exact(db, user):
+    for seq in range(1, 101):
+        db.record_tap_batch(user.id, seq, taps=1, amount=0.01)
+    assert db.get_user(user.id).coins == 1.0
+
+
+def test_apply_tap_batches_drops_unknown_users(db, user):
+    batches = [
+        {'user_id': user_id, 'seq': 1, 'taps': 10, 'amount': 1.0, 'window_start': None, 'window_end': None}
+        for user_id in (user.id, 999999)
+    ]
+    assert db.apply_tap_batches(batches) == 1
+    assert db.apply_tap_batches(batches[1:]) == 0
+    session = db.get_session()
+    try:
+        assert session.query(TapBatch).filter_by(user_id=999999).count() == 0
+        assert session.query(Transaction).filter_by(user_id=999999).count() == 0
+    finally:
+        session.close()
+    assert db.get_user(user.id).coins == 1.0
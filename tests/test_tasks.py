@@ -0,0 +1,67 @@
+def test_create_task_charges_creator(db, user):
+    db.add_coins(user.id, 100, 'admin_grant')
+    task, balance = db.create_task(user.id, 'Follow', 'Follow the channel', 10, cost=10)
+    assert task.id and balance == 90
+    assert db.get_transactions(user.id)[0].transaction_type == 'task_creation'
+
+
+def test_create_task_refuses_without_funds(db, user):
+    assert db.create_task(user.id, 'Follow', None, 10, cost=10) == (None, 0)
+
+
+def test_complete_task_pays_once(db, user):
+    worker = db.get_or_create_user(3003, 'worker')
+    task, _ = db.create_task(user.id, 'Follow', None, 25)
+    assert db.complete_task(task.id, worker.id) == ('not_assigned', None)
+
+    session = db.get_session()
+    try:
+        session.get(type(task), task.id).assigned_to = worker.id
+        session.commit()
+    finally:
+        session.close()
+
+    error, result = db.complete_task(task.id, worker.id)
+    assert error is None
+    assert (result['balance'], result['tasks_completed'], result['level']) == (25, 1, 1)
+    assert db.complete_task(task.id, worker.id) == ('completed', None)
+    assert db.complete_task(task.id + 1000, worker.id) == ('not_found', None)
+    assert db.get_user(worker.id).coins == 25
+
+
+def test_get_user_tasks(db, user):
+    worker = db.get_or_create_user(3003, 'worker')
+    tasks = [db.create_task(user.id, f'Task {i}', None, 10)[0] for i in range(5)]
+    session = db.get_session()
+    try:
+        session.get(type(tasks[0]), tasks[1].id).assigned_to = worker.id
+        session.get(type(tasks[0]), tasks[2].id).assigned_to = user.id
+        session.commit()
+    finally:
+        session.close()
+
+    assigned, available, created = db.get_user_tasks(worker.id)
+    assert [t.id for t in assigned] == [tasks[1].id]
+    assert [t.id for t in available] == [tasks[4].id, tasks[3].id, tasks[0].id]
+    assert available[0].creator.username == 'alice'
+    assert created == []
+    assert len(db.get_user_tasks(user.id)[2]) == 5
+
+
+def test_task_feed_pages(db, user):
+    ids = [db.create_task(user.id, f'Task {i}', None, i)[0].id for i in range(7)]
+    seen, cursor = [], None
+    while True:
+        page, cursor = db.get_task_feed(cursor, limit=3)
+        seen += [t.id for t in page]
+        if cursor is None:
+            break
+    assert seen == ids[::-1]
+    page, _ = db.get_task_feed(min_reward=5)
+    assert [t.reward_coins for t in page] == [6, 5]
+
+
+def test_free_task_ignores_balance(db, user):
+    db.add_coins(user.id, -5, 'penalty')
+    task, balance = db.create_task(user.id, 'Follow', None, 10)
+    assert task is not None and balance == -5
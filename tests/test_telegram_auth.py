@@ -0,0 +1,37 @@
+import hashlib
+import hmac
+import json
+from urllib.parse import urlencode
+
+import pytest
+
+from telegram_auth import InitDataError, TelegramAuth
+
+TOKEN = '1:test'
+NOW = 1_700_000_000
+
+
+def init_data(user_id, auth_date=NOW, token=TOKEN):
+    fields = {'auth_date': str(auth_date), 'user': json.dumps({'id': user_id, 'first_name': 'A'})}
+    data_check_string = '\n'.join(f'{key}={value}' for key, value in sorted(fields.items()))
+    secret_key = hmac.new(b'WebAppData', token.encode(), hashlib.sha256).digest()
+    fields['hash'] = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+    return urlencode(fields)
+
+
+def test_verify():
+    auth = TelegramAuth(TOKEN, max_age=3600)
+    assert auth.verify(init_data(7), now=NOW + 10)['user']['id'] == 7
+    with pytest.raises(InitDataError):
+        auth.verify(init_data(7, token='1:other'), now=NOW + 10)
+    with pytest.raises(InitDataError):
+        auth.verify(init_data(7), now=NOW + 3600)
+
+
+def test_sessions_expire():
+    auth = TelegramAuth(TOKEN)
+    token = auth.issue_session(7, now=NOW)
+    assert auth.session_telegram_id(token, now=NOW + auth.session_ttl - 1) == 7
+    assert auth.session_telegram_id(token, now=NOW + auth.session_ttl) is None
+    assert auth.session_telegram_id(token.replace('7.', '8.', 1), now=NOW) is None
+    assert auth.session_ttl <= 3600
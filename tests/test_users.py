@@ -0,0 +1,64 @@
+from database import User
+
+
+def test_get_or_create_user_creates_once(db):
+    created = db.get_or_create_user(42, 'bob', 'Bob')
+    again = db.get_or_create_user(42, 'bob', 'Bob')
+    assert again.id == created.id
+    assert created.coins == 0
+    assert created.referral_code
+    session = db.get_session()
+    try:
+        assert session.query(User).filter_by(telegram_id=42).count() == 1
+    finally:
+        session.close()
+
+
+def test_get_or_create_user_updates_names(db):
+    user = db.get_or_create_user(42, 'bob', 'Bob')
+    renamed = db.get_or_create_user(42, 'bobby', 'Robert')
+    assert renamed.id == user.id
+    assert (db.get_user(user.id).username, db.get_user(user.id).first_name) == ('bobby', 'Robert')
+
+
+def test_cached_user_sees_balance_changes(db, user):
+    db.add_coins(user.id, 12.5, 'admin_grant')
+    assert db.get_or_create_user(user.telegram_id).coins == 12.5
+
+
+def test_referral_code_resolves(db, user):
+    assert db.get_user_by_referral_code(user.referral_code).id == user.id
+    assert db.get_user_by_referral_code('not-a-code') is None
+
+
+def test_attach_referral_pays_ancestors(db):
+    top = db.get_or_create_user(1, 'top')
+    middle = db.get_or_create_user(2, 'middle')
+    bottom = db.get_or_create_user(3, 'bottom')
+    assert [level for level, *_ in db.attach_referral(middle.id, top.referral_code, 'middle')] == [1]
+    paid = db.attach_referral(bottom.id, middle.referral_code, 'bottom')
+    assert [(level, user_id) for level, user_id, _, _ in paid] == [(1, middle.id), (2, top.id)]
+    # Already referred
+    assert db.attach_referral(bottom.id, top.referral_code, 'bottom') == []
+    assert db.get_user(top.id).indirect_referrals == 1
+
+
+def test_search_users(db):
+    db.get_or_create_user(7001, 'carol', 'Carol')
+    db.get_or_create_user(7002, 'dave', 'Dave')
+    assert [u.telegram_id for u in db.search_users('car')] == [7001]
+    assert [u.telegram_id for u in db.search_users('7002')] == [7002]
+
+
+def test_search_ranks_every_match(db):
+    for telegram_id in range(100, 700):
+        db.get_or_create_user(telegram_id, f'user{telegram_id}', 'Zed')
+    best = db.get_or_create_user(999, 'zed', 'Zed')
+    # The username match outranks first name matches however many users matched before it
+    assert db.search_users('zed')[0].id == best.id
+
+
+def test_search_numeric_out_of_range(db, user):
+    assert db.search_users(str(10 ** 30)) == []
+    assert db.search_users('²') == []
+    assert [u.id for u in db.search_users(str(user.telegram_id))] == [user.id]
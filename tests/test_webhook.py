@@ -0,0 +1,26 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+
+from webhook import TelegramWebhook
+
+UPDATE = {'update_id': 1, 'message': {'message_id': 1, 'date': 0, 'chat': {'id': 5, 'type': 'private'}, 'text': 'hi'}}
+
+
+def test_url_without_path_gets_default_path():
+    assert TelegramWebhook(None, 's', 'https://example.com').url == 'https://example.com/telegram/webhook'
+    assert TelegramWebhook(None, 's', 'https://example.com/').path == '/telegram/webhook'
+    assert TelegramWebhook(None, 's', 'https://example.com/hook').path == '/hook'
+
+
+def test_updates_need_the_secret():
+    async def post():
+        application = SimpleNamespace(bot=None, update_queue=asyncio.Queue())
+        webhook = TelegramWebhook(application, 'secret', 'https://example.com/hook')
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=webhook), base_url='http://test') as client:
+            rejected = await client.post('/hook', json=UPDATE, headers={'X-Telegram-Bot-Api-Secret-Token': 'wrong'})
+            accepted = await client.post('/hook', json=UPDATE, headers={'X-Telegram-Bot-Api-Secret-Token': 'secret'})
+        return rejected.status_code, accepted.status_code, application.update_queue.qsize()
+
+    assert asyncio.run(post()) == (403, 200, 1)
@@ -0,0 +1,71 @@
+"""Bounded read-through cache for user rows.
+
+Nearly every request and bot command starts by loading the caller's user
+row. UserCache keeps the column values of recently seen users keyed by
+telegram_id, evicting the least recently used entry beyond `max_size` and
+treating entries older than `ttl` seconds as misses. Writes made through
+Database update or drop the cached entry; writes made by other processes are
+picked up once the entry expires.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class UserCache:
+    def __init__(self, max_size=10000, ttl=30.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # telegram_id -> (expires_at, values)
+        self._telegram_ids = {}  # user id -> telegram_id
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, telegram_id):
+        """Cached column values for a user, or None"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(telegram_id)
+            if entry is None or entry[0] < now:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(telegram_id)
+            self.hits += 1
+            return dict(entry[1])
+
+    def put(self, values):
+        with self._lock:
+            telegram_id = values['telegram_id']
+            self._entries[telegram_id] = (time.monotonic() + self.ttl, dict(values))
+            self._entries.move_to_end(telegram_id)
+            self._telegram_ids[values['id']] = telegram_id
+            while len(self._entries) > self.max_size:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._telegram_ids.pop(evicted['id'], None)
+                self.evictions += 1
+
+    def update(self, user_id, **fields):
+        """Apply committed changes to a cached user, if present"""
+        with self._lock:
+            entry = self._entries.get(self._telegram_ids.get(user_id))
+            if entry is not None:
+                entry[1].update(fields)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            telegram_id = self._telegram_ids.pop(user_id, None)
+            self._entries.pop(telegram_id, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
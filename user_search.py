@@ -0,0 +1,92 @@
+"""Indexed user search by username and first name.
+
+On SQLite the names are indexed in an FTS5 table, users_fts, that triggers
+on users keep in step with every insert, delete and name change (balance
+updates don't touch it). Queries match each word as a prefix and every
+match is ranked with bm25, a username match weighing twice a first name
+match, before the best are taken. PostgreSQL deployments use expression
+indexes on lower(username) and lower(first_name) for prefix matching
+instead, exact matches first and then by the same column weights.
+
+A numeric query that fits the telegram_id column is also looked up through
+its unique index.
+"""
+import re
+
+from sqlalchemy import text
+
+SQLITE_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5("
+    "username, first_name, content='users', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN "
+    "INSERT INTO users_fts (rowid, username, first_name) VALUES (new.id, new.username, new.first_name); END",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN "
+    "INSERT INTO users_fts (users_fts, rowid, username, first_name) "
+    "VALUES ('delete', old.id, old.username, old.first_name); END",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF username, first_name ON users BEGIN "
+    "INSERT INTO users_fts (users_fts, rowid, username, first_name) "
+    "VALUES ('delete', old.id, old.username, old.first_name); "
+    "INSERT INTO users_fts (rowid, username, first_name) VALUES (new.id, new.username, new.first_name); END",
+)
+POSTGRESQL_DDL = (
+    'CREATE INDEX IF NOT EXISTS ix_users_username_prefix ON users (lower(username) text_pattern_ops)',
+    'CREATE INDEX IF NOT EXISTS ix_users_first_name_prefix ON users (lower(first_name) text_pattern_ops)',
+)
+
+MAX_TELEGRAM_ID = 2 ** 63 - 1  # users.telegram_id is a BIGINT
+SEARCH_SQL = {
+    'sqlite':
+        'SELECT rowid FROM users_fts WHERE users_fts MATCH :query '
+        'ORDER BY bm25(users_fts, 2.0, 1.0) LIMIT :limit',
+    'postgresql':
+        "SELECT id FROM ("
+        "SELECT id, lower(username) = :term AS exact, 2 AS weight FROM users "
+        "WHERE lower(username) LIKE :prefix ESCAPE '\\' "
+        "UNION ALL "
+        "SELECT id, lower(first_name) = :term, 1 FROM users WHERE lower(first_name) LIKE :prefix ESCAPE '\\'"
+        ") matches GROUP BY id ORDER BY bool_or(exact) DESC, sum(weight) DESC, id LIMIT :limit",
+}
+
+
+def create_search_index(conn):
+    """Create the search index and its triggers; safe to run again"""
+    if conn.dialect.name == 'sqlite':
+        exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'users_fts'")).first()
+        for statement in SQLITE_DDL:
+            conn.execute(text(statement))
+        if not exists:
+            conn.execute(text("INSERT INTO users_fts (users_fts) VALUES ('rebuild')"))
+    elif conn.dialect.name == 'postgresql':
+        for statement in POSTGRESQL_DDL:
+            conn.execute(text(statement))
+
+
+def search_params(dialect, query, limit):
+    """Bind parameters for SEARCH_SQL[dialect], or None if the query has no words"""
+    words = re.findall(r'\w+', query.lower())
+    if not words:
+        return None
+    if dialect == 'sqlite':
+        # Every word must match the start of a token, in either column
+        return {'query': ' '.join(f'"{word}"*' for word in words), 'limit': limit}
+    term = ' '.join(query.strip().lstrip('@').lower().split())
+    escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return {'term': term, 'prefix': f'{escaped}%', 'limit': limit}
+
+
+def telegram_id_query(query):
+    """The telegram_id a query can be, or None"""
+    query = query.strip()
+    if not query.isdecimal():
+        return None
+    telegram_id = int(query)
+    return telegram_id if telegram_id <= MAX_TELEGRAM_ID else None
+
+
+def search_user_ids(conn, query, limit=10):
+    """Ids of the users best matching `query`, best first"""
+    params = search_params(conn.dialect.name, query, limit)
+    if params is None:
+        return []
+    return conn.execute(text(SEARCH_SQL[conn.dialect.name]), params).scalars().all()
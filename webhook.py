@@ -0,0 +1,99 @@
+"""Telegram updates pushed to the shared HTTP server instead of long polling.
+
+With TELEGRAM_WEBHOOK_URL set, asgi.py registers that URL with setWebhook
+and Telegram POSTs every update to it, on the same server as the Mini App
+API. A request is accepted only with the secret token given to setWebhook
+in its X-Telegram-Bot-Api-Secret-Token header (TELEGRAM_WEBHOOK_SECRET, by
+default derived from the bot token so every instance agrees on it). A URL
+without a path gets DEFAULT_PATH, since "/" is the Mini App itself. The
+update is put on the Application's update queue and acknowledged at once,
+so a slow handler never holds up the next delivery.
+"""
+import hashlib
+import hmac
+import json
+import logging
+import os
+from urllib.parse import urlparse
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_URL = os.environ.get('TELEGRAM_WEBHOOK_URL')
+MAX_BODY_BYTES = 1 << 20
+SECRET_HEADER = b'x-telegram-bot-api-secret-token'
+DEFAULT_PATH = '/telegram/webhook'
+
+
+def webhook_secret(token):
+    """TELEGRAM_WEBHOOK_SECRET, or a secret derived from the bot token"""
+    # Telegram allows letters, digits, _ and - in up to 256 characters
+    return os.environ.get('TELEGRAM_WEBHOOK_SECRET') or hashlib.sha256(b'webhook:' + token.encode()).hexdigest()
+
+
+def endpoint_url(url):
+    """The webhook URL to register, with DEFAULT_PATH if `url` has no path"""
+    parsed = urlparse(url)
+    if parsed.path.strip('/'):
+        return url
+    logger.warning('TELEGRAM_WEBHOOK_URL has no path, receiving updates at %s', DEFAULT_PATH)
+    return parsed._replace(path=DEFAULT_PATH).geturl()
+
+
+async def respond(send, status, payload=None):
+    body = json.dumps(payload or {}).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+class TelegramWebhook:
+    """ASGI endpoint queuing POSTed updates into a started Application"""
+
+    def __init__(self, application, secret, url):
+        self.application = application
+        self.secret = secret.encode()
+        self.url = endpoint_url(url)
+        self.path = urlparse(self.url).path
+        self.received = 0
+        self.rejected = 0
+
+    async def register(self):
+        """Point Telegram at this endpoint; updates queued while we were down are delivered here"""
+        await self.application.bot.set_webhook(
+            self.url, secret_token=self.secret.decode(), allowed_updates=Update.ALL_TYPES
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope['method'] != 'POST':
+            await respond(send, 405, {'error': 'Method not allowed'})
+            return
+        secret = dict(scope['headers']).get(SECRET_HEADER, b'')
+        if not hmac.compare_digest(secret, self.secret):
+            self.rejected += 1
+            await respond(send, 403, {'error': 'Invalid secret token'})
+            return
+
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if len(body) > MAX_BODY_BYTES:
+                await respond(send, 413, {'error': 'Update too large'})
+                return
+            if not message.get('more_body'):
+                break
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            # Telegram would retry it forever, so acknowledge and log it
+            logger.warning('Ignoring malformed update: %s', e)
+            await respond(send, 200)
+            return
+        await self.application.update_queue.put(update)
+        self.received += 1
+        await respond(send, 200)